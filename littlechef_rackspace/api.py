@@ -1,39 +1,224 @@
-from libcloud.compute.base import NodeImage, NodeSize
+from libcloud.compute.base import Node, NodeImage, NodeSize
 from libcloud.compute.drivers.openstack import OpenStackNetwork
 from libcloud.compute.providers import get_driver
 from libcloud.compute.types import Provider, NodeState
+import threading
 import time
+import urllib
+from journal import SUBMITTED
 from lib import Host
+from metrics import Metrics
+from parallel import run_windowed
+from poller import NodePoller, ServerView
+from ratelimit import (RateLimiter, PRIORITY_POLL, PRIORITY_ACTION,
+                       PRIORITY_LIST)
+
+
+# libcloud maps ERROR (and anything else it doesn't know) to UNKNOWN, and
+# DELETED/SUSPENDED to TERMINATED; a build never recovers from these
+FAILED_STATES = [NodeState.UNKNOWN, NodeState.TERMINATED]
+
+
+class BuildError(Exception):
+
+    def __init__(self, node, message):
+        super(BuildError, self).__init__(message)
+        self.node = node
+        self.node_id = node.id if node else None
+
+
+class BuildFailed(BuildError):
+    pass
+
+
+class BuildTimeout(BuildError):
+    pass
 
 
 class RackspaceApi(object):
 
-    def __init__(self, username, key, region):
+    def __init__(self, username, key, region, rate_limiter=None,
+                 build_timeout=30 * 60, rebuild_start_timeout=5 * 60,
+                 replace_failed=0, shared_polling=False, metrics=None,
+                 page_size=1000, clock=time.time):
         self.username = username
         self.key = key
         self.region = region
+        self.rate_limiter = rate_limiter or RateLimiter()
+        # Seconds to wait for a node to become active / begin rebuilding
+        self.build_timeout = build_timeout
+        self.rebuild_start_timeout = rebuild_start_timeout
+        # How many times to replace a failed build before giving up
+        self.replace_failed = replace_failed
+        self.metrics = metrics or Metrics()
+        # Servers per page of a listing (Nova returns at most 1000)
+        self.page_size = page_size
+        self.clock = clock
+        self._local = threading.local()
+        # Every listing of servers after the first only fetches changes
+        self.servers = ServerView(self._list_all_servers,
+                                  self._list_changed_servers)
+        # With many builds in flight, poll them all with one listing
+        self.poller = None
+        if shared_polling:
+            self.poller = NodePoller(self._list_nodes_to_poll)
 
     def _get_conn(self):
-        Driver = get_driver(Provider.RACKSPACE)
-        return Driver(self.username, self.key, region=self.region)
+        # A driver authenticates on first use and keeps its token, so
+        # reuse one per thread (they aren't safe to share between threads)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            Driver = get_driver(Provider.RACKSPACE)
+            conn = self._local.conn = Driver(self.username, self.key,
+                                             region=self.region)
+        return conn
+
+    def authenticate(self):
+        """
+        Authenticate this thread's connection now rather than on its first
+        request, e.g. so --profile charges it to the 'api' phase
+        """
+
+        self._get_conn().connection.get_service_catalog()
+
+    def _load_limits(self, conn):
+        """
+        Seed the rate limiter from the account's /limits, and reload them
+        when they go stale.  If the limits can't be read we keep the ones
+        we have, and still honor over limit responses.
+        """
+
+        if not self.rate_limiter.expired():
+            return
+
+        try:
+            limits = conn.connection.request("/limits").object
+            self.rate_limiter.configure(limits)
+        except Exception:
+            if not self.rate_limiter.configured:
+                self.rate_limiter.configure({})
+
+    def _call(self, conn, verb, uri, priority, func, *args, **kwargs):
+        """
+        Issue an API call through the account rate limiter
+        """
+
+        self._load_limits(conn)
+        call = getattr(func, '__name__', verb)
+        started = time.time()
+        try:
+            return self.rate_limiter.call(verb, uri, priority,
+                                          func, *args, **kwargs)
+        except Exception:
+            self.metrics.increment("api_errors_total", call=call)
+            raise
+        finally:
+            # Includes time spent waiting on the rate limiter
+            self.metrics.observe("api_request_seconds",
+                                 time.time() - started, call=call)
 
     def list_images(self):
         conn = self._get_conn()
+        images = self._call(conn, "GET", "/images/detail", PRIORITY_LIST,
+                            conn.list_images)
 
-        return [{"id": image.id, "name": image.name}
-                for image in conn.list_images()]
+        return [{"id": image.id, "name": image.name,
+                 "created": image.extra.get('created')}
+                for image in images]
 
     def list_networks(self):
         conn = self._get_conn()
+        networks = self._call(conn, "GET", "/os-networksv2", PRIORITY_LIST,
+                              conn.ex_list_networks)
 
         return [{"id": network.id, "name": network.name, "cidr": network.cidr}
-                for network in conn.ex_list_networks()]
+                for network in networks]
 
     def list_flavors(self):
         conn = self._get_conn()
+        sizes = self._call(conn, "GET", "/flavors/detail", PRIORITY_LIST,
+                           conn.list_sizes)
+
+        return [{"id": size.id, "name": size.name, "ram": size.ram}
+                for size in sizes]
+
+    def headroom(self):
+        """
+        Servers and MB of RAM the account can still create
+        """
+
+        self._load_limits(self._get_conn())
+        return self.rate_limiter.headroom()
+
+    def _servers_detail(self, conn, priority, **params):
+        """
+        Every server of a /servers/detail listing, a page at a time
+        """
+
+        servers = []
+        params['limit'] = self.page_size
+        while True:
+            def list_nodes():
+                return conn.connection.request("/servers/detail",
+                                               params=dict(params)).object
+
+            # The query too, for limits on e.g. changes-since listings
+            uri = "/servers/detail?" + urllib.urlencode(sorted(params.items()))
+            page = self._call(conn, "GET", uri, priority,
+                              list_nodes)['servers']
+            servers.extend(page)
+            if len(page) < self.page_size:
+                return servers
+            params['marker'] = page[-1]['id']
+
+    def _to_nodes(self, conn, servers):
+        nodes = []
+        for server in servers:
+            node = conn._to_node(server)
+            # libcloud folds several statuses into one state
+            node.extra['status'] = server['status']
+            nodes.append(node)
+        return nodes
+
+    def _list_all_servers(self, priority):
+        conn = self._get_conn()
+        return self._to_nodes(conn, self._servers_detail(conn, priority))
 
-        return [{"id": size.id, "name": size.name}
-                for size in conn.list_sizes()]
+    def _list_changed_servers(self, since, priority):
+        conn = self._get_conn()
+        servers = self._servers_detail(conn, priority,
+                                       **{'changes-since': since})
+
+        # Deleted servers come back once, with only some of their details
+        changed = self._to_nodes(conn, [server for server in servers
+                                        if server['status'] != 'DELETED'])
+        deleted = [server['id'] for server in servers
+                   if server['status'] == 'DELETED']
+        return changed, deleted
+
+    def _list_nodes(self, conn):
+        return self.servers.refresh(priority=PRIORITY_LIST)
+
+    def _get_node_details(self, conn, node_id):
+        return self._call(conn, "GET", "/servers/{0}".format(node_id),
+                          PRIORITY_POLL, conn.ex_get_node_details, node_id)
+
+    def _list_nodes_to_poll(self):
+        return self.servers.refresh(priority=PRIORITY_POLL)
+
+    def _next_states(self, conn, nodes):
+        """
+        Wait a polling interval and return the nodes' current state
+        """
+
+        if self.poller is None:
+            time.sleep(5)
+            return [self._get_node_details(conn, node.id) for node in nodes]
+
+        polled = self.poller.next_states([node.id for node in nodes])
+        # A node too new (or too far down the list) to be in the listing
+        return [current or self._get_node_details(conn, node.id)
+                for node, current in zip(nodes, polled)]
 
     def list_servers(self):
         conn = self._get_conn()
@@ -41,27 +226,85 @@ class RackspaceApi(object):
         return [{"id": node.id,
                  "name": node.name,
                  "public_ipv4": self._public_ipv4(node)}
-                for node in conn.list_nodes()]
+                for node in self._list_nodes(conn)]
+
+    def list_server_details(self):
+        """
+        Like list_servers, with every address, image, flavor, status and
+        metadata
+        """
+
+        conn = self._get_conn()
+
+        return [self._server_details(node)
+                for node in self._list_nodes(conn)]
+
+    def list_server_changes(self, since):
+        """
+        Details of the servers changed since a changes-since time, and the
+        ids of those deleted
+        """
+
+        changed, deleted = self._list_changed_servers(since, PRIORITY_LIST)
+        return [self._server_details(node) for node in changed], deleted
+
+    def _server_details(self, node):
+        return {"id": node.id,
+                "name": node.name,
+                "region": self.region,
+                "status": node.extra.get('status'),
+                "public_ipv4": self._public_ipv4(node),
+                "public_ips": node.public_ips,
+                "private_ips": node.private_ips,
+                "image": node.extra.get('imageId'),
+                "flavor": node.extra.get('flavorId'),
+                "metadata": node.extra.get('metadata') or {},
+                "created": node.extra.get('created'),
+                "updated": node.extra.get('updated')}
 
     def _public_ipv4(self, node):
         # Dumb hack to not select the ipv6 address
-        return [ip for ip in node.public_ips if ":" not in ip][0]
+        ipv4s = [ip for ip in node.public_ips if ":" not in ip]
+        # Nodes that are still building have no addresses yet
+        return ipv4s[0] if ipv4s else None
 
     def _node_to_host(self, node):
         return Host(name=node.name,
-                    ip_address=self._public_ipv4(node))
+                    ip_address=self._public_ipv4(node),
+                    private_addresses=[ip for ip in node.private_ips
+                                       if ":" not in ip],
+                    node_id=node.id)
+
+    def _check_build(self, node, deadline, waiting_to):
+        """
+        Fail fast on nodes that errored out or have taken too long
+        """
+
+        if node.state in FAILED_STATES:
+            raise BuildFailed(node,
+                              "Node {0} ({1}) failed while waiting to {2}"
+                              .format(node.name, node.id, waiting_to))
+
+        if self.clock() > deadline:
+            raise BuildTimeout(node,
+                               "Node {0} ({1}) timed out waiting to {2}"
+                               .format(node.name, node.id, waiting_to))
 
     def _wait_for_node_to_become_active_host(self, conn, node, progress):
         if progress:
             progress.write("Waiting for node to become active")
 
+        deadline = self.clock() + self.build_timeout
         while node.state != NodeState.RUNNING:
-            time.sleep(5)
+            self._check_build(node, deadline, "become active")
+            node, = self._next_states(conn, [node])
 
             if progress:
                 progress.write(".")
-            node = conn.ex_get_node_details(node.id)
 
+        return self._active_host(node, progress)
+
+    def _active_host(self, node, progress):
         host = self._node_to_host(node)
         if progress:
             progress.write("\n")
@@ -70,8 +313,95 @@ class RackspaceApi(object):
 
         return host
 
+    def _wait_for_hedged_build(self, conn, node, submit, hedge_after,
+                               progress):
+        """
+        Wait for `node` to become active, submitting a spare build with
+        submit() once it has taken longer than `hedge_after` seconds.  The
+        first node to become active wins and the other one is deleted.
+        """
+
+        if progress:
+            progress.write("Waiting for node to become active")
+
+        started = self.clock()
+        deadline = started + self.build_timeout
+        building = [node]
+        hedged = False
+
+        while True:
+            active = [n for n in building if n.state == NodeState.RUNNING]
+            if active:
+                for loser in building:
+                    if loser is not active[0]:
+                        self._destroy_node(conn, loser)
+                return active[0]
+
+            for candidate in list(building):
+                try:
+                    self._check_build(candidate, deadline, "become active")
+                except BuildError:
+                    if len(building) == 1:
+                        raise
+                    building.remove(candidate)
+                    self._destroy_node(conn, candidate)
+
+            if not hedged and self.clock() - started > hedge_after:
+                hedged = True
+                if progress:
+                    progress.write("\nBuild is taking longer than {0}s, "
+                                   "submitting a spare\n".format(
+                                       int(hedge_after)))
+                building.append(submit())
+
+            building = self._next_states(conn, building)
+
+            if progress:
+                progress.write(".")
+
+    def wait_for_node(self, node_id, progress=None):
+        """
+        Wait for an existing node (e.g. one left building by an
+        interrupted run) to become active
+        """
+
+        conn = self._get_conn()
+        node = self._get_node_details(conn, node_id)
+
+        return self._wait_for_node_to_become_active_host(conn,
+                                                         node,
+                                                         progress=progress)
+
+    def wait_for_rebuild(self, node_id, updated, progress=None):
+        """
+        Wait for a rebuild submitted by an interrupted run to begin and
+        then finish; `updated` is the node's timestamp from before the
+        rebuild was submitted
+        """
+
+        conn = self._get_conn()
+        node = self._get_node_details(conn, node_id)
+        node = self._wait_for_rebuild_to_begin(conn, node, updated, progress)
+
+        return self._wait_for_node_to_become_active_host(conn,
+                                                         node,
+                                                         progress=progress)
+
+    def _destroy_node(self, conn, node):
+        self._call(conn, "DELETE", "/servers/{0}".format(node.id),
+                   PRIORITY_ACTION, conn.destroy_node, node)
+        self.rate_limiter.release_instance()
+
     def create_node(self, image, flavor, name, public_key_file,
-                    networks=None, progress=None):
+                    networks=None, progress=None, journal=None,
+                    hedge_after=None, user_data=None):
+        with self.metrics.phase("build", operation="create"):
+            return self._create_node(image, flavor, name, public_key_file,
+                                     networks, progress, journal,
+                                     hedge_after, user_data)
+
+    def _create_node(self, image, flavor, name, public_key_file, networks,
+                     progress, journal, hedge_after, user_data):
         create_kwargs = {}
         if networks:
             fake_networks = [OpenStackNetwork(n, None, None, self)
@@ -79,62 +409,237 @@ class RackspaceApi(object):
             create_kwargs['networks'] = fake_networks
 
         conn = self._get_conn()
+        create = conn.create_node
+        if user_data:
+            create = self._with_config_drive(conn, user_data)
         fake_image = NodeImage(id=image, name=None, driver=conn)
         fake_flavor = NodeSize(id=flavor, name=None, ram=None, disk=None,
                                bandwidth=None, price=None, driver=conn)
+        public_key = public_key_file.read()
+
+        def submit():
+            self.rate_limiter.claim_instance()
+            try:
+                node = self._call(conn, "POST", "/servers", PRIORITY_ACTION,
+                                  create, name=name, image=fake_image,
+                                  size=fake_flavor, ex_files={
+                                      "/root/.ssh/authorized_keys": public_key
+                                  },
+                                  **create_kwargs)
+            except Exception:
+                # Nothing was built, so it doesn't count against the quota
+                self.rate_limiter.release_instance()
+                raise
+            password = node.extra.get("password")
+
+            if progress:
+                progress.write("Created node {0} (id: {1}, password: {2})\n"
+                               .format(name, node.id, password))
+            return node
+
+        replacements = 0
+        while True:
+            if progress:
+                progress.write("Creating node {0} (image: {1}, "
+                               "flavor: {2})...\n".format(name, image,
+                                                          flavor))
+
+            self._load_limits(conn)
+            node = submit()
+            if journal:
+                journal.record("create", name, SUBMITTED, node_id=node.id)
+
+            try:
+                if not hedge_after:
+                    return self._wait_for_node_to_become_active_host(
+                        conn, node, progress=progress)
+
+                journaled = [node.id]
+
+                def submit_spare():
+                    spare = submit()
+                    if journal:
+                        # So an interrupted run still knows about it
+                        journal.record("create", name, SUBMITTED,
+                                       node_id=spare.id,
+                                       details={'spare_for': node.id})
+                        journaled.append(spare.id)
+                    return spare
+
+                winner = self._wait_for_hedged_build(conn, node,
+                                                     submit_spare,
+                                                     hedge_after, progress)
+                if journal and winner.id != journaled[-1]:
+                    journal.record("create", name, SUBMITTED,
+                                   node_id=winner.id)
+                return self._active_host(winner, progress)
+            except BuildError as e:
+                if replacements >= self.replace_failed:
+                    raise
+
+                replacements += 1
+                if progress:
+                    progress.write("\n{0}; deleting it and creating a "
+                                   "replacement\n".format(e))
+                self._destroy_node(conn, e.node)
+
+    def _with_config_drive(self, conn, user_data):
+        """
+        conn.create_node, also giving the server user data on a config
+        drive (where cloud-init reads it at first boot; libcloud has no
+        option for one)
+        """
+
+        def create_node(**kwargs):
+            params = conn._create_args_to_params(None, ex_userdata=user_data,
+                                                 **kwargs)
+            params['config_drive'] = True
+            created = conn.connection.request(
+                "/servers", method='POST',
+                data={'server': params}).object['server']
+            server = conn.connection.request(
+                "/servers/{0}".format(created['id'])).object['server']
+            server['adminPass'] = created.get('adminPass')
+            return conn._to_node(server)
+
+        return create_node
+
+    def _wait_for_rebuild_to_begin(self, conn, node, updated, progress):
+        """
+        Wait for node to go into 'Rebuilding' state (takes a few seconds).
+        A quick rebuild can finish between two polls, so a node that is
+        active again with a new 'updated' timestamp has also been rebuilt.
+        """
 
         if progress:
-            progress.write("Creating node {0} (image: {1}, flavor: {2})...\n"
-                           .format(name, image, flavor))
+            progress.write("Waiting for node to begin rebuilding")
+
+        deadline = self.clock() + self.rebuild_start_timeout
+        while node.state != NodeState.PENDING:
+            node, = self._next_states(conn, [node])
+
+            if progress:
+                progress.write(".")
 
-        node = conn.create_node(name=name, image=fake_image,
-                                size=fake_flavor, ex_files={
-                                    "/root/.ssh/authorized_keys":
-                                    public_key_file.read()
-                                },
-                                **create_kwargs)
-        password = node.extra.get("password")
+            self._check_build(node, deadline, "begin rebuilding")
+            if (node.state == NodeState.RUNNING and updated and
+                    node.extra.get('updated') != updated):
+                break
 
         if progress:
-            progress.write("Created node {0} (id: {1}, password: {2})\n"
-                           .format(name, node.id, password))
+            progress.write("\n")
 
-        return self._wait_for_node_to_become_active_host(conn,
-                                                         node,
-                                                         progress=progress)
+        return node
 
     def rebuild_node(self, name, image, public_key_file,
-                     networks=None, progress=None):
+                     networks=None, progress=None, node_id=None,
+                     journal=None):
+        with self.metrics.phase("build", operation="rebuild"):
+            return self._rebuild_node(name, image, public_key_file,
+                                      progress, node_id, journal)
+
+    def _rebuild_node(self, name, image, public_key_file, progress, node_id,
+                      journal):
         conn = self._get_conn()
 
-        nodes_with_name = [n for n in conn.list_nodes() if n.name == name]
-        node = nodes_with_name[0]
+        if node_id:
+            node = self._get_node_details(conn, node_id)
+        else:
+            nodes_with_name = [n for n in self._list_nodes(conn)
+                               if n.name == name]
+            node = nodes_with_name[0]
         fake_image = NodeImage(id=image, name=None, driver=conn)
+        public_key = public_key_file.read()
 
-        if progress:
-            progress.write("Rebuilding node {0} ({1})...".format(node.name,
-                                                                 node.id))
-            progress.write("\n")
+        replacements = 0
+        while True:
+            if progress:
+                progress.write("Rebuilding node {0} ({1})...".format(
+                    node.name, node.id))
+                progress.write("\n")
+
+            updated = node.extra.get('updated')
+            self._call(conn, "POST", "/servers/{0}/action".format(node.id),
+                       PRIORITY_ACTION, conn.ex_rebuild, node=node,
+                       image=fake_image, ex_files={
+                           "/root/.ssh/authorized_keys": public_key
+                       })
+            if journal:
+                journal.record("rebuild", name, SUBMITTED, node_id=node.id,
+                               details={'updated': updated})
+
+            try:
+                node = self._wait_for_rebuild_to_begin(conn, node, updated,
+                                                       progress)
+                return self._wait_for_node_to_become_active_host(
+                    conn, node, progress=progress)
+            except BuildError as e:
+                if replacements >= self.replace_failed:
+                    raise
+
+                # A rebuild target can't be replaced by a new server, but
+                # rebuilding it again usually gets it out of ERROR
+                replacements += 1
+                if progress:
+                    progress.write("\n{0}; rebuilding it again\n".format(e))
+                node = self._get_node_details(conn, node.id)
+
+    def rename_node(self, node_id, name):
+        """
+        Give a server a new name in the API (its hostname is left alone);
+        returns its Host
+        """
 
-        conn.ex_rebuild(node=node, image=fake_image, ex_files={
-            "/root/.ssh/authorized_keys":
-            public_key_file.read()
-        })
+        conn = self._get_conn()
+        node = Node(id=node_id, name=None, state=None, public_ips=[],
+                    private_ips=[], driver=conn)
+        node = self._call(conn, "PUT", "/servers/{0}".format(node_id),
+                          PRIORITY_ACTION, conn.ex_set_server_name, node,
+                          name)
+        return self._node_to_host(node)
+
+    def delete_nodes(self, servers, concurrency=10, progress=None):
+        """
+        Delete servers (as returned by list_servers) concurrently and wait
+        for all of them to disappear, polling with a single listing.
+        """
+
+        conn = self._get_conn()
 
-        # Wait for node to go into 'Rebuilding' state (takes a few seconds)
+        def delete(server):
+            node = Node(id=server['id'], name=server['name'], state=None,
+                        public_ips=[], private_ips=[], driver=conn)
+            self._destroy_node(conn, node)
+            if progress:
+                progress.write("Deleting node {0} ({1})\n".format(
+                    server['name'], server['id']))
+
+        results = run_windowed(delete, servers, window=concurrency)
+        failed = [result for result in results if result.error]
+        for result in failed:
+            if progress:
+                progress.write("Could not delete {0}: {1}\n".format(
+                    result.item['name'], result.error))
+
+        remaining = set(result.item['id'] for result in results
+                        if result.succeeded)
         if progress:
-            progress.write("Waiting for node to begin rebuilding")
+            progress.write("Waiting for nodes to be deleted")
 
-        while node.state != NodeState.PENDING:
+        deadline = self.clock() + self.build_timeout
+        while remaining:
+            if self.clock() > deadline:
+                raise BuildTimeout(None, "Timed out waiting for {0} nodes "
+                                   "to be deleted".format(len(remaining)))
             time.sleep(5)
 
             if progress:
                 progress.write(".")
-            node = conn.ex_get_node_details(node.id)
+            remaining = set(node.id for node in self._list_nodes(conn)
+                            if node.id in remaining and
+                            node.state != NodeState.TERMINATED)
 
         if progress:
             progress.write("\n")
 
-        return self._wait_for_node_to_become_active_host(conn,
-                                                         node,
-                                                         progress=progress)
+        return [result.item for result in failed]
@@ -0,0 +1,243 @@
+import difflib
+from fnmatch import fnmatchcase
+from glob import has_magic
+import os
+import re
+import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from journal import STATE_DIRECTORY, ensure_directory
+from parallel import run_windowed
+
+KINDS = ["images", "flavors", "networks"]
+
+# Value prefixes: a regular expression to search names with, and the
+# newest of the images matching what follows
+REGEX = "re:"
+LATEST = "latest:"
+
+
+class CatalogError(Exception):
+    pass
+
+
+class Catalog(object):
+
+    """
+    A region's images, flavors and networks, cached in the kitchen so
+    checking and resolving them doesn't cost API calls on every run
+    """
+
+    def __init__(self, rackspace_api, region, path=None, max_age=60 * 60,
+                 clock=time.time):
+        self.rackspace_api = rackspace_api
+        self.region = region
+        self.path = path or os.path.join(STATE_DIRECTORY,
+                                         "catalog-{0}.json".format(region))
+        # Seconds before the cached catalog is fetched again
+        self.max_age = max_age
+        self.clock = clock
+        self._catalog = None
+        self._fresh = False
+        # Per kind: entries by ID and by name
+        self._indexes = {}
+        # Resolved (kind, value) pairs, so specs with hundreds of nodes
+        # naming the same image resolve it once
+        self._resolved = {}
+
+    def _read(self):
+        try:
+            with open(self.path) as catalog_file:
+                catalog = json.loads(catalog_file.read())
+        except (IOError, ValueError):
+            return None
+
+        if self.clock() - catalog.get('fetched', 0) > self.max_age:
+            return None
+        return catalog
+
+    def refresh(self):
+        """
+        Fetch images, flavors and networks from the API, all at once
+        """
+
+        results = run_windowed(
+            lambda kind: getattr(self.rackspace_api, "list_" + kind)(),
+            KINDS, window=len(KINDS))
+        for result in results:
+            if result.error is not None:
+                raise result.error
+
+        catalog = dict((result.item, result.value) for result in results)
+        catalog['fetched'] = self.clock()
+
+        ensure_directory(self.path)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as catalog_file:
+            catalog_file.write(json.dumps(catalog))
+        os.rename(temp_path, self.path)
+
+        self._catalog = catalog
+        self._fresh = True
+        self._indexes = {}
+        self._resolved = {}
+
+    def load(self):
+        if self._catalog is None:
+            self._catalog = self._read()
+            if self._catalog is None:
+                self.refresh()
+        return self._catalog
+
+    def entries(self, kind):
+        return self.load()[kind]
+
+    def _index(self, kind):
+        if kind not in self._indexes:
+            by_id, by_name = {}, {}
+            for entry in self.entries(kind):
+                by_id[entry['id']] = entry
+                by_name.setdefault(entry['name'], []).append(entry)
+            self._indexes[kind] = (by_id, by_name)
+        return self._indexes[kind]
+
+    def _match(self, kind, value):
+        by_id, by_name = self._index(kind)
+        if value in by_id:
+            return [by_id[value]]
+        # Names may contain glob characters ('[PVHVM]') themselves
+        if value in by_name:
+            return by_name[value]
+
+        if value.startswith(REGEX):
+            try:
+                regex = re.compile(value[len(REGEX):])
+            except re.error as e:
+                raise CatalogError("Bad regular expression '{0}': {1}"
+                                   .format(value[len(REGEX):], e))
+            return [entry for entry in self.entries(kind)
+                    if regex.search(entry['name'])]
+        if has_magic(value):
+            return [entry for entry in self.entries(kind)
+                    if fnmatchcase(entry['name'], value)]
+        return []
+
+    def resolve(self, kind, value):
+        """
+        The catalog entry for an ID, exact name, glob pattern (such as
+        'Ubuntu 12.04*') or regular expression ('re:^Ubuntu').  Prefixed
+        with 'latest:', the newest image matching is chosen instead of
+        failing when more than one does.
+        """
+
+        key = (kind, value)
+        if key not in self._resolved:
+            self._resolved[key] = self._resolve(kind, value)
+        return self._resolved[key]
+
+    def _resolve(self, kind, value):
+        singular = kind[:-1]
+        latest = value.startswith(LATEST)
+        if latest:
+            if kind != "images":
+                raise CatalogError("Only images can be chosen by '{0}'"
+                                   .format(LATEST))
+            value = value[len(LATEST):]
+
+        matches = self._match(kind, value)
+        if not matches and not self._fresh:
+            # Maybe it's newer than our cache
+            self.refresh()
+            matches = self._match(kind, value)
+
+        if latest and matches:
+            # ISO 8601 timestamps sort chronologically
+            matches = [max(matches, key=lambda m: m.get('created') or '')]
+
+        pattern = value.startswith(REGEX) or has_magic(value)
+        if len(matches) > 1 and pattern:
+            names = ", ".join("{0} ({1})".format(m['name'], m['id'])
+                              for m in matches)
+            message = "More than one {0} matches '{1}': {2}".format(
+                singular, value, names)
+            if kind == "images":
+                message += " (use '{0}{1}' for the newest)".format(LATEST,
+                                                                   value)
+            raise CatalogError(message)
+        if len(matches) > 1:
+            raise CatalogError("More than one {0} is named '{1}': {2}"
+                               .format(singular, value,
+                                       ", ".join(m['id'] for m in matches)))
+        if not matches and pattern:
+            raise CatalogError("No {0} matches '{1}'".format(singular, value))
+        if not matches:
+            message = "Unknown {0} '{1}'".format(singular, value)
+            close = difflib.get_close_matches(
+                value, [entry['name'] for entry in self.entries(kind)], 3)
+            if close:
+                message += " (did you mean {0}?)".format(
+                    ", ".join("'{0}'".format(name) for name in close))
+            raise CatalogError(message)
+
+        return matches[0]
+
+
+def preflight(catalog, image, flavor=None, networks=None, count=1):
+    """
+    Check image, flavor and networks (see Catalog.resolve) against the
+    catalog, and the account's quota for `count` new servers, fetching the
+    catalog and limits concurrently.  Returns the resolved IDs; raises a
+    CatalogError listing every problem found.
+    """
+
+    checks = {'catalog': catalog.load}
+    if flavor is not None:
+        checks['headroom'] = catalog.rackspace_api.headroom
+
+    fetched = {}
+    for result in run_windowed(lambda check: checks[check](), list(checks),
+                               window=len(checks)):
+        if result.error is not None:
+            raise result.error
+        fetched[result.item] = result.value
+
+    resolved = {'image': image, 'flavor': flavor, 'networks': networks}
+    problems = []
+
+    def resolve(kind, value):
+        try:
+            return catalog.resolve(kind, value)
+        except CatalogError as e:
+            problems.append(str(e))
+
+    image_entry = resolve("images", image)
+    resolved['image'] = image_entry and image_entry['id']
+
+    if flavor is not None:
+        flavor_entry = resolve("flavors", flavor)
+        resolved['flavor'] = flavor_entry and flavor_entry['id']
+
+        headroom = fetched['headroom']
+        if headroom.get('instances') is not None and \
+                headroom['instances'] < count:
+            problems.append("Only {0} more servers fit in the account's "
+                            "quota".format(headroom['instances']))
+        ram = flavor_entry and flavor_entry.get('ram')
+        if ram and headroom.get('ram') is not None and \
+                headroom['ram'] < ram * count:
+            problems.append("Only {0} MB of RAM left in the account's quota "
+                            "({1} MB needed)".format(headroom['ram'],
+                                                     ram * count))
+
+    if networks is not None:
+        network_entries = [resolve("networks", network)
+                           for network in networks]
+        resolved['networks'] = [entry and entry['id']
+                                for entry in network_entries]
+
+    if problems:
+        raise CatalogError("; ".join(problems))
+
+    return resolved
@@ -0,0 +1,50 @@
+"""
+Thin client for `fix-rackspace serve`.  Only imports the standard library
+so a request costs milliseconds instead of interpreter and API startup.
+"""
+import os
+import socket
+import sys
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# Kept in step with daemon.SOCKET_PATH without importing the daemon
+SOCKET_PATH = os.path.join(".littlechef-rackspace", "serve.sock")
+
+
+def request(args, socket_path=SOCKET_PATH, stream=sys.stderr):
+    """
+    Run a fix-rackspace command line through the daemon, copying its
+    output to stream.  Returns the command's exit code.
+    """
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    try:
+        client.sendall(json.dumps({'args': list(args)}) + "\n")
+        for line in client.makefile():
+            message = json.loads(line)
+            if 'output' in message:
+                stream.write(message['output'])
+                continue
+
+            if message.get('error'):
+                stream.write("Fatal error: {0}\n".format(message['error']))
+            return message['exit']
+    finally:
+        client.close()
+
+    stream.write("Fatal error: the daemon closed the connection\n")
+    return 1
+
+
+def main(args, socket_path=SOCKET_PATH):
+    try:
+        return request(args, socket_path)
+    except socket.error as e:
+        sys.stderr.write("Could not reach 'fix-rackspace serve' at {0} "
+                         "({1}); start it in this kitchen first\n"
+                         .format(socket_path, e))
+        return 1
@@ -1,17 +1,49 @@
+import copy
+from fnmatch import fnmatch
+from glob import has_magic
+import re
+from StringIO import StringIO
+import os
 import sys
+import time
 try:
     import simplejson as json
 except ImportError:
     import json
+from fabric.contrib.console import confirm
+from fabric.utils import abort
+from littlechef import runner as lc
+from catalog import CatalogError, preflight
+from daemon import Daemon, AlreadyServing
+from deploy import bootstrap_config_path
+from journal import REQUESTED, SUBMITTED, ACTIVE, DEPLOYING, DONE, FAILED
+from lib import Host
+from logs import LogStore, read_lines
+from nodes import NodeStore, content_hash
+from parallel import run_windowed, PrefixedProgress
+from pool import LOG_PATH, Pool
+from servers import FIELDS, InvalidQuery, ServerIndex
+from timings import BUILD, REBUILD, DEPLOY, format_duration
+from userdata import (BUNDLE_PATH, BUNDLE_URL_LIFETIME, USER_DATA,
+                      bootstrap_script, build_bundle, file_sha256, temp_url)
+from verify import Verifier
 
 
 class Command(object):
 
     requires_api = False
     requires_deploy = False
+    requires_runner = False
 
-    def __init__(self, rackspace_api=None, chef_deployer=None):
+    def __init__(self, rackspace_api=None, chef_deployer=None,
+                 journal=None, timings=None, node_store=None, catalog=None):
         self.rackspace_api = rackspace_api
+        self.chef_deploy = chef_deployer
+        self.journal = journal
+        self.timings = timings
+        self.node_store = node_store or NodeStore()
+        # Images, flavors and networks to check arguments against
+        self.catalog = catalog
 
     def execute(self, **kwargs):
         pass
@@ -19,6 +51,99 @@ class Command(object):
     def validate_args(self, **kwargs):
         return True
 
+    def _find_servers(self, patterns):
+        """
+        Servers whose names match any of the (comma separated) names or
+        glob patterns, from a single listing
+        """
+
+        if not isinstance(patterns, list):
+            patterns = patterns.split(',')
+
+        return [server for server in self.rackspace_api.list_servers()
+                if any(fnmatch(server['name'], pattern)
+                       for pattern in patterns)]
+
+    def _preflight(self, image, flavor=None, networks=None):
+        """
+        Check arguments against the catalog before anything is built,
+        returning them with names resolved to IDs
+        """
+
+        if not self.catalog:
+            return {'image': image, 'flavor': flavor, 'networks': networks}
+
+        try:
+            return preflight(self.catalog, image, flavor=flavor,
+                             networks=networks)
+        except CatalogError as e:
+            abort(str(e))
+
+    def _record(self, operation, name, phase, **kwargs):
+        if self.journal:
+            self.journal.record(operation, name, phase, **kwargs)
+
+    def _timing_keys(self, kwargs, flavor=None, image=None):
+        return {'region': kwargs.get('region'),
+                'flavor': flavor,
+                'image': image,
+                'template': kwargs.get('template')}
+
+    def _record_timing(self, phase, started, timing_keys):
+        if self.timings and timing_keys is not None:
+            self.timings.record(phase, time.time() - started, **timing_keys)
+
+    def _estimate(self, phases, timing_keys, progress, count=1,
+                  concurrency=1):
+        if self.timings:
+            self.timings.describe(
+                self.timings.estimate(phases, count=count,
+                                      concurrency=concurrency or 1,
+                                      **timing_keys), progress)
+
+    def _deploy(self, operation, name, host, environment=None,
+                timing_keys=None, **kwargs):
+        """
+        Bootstrap Chef on a freshly built host, journaling its progress
+        """
+
+        self._record(operation, name, ACTIVE)
+        if environment:
+            host.environment = environment
+
+        self._record(operation, name, DEPLOYING)
+        started = time.time()
+        self.chef_deploy.deploy(host=host, **kwargs)
+        self._record_timing(DEPLOY, started, timing_keys)
+        self._record(operation, name, DONE,
+                     details={'network': host.network,
+                              'address': host.bootstrap_address,
+                              'log': host.log_path})
+
+        return host
+
+    def _report(self, operation, results, progress):
+        """
+        Summarize a run over many servers, aborting if any of them failed
+        """
+
+        failed = [r for r in results if r.error is not None]
+        skipped = [r for r in results if r.skipped]
+
+        for result in failed:
+            progress.write("FAILED {0}: {1}\n".format(result.item['name'],
+                                                      result.error))
+        for result in skipped:
+            progress.write("SKIPPED {0}\n".format(result.item['name']))
+
+        progress.write("Completed {0} of {1} servers\n".format(
+            len(results) - len(failed) - len(skipped), len(results)))
+
+        if failed or skipped:
+            abort("{0} {1}s failed, {2} skipped".format(len(failed),
+                                                        operation,
+                                                        len(skipped)))
+
 
 class RackspaceCreate(Command):
 
@@ -27,13 +152,22 @@ class RackspaceCreate(Command):
     requires_api = True
     requires_deploy = True
 
-    def __init__(self, rackspace_api, chef_deployer):
-        super(RackspaceCreate, self).__init__(rackspace_api)
-        self.chef_deploy = chef_deployer
+    def __init__(self, rackspace_api, chef_deployer, journal=None,
+                 timings=None, catalog=None, node_store=None,
+                 pool_store=None):
+        super(RackspaceCreate, self).__init__(rackspace_api, chef_deployer,
+                                              journal, timings,
+                                              node_store=node_store,
+                                              catalog=catalog)
+        self.pool = Pool(rackspace_api, chef_deployer, pool_store)
 
     def execute(self, name, flavor, image, public_key_file,
-                environment=None, networks=None,
+                environment=None, networks=None, hedge_after=None,
                 progress=sys.stderr, **kwargs):
+        resolved = self._preflight(image, flavor, networks)
+        image, flavor = resolved['image'], resolved['flavor']
+        networks = resolved['networks']
+
         create_args = {
             'name': name,
             'flavor': flavor,
@@ -45,18 +179,156 @@ class RackspaceCreate(Command):
 
         progress.write("Creating node with arguments:\n{0}\n"
                        .format(json.dumps(create_args, indent=4)))
+        timing_keys = self._timing_keys(kwargs, flavor=flavor, image=image)
+        self_bootstrap = kwargs.get('bootstrap_mode') == USER_DATA
         if kwargs.get('dry_run', False):
+            self._estimate([BUILD] if self_bootstrap else [BUILD, DEPLOY],
+                           timing_keys, progress)
             return
 
-        host = self.rackspace_api.create_node(name=name, flavor=flavor,
-                                              image=image,
-                                              public_key_file=public_key_file,
-                                              networks=networks,
-                                              progress=sys.stderr)
+        if self.journal and self.journal.is_unfinished(name):
+            abort("An earlier operation on {0} did not finish; run "
+                  "'fix-rackspace resume' to pick it up".format(name))
+
+        if kwargs.get('from_pool'):
+            host = self._claim(name, flavor, image, public_key_file,
+                               networks, progress, create_args, **kwargs)
+            if host is not None:
+                try:
+                    self._record("create", name, SUBMITTED,
+                                 node_id=host.node_id)
+                    # Its build and Chef install were done ahead of time
+                    return self._deploy("create", name, host,
+                                        environment=environment,
+                                        **dict(kwargs, use_opscode_chef=False,
+                                               set_hostname=True))
+                except (Exception, SystemExit):
+                    self._record("create", name, FAILED)
+                    raise
+
+        hedge_seconds = self._hedge_seconds(hedge_after, timing_keys,
+                                            progress)
+
+        create_kwargs = {}
+        if self_bootstrap:
+            create_kwargs['user_data'] = self._user_data(name, environment,
+                                                         **kwargs)
+
+        self._record("create", name, REQUESTED, args=create_args)
+        try:
+            started = time.time()
+            host = self.rackspace_api.create_node(
+                name=name, flavor=flavor, image=image,
+                public_key_file=public_key_file, networks=networks,
+                progress=progress, journal=self.journal,
+                hedge_after=hedge_seconds, **create_kwargs)
+            self._record_timing(BUILD, started, timing_keys)
+
+            if self_bootstrap:
+                # The server runs Chef itself from here on
+                self._record("create", name, ACTIVE)
+                self._record("create", name, DONE,
+                             details={'bootstrap': USER_DATA,
+                                      'address': host.ip_address})
+                progress.write("{0} is bootstrapping itself from {1}\n"
+                               .format(name, kwargs['bundle_url']))
+                return host
+
+            return self._deploy("create", name, host,
+                                environment=environment,
+                                timing_keys=timing_keys, **kwargs)
+        except (Exception, SystemExit):
+            # fabric's abort() raises SystemExit.  An interrupted run
+            # (KeyboardInterrupt) is left unfinished, for resume.
+            self._record("create", name, FAILED)
+            raise
+
+    def _hedge_seconds(self, hedge_after, timing_keys, progress):
+        """
+        Turn --hedge-after (seconds, or a percentile of past build times
+        such as 'p90') into seconds
+        """
+
+        if not hedge_after:
+            return None
+
+        hedge_after = str(hedge_after)
+        if not hedge_after.startswith('p'):
+            return float(hedge_after)
+
+        seconds = None
+        if self.timings:
+            seconds = self.timings.percentile(BUILD,
+                                              float(hedge_after[1:]),
+                                              **timing_keys)
+        if seconds is None:
+            progress.write("Not enough build history for --hedge-after {0}, "
+                           "not hedging\n".format(hedge_after))
+        return seconds
+
+    def _claim(self, name, flavor, image, public_key_file, networks,
+               progress, create_args, pool_size=None, concurrency=None,
+               **kwargs):
+        """
+        A server from the pool, renamed to name (None if the pool is
+        empty), refilling the pool in the background
+        """
+
+        public_key = public_key_file.read()
+        public_key_file.seek(0)
+        host = self.pool.claim(name, flavor, image, public_key,
+                               networks=networks, progress=progress,
+                               journal=self.journal, args=create_args)
+        if host is None:
+            progress.write("The pool for {0} is empty; building a server\n"
+                           .format(self.pool.key(flavor, image, networks,
+                                                 public_key)))
+
+        if pool_size:
+            try:
+                self.pool.fill_in_background(int(pool_size), flavor, image,
+                                             networks=networks,
+                                             concurrency=concurrency or 1,
+                                             options=kwargs)
+                progress.write("Refilling the pool in the background (see "
+                               "{0})\n".format(LOG_PATH))
+            except OSError as e:
+                # The server is claimed; don't fail its create over this
+                progress.write("WARNING: Could not refill the pool: {0}\n"
+                               .format(e))
+
+        return host
+
+    def _user_data(self, name, environment, runlist=None, bundle_url=None,
+                   bundle_url_key=None, callback_url=None,
+                   use_opscode_chef=True, **kwargs):
+        """
+        Save the node's data and return the script it bootstraps itself
+        with
+        """
+
+        if not os.path.exists(BUNDLE_PATH):
+            abort("No kitchen bundle at {0}; run 'fix-rackspace "
+                  "bundle-kitchen' and upload it to --bundle-url"
+                  .format(BUNDLE_PATH))
+
+        node = self.node_store.get(name)
         if environment:
-            host.environment = environment
+            node['chef_environment'] = environment
+        if runlist:
+            node['run_list'] = runlist
+        self.node_store.save(node)
 
-        self.chef_deploy.deploy(host=host, **kwargs)
+        if bundle_url_key:
+            bundle_url = temp_url(bundle_url, bundle_url_key,
+                                  time.time() + BUNDLE_URL_LIFETIME)
+
+        # node_work_path and cookbook paths come from littlechef.cfg
+        lc._readconfig()
+        return bootstrap_script(node, bundle_url, file_sha256(BUNDLE_PATH),
+                                callback_url=callback_url,
+                                install_chef=use_opscode_chef,
+                                node_work_path=lc.env.node_work_path)
 
     def validate_args(self, **kwargs):
         required_args = ["name", "flavor", "image"]
@@ -65,9 +337,105 @@ class RackspaceCreate(Command):
                 print("Missing argument {0}".format(arg))
                 return False
 
+        if kwargs.get('bootstrap_mode') == USER_DATA:
+            if not kwargs.get('bundle_url'):
+                print("--bootstrap-mode user-data needs --bundle-url")
+                return False
+            if (kwargs.get('plugins') or kwargs.get('post_plugins') or
+                    kwargs.get('post-plugins')):
+                print("Plugins run over SSH, so can't be used with "
+                      "--bootstrap-mode user-data")
+                return False
+            if kwargs.get('from_pool'):
+                print("Pooled servers are deployed over SSH, so --from-pool "
+                      "can't be used with --bootstrap-mode user-data")
+                return False
+
+        hedge_after = str(kwargs.get('hedge_after') or '')
+        match = re.match(r'^(p?)(\d+(\.\d+)?)$', hedge_after)
+        if hedge_after and (not match or
+                            match.group(1) and float(match.group(2)) > 100):
+            print("--hedge-after must be seconds or a percentile like p90")
+            return False
+
+        return True
+
+
+class RackspacePool(Command):
+
+    name = "pool"
+    description = ("Build idle servers ahead of time for create "
+                   "--from-pool, or show the pools")
+    requires_api = True
+    requires_deploy = True
+
+    def __init__(self, pool_store=None, **kwargs):
+        super(RackspacePool, self).__init__(**kwargs)
+        self.pool = Pool(self.rackspace_api, self.chef_deploy, pool_store)
+
+    def execute(self, flavor=None, image=None, public_key_file=None,
+                pool_size=None, networks=None, concurrency=None,
+                progress=sys.stderr, **kwargs):
+        if pool_size is None:
+            counts = self.pool.store.counts()
+            for key in sorted(counts):
+                progress.write("{0}: {1[ready]} ready, {1[building]} "
+                               "building\n".format(key, counts[key]))
+            if not counts:
+                progress.write("No pooled servers\n")
+            return counts
+
+        resolved = self._preflight(image, flavor, networks)
+        image, flavor = resolved['image'], resolved['flavor']
+        public_key = public_key_file.read()
+        key = self.pool.key(flavor, image, resolved['networks'], public_key)
+
+        results = self.pool.fill(int(pool_size), flavor, image, public_key,
+                                 networks=resolved['networks'],
+                                 concurrency=concurrency or 1,
+                                 progress=progress)
+
+        failed = [result for result in results if result.error is not None]
+        for result in failed:
+            progress.write("FAILED {0}: {1}\n".format(result.item,
+                                                      result.error))
+        progress.write("Built {0} servers; {1} has {2[ready]} ready\n".format(
+            len(results) - len(failed), key,
+            self.pool.store.counts().get(key, {'ready': 0})))
+
+        if failed:
+            abort("{0} pooled servers failed".format(len(failed)))
+
+        return results
+
+    def validate_args(self, **kwargs):
+        if kwargs.get('pool_size') is None:
+            return True
+
+        for arg in ["flavor", "image"]:
+            if not kwargs.get(arg):
+                print("Missing argument {0}".format(arg))
+                return False
+
         return True
 
 
+class RackspaceBundleKitchen(Command):
+
+    name = "bundle-kitchen"
+    description = ("Pack the kitchen for servers created with "
+                   "--bootstrap-mode user-data")
+
+    def execute(self, progress=sys.stderr, **kwargs):
+        # Cookbook paths (and the data bag secret) come from littlechef.cfg
+        lc._readconfig()
+        sha256 = build_bundle()
+        progress.write("Wrote {0} ({1} bytes, sha256 {2}); upload it to "
+                       "--bundle-url\n".format(BUNDLE_PATH,
+                                               os.path.getsize(BUNDLE_PATH),
+                                               sha256))
+
+
 class RackspaceListImages(Command):
 
     name = "list-images"
@@ -132,17 +500,615 @@ class RackspaceRebuild(Command):
     requires_api = True
     requires_deploy = True
 
-    def __init__(self, rackspace_api, chef_deployer):
-        super(RackspaceRebuild, self).__init__(rackspace_api)
-        self.chef_deploy = chef_deployer
+    def __init__(self, rackspace_api, chef_deployer, journal=None,
+                 timings=None, catalog=None):
+        super(RackspaceRebuild, self).__init__(rackspace_api, chef_deployer,
+                                               journal, timings,
+                                               catalog=catalog)
 
     def execute(self, name, image, public_key_file, environment=None,
-                hostname=None, progress=sys.stderr, **kwargs):
+                hostname=None, concurrency=1, max_failures=None,
+                progress=sys.stderr, **kwargs):
+        image = self._preflight(image)['image']
+
+        names = name if isinstance(name, list) else name.split(',')
+        if len(names) > 1 or has_magic(names[0]):
+            return self._rebuild_many(names, image, public_key_file,
+                                      environment, concurrency,
+                                      max_failures, progress, **kwargs)
+
+        timing_keys = self._timing_keys(kwargs, image=image)
+        if kwargs.get('dry_run', False):
+            progress.write("Rebuilding {0} with image {1}\n"
+                           .format(name, image))
+            self._estimate([REBUILD, DEPLOY], timing_keys, progress)
+            return
+
+        self._record("rebuild", name, REQUESTED,
+                     args=dict(kwargs, image=image, environment=environment))
+        started = time.time()
         host = self.rackspace_api.rebuild_node(name=name,
                                                image=image,
                                                public_key_file=public_key_file,
-                                               progress=progress)
+                                               progress=progress,
+                                               journal=self.journal)
+        self._record_timing(REBUILD, started, timing_keys)
+
+        return self._deploy("rebuild", name, host, environment=environment,
+                            timing_keys=timing_keys, **kwargs)
+
+    def _rebuild_many(self, patterns, image, public_key_file, environment,
+                      concurrency, max_failures, progress, **kwargs):
+        """
+        Rolling rebuild of every server matching one of `patterns`, with at
+        most `concurrency` servers rebuilding/converging at once.
+        """
+
+        servers = self._find_servers(patterns)
+        if not servers:
+            abort("No servers match {0}".format(', '.join(patterns)))
+
+        timing_keys = self._timing_keys(kwargs, image=image)
+        if kwargs.get('dry_run', False):
+            progress.write("Rebuilding {0} with image {1}\n".format(
+                ", ".join(server['name'] for server in servers), image))
+            self._estimate([REBUILD, DEPLOY], timing_keys, progress,
+                           count=len(servers), concurrency=concurrency)
+            return
+
+        public_key = public_key_file.read()
+
+        def rebuild(server):
+            server_progress = PrefixedProgress(progress, server['name'])
+            self._record("rebuild", server['name'], REQUESTED,
+                         node_id=server['id'],
+                         args=dict(kwargs, image=image,
+                                   environment=environment))
+            started = time.time()
+            host = self.rackspace_api.rebuild_node(
+                name=server['name'],
+                node_id=server['id'],
+                image=image,
+                public_key_file=StringIO(public_key),
+                progress=server_progress,
+                journal=self.journal)
+            self._record_timing(REBUILD, started, timing_keys)
+
+            return self._deploy("rebuild", server['name'], host,
+                                environment=environment,
+                                timing_keys=timing_keys, **kwargs)
+
+        progress.write("Rebuilding {0} servers, {1} at a time\n"
+                       .format(len(servers), concurrency or 1))
+        results = run_windowed(rebuild, servers, window=concurrency,
+                               max_failures=max_failures)
+
+        self._report("rebuild", results, progress)
+        return results
+
+
+class RackspaceResume(Command):
+
+    name = "resume"
+    description = "Resume creates/rebuilds left unfinished by an earlier run"
+    requires_api = True
+    requires_deploy = True
+
+    def __init__(self, rackspace_api, chef_deployer, journal=None,
+                 timings=None, catalog=None):
+        super(RackspaceResume, self).__init__(rackspace_api, chef_deployer,
+                                              journal, timings,
+                                              catalog=catalog)
+
+    def execute(self, public_key_file, concurrency=1, max_failures=None,
+                abandon=False, progress=sys.stderr, **kwargs):
+        unfinished = self.journal.unfinished()
+        if not unfinished:
+            progress.write("Nothing to resume\n")
+            return
+
+        if abandon:
+            for node in unfinished:
+                self._record(node['operation'], node['name'], FAILED)
+                progress.write("Abandoned {0} {1} ({2})\n".format(
+                    node['operation'], node['name'], node['phase']))
+            return
+
+        public_key = public_key_file.read()
+        existing = {}
+        if [node for node in unfinished if not node.get('node_id')]:
+            for server in self.rackspace_api.list_servers():
+                existing[server['name']] = server['id']
+
+        def resume(node):
+            node_progress = PrefixedProgress(progress, node['name'])
+            node_progress.write("Resuming {0} from phase '{1}'\n".format(
+                node['operation'], node['phase']))
+
+            args = dict(node.get('args', {}))
+            image = args.pop('image', None)
+            flavor = args.pop('flavor', None)
+            networks = args.pop('networks', None)
+            self_bootstrap = args.pop('bootstrap_mode', None) == USER_DATA
+            node_id = node.get('node_id')
+
+            if node['operation'] == 'create' and not node_id:
+                node_id = existing.get(node['name'])
+
+            if self_bootstrap and node['operation'] == 'create':
+                return self._resume_self_bootstrap(node['name'], node_id,
+                                                   node_progress)
+
+            if node['operation'] == 'create' and not node_id:
+                # The create request never reached the API
+                host = self.rackspace_api.create_node(
+                    name=node['name'], flavor=flavor, image=image,
+                    public_key_file=StringIO(public_key), networks=networks,
+                    progress=node_progress, journal=self.journal)
+            elif node.get('from_pool'):
+                # Claimed from the pool, maybe not yet renamed; renaming
+                # twice is harmless.  Chef was installed when it was pooled.
+                host = self.rackspace_api.rename_node(node_id, node['name'])
+                args.update(use_opscode_chef=False, set_hostname=True)
+            elif node['operation'] == 'rebuild' and \
+                    node['phase'] == REQUESTED:
+                # We can't tell whether the rebuild was accepted, and
+                # rebuilding twice is harmless
+                host = self.rackspace_api.rebuild_node(
+                    name=node['name'], node_id=node_id, image=image,
+                    public_key_file=StringIO(public_key),
+                    progress=node_progress, journal=self.journal)
+            elif node['operation'] == 'rebuild' and \
+                    node['phase'] == SUBMITTED and node.get('updated'):
+                # The node may still be active from before the rebuild
+                host = self.rackspace_api.wait_for_rebuild(
+                    node_id, node['updated'], progress=node_progress)
+            else:
+                host = self.rackspace_api.wait_for_node(
+                    node_id, progress=node_progress)
+
+            return self._deploy(node['operation'], node['name'], host,
+                                **args)
+
+        progress.write("Resuming {0} unfinished operations\n"
+                       .format(len(unfinished)))
+        results = run_windowed(resume, unfinished, window=concurrency,
+                               max_failures=max_failures)
+
+        self._report("resume", results, progress)
+        return results
+
+    def _resume_self_bootstrap(self, name, node_id, progress):
+        """
+        A --bootstrap-mode user-data create runs Chef itself once active,
+        so there's nothing to deploy; without its user data (which isn't
+        journaled) one that never reached the API can't be resubmitted
+        """
+
+        if not node_id:
+            self._record("create", name, FAILED)
+            raise Exception("{0} was never created; run create again"
+                            .format(name))
+
+        host = self.rackspace_api.wait_for_node(node_id, progress=progress)
+        self._record("create", name, ACTIVE)
+        self._record("create", name, DONE,
+                     details={'bootstrap': USER_DATA,
+                              'address': host.ip_address})
+        return host
+
+
+class RackspaceDelete(Command):
+
+    name = "delete"
+    description = "Delete Cloud Servers and their littlechef node files"
+    requires_api = True
+
+    def execute(self, name, concurrency=None, yes=False,
+                progress=sys.stderr, **kwargs):
+        servers = self._find_servers(name)
+        if not servers:
+            abort("No servers match {0}".format(name))
+
+        for server in servers:
+            progress.write('{0}{1}{2}\n'.format(server['id'].ljust(41),
+                                                server['name'].ljust(20),
+                                                server['public_ipv4']))
+
+        if not yes and not confirm("Delete these {0} servers?"
+                                   .format(len(servers)), default=False):
+            abort("Not deleting anything")
+
+        failed = self.rackspace_api.delete_nodes(
+            servers, concurrency=concurrency or 10, progress=progress)
+
+        failed_ids = [server['id'] for server in failed]
+        with self.node_store.batch():
+            for server in servers:
+                if server['id'] not in failed_ids:
+                    self._remove_node_files(server['name'], progress)
+
+        if failed:
+            abort("Failed to delete {0} servers".format(len(failed)))
+
+    def _remove_node_files(self, name, progress):
+        node_path = self.node_store.node_path(name)
+        if os.path.isfile(node_path):
+            self.node_store.remove(name)
+            progress.write("Removed {0}\n".format(node_path))
+
+        config_path = bootstrap_config_path(name)
+        if os.path.isfile(config_path):
+            os.remove(config_path)
+            progress.write("Removed {0}\n".format(config_path))
+
+    def validate_args(self, **kwargs):
+        if not kwargs.get("name"):
+            print("Missing argument name")
+            return False
+
+        return True
+
+
+class RackspaceConverge(Command):
+
+    name = "converge"
+    description = "Run Chef again on existing servers"
+    requires_api = True
+    requires_deploy = True
+
+    def execute(self, name=None, environment=None, concurrency=1,
+                max_failures=None, progress=sys.stderr, **kwargs):
+        if name:
+            servers = self._find_servers(name)
+        else:
+            servers = self.rackspace_api.list_servers()
         if environment:
-            host.environment = environment
+            in_environment = set(self.node_store.find(
+                environment=environment))
+            servers = [server for server in servers
+                       if server['name'] in in_environment]
+        if not servers:
+            abort("No servers match {0}".format(", ".join(
+                "{0} {1}".format(key, value) for key, value
+                in [("name", name), ("environment", environment)]
+                if value)))
 
-        self.chef_deploy.deploy(host=host, **kwargs)
+        # Only servers littlechef knows about can be converged
+        missing = [server for server in servers
+                   if not os.path.isfile(
+                       self.node_store.node_path(server['name']))]
+        for server in missing:
+            progress.write("Skipping {0}: no node file\n".format(
+                server['name']))
+        servers = [server for server in servers if server not in missing]
+        if not servers:
+            abort("None of the matching servers have node files")
+
+        if kwargs.get('dry_run', False):
+            progress.write("Converging {0}\n".format(
+                ", ".join(server['name'] for server in servers)))
+            return
+
+        def converge(server):
+            host = Host(name=server['name'], ip_address=server['public_ipv4'])
+            self.chef_deploy.converge(host)
+            return host
+
+        progress.write("Converging {0} servers, {1} at a time\n"
+                       .format(len(servers), concurrency or 1))
+        results = run_windowed(converge, servers, window=concurrency,
+                               max_failures=max_failures)
+
+        self._report("converge", results, progress)
+        return results
+
+    def validate_args(self, **kwargs):
+        if not kwargs.get("name") and not kwargs.get("environment"):
+            print("Missing argument name or environment")
+            return False
+
+        return True
+
+
+class RackspaceInventorySync(Command):
+
+    name = "inventory-sync"
+    description = ("Create or update node files for every server, with "
+                   "addresses and metadata")
+    requires_api = True
+    requires_runner = True
+
+    def __init__(self, runner=None, **kwargs):
+        super(RackspaceInventorySync, self).__init__(**kwargs)
+        self.runner = runner
+
+    def execute(self, regions=None, progress=sys.stderr, **kwargs):
+        if regions and not isinstance(regions, list):
+            regions = regions.split(',')
+        if regions:
+            apis = [self.runner.get_api(region) for region in regions]
+        else:
+            apis = [self.rackspace_api]
+
+        results = run_windowed(lambda api: api.list_server_details(), apis,
+                               window=len(apis))
+        failed = [result for result in results if result.error is not None]
+        if failed:
+            abort("Could not list servers in {0}: {1}".format(
+                ", ".join(result.item.region for result in failed),
+                "; ".join(str(result.error) for result in failed)))
+
+        servers = {}
+        results.sort(key=lambda result: apis.index(result.item))
+        for result in results:
+            for server in result.value:
+                if os.sep in server['name']:
+                    progress.write("Skipping {0}: not a valid node name\n"
+                                   .format(server['name']))
+                elif server['name'] in servers:
+                    progress.write("Skipping {0} in {1}: already synced "
+                                   "from {2}\n".format(
+                                       server['name'], server['region'],
+                                       servers[server['name']]['region']))
+                else:
+                    servers[server['name']] = server
+
+        existing = dict((node['name'], node)
+                        for node in self.node_store.get_nodes())
+        created = updated = unchanged = 0
+        with self.node_store.batch():
+            for name, server in sorted(servers.items()):
+                node = existing.get(name)
+                data = self._node_data(name, node, server)
+                if node is None:
+                    created += 1
+                elif content_hash(data) == content_hash(node):
+                    unchanged += 1
+                    continue
+                else:
+                    updated += 1
+                if not kwargs.get('dry_run', False):
+                    self.node_store.save(data)
+
+        progress.write("Synced {0} servers from {1}: {2} new, {3} updated, "
+                       "{4} unchanged\n".format(
+                           len(servers),
+                           ", ".join(api.region for api in apis),
+                           created, updated, unchanged))
+
+        orphans = sorted(name for name in existing if name not in servers)
+        if orphans:
+            progress.write("{0} node files have no server: {1}\n".format(
+                len(orphans), ", ".join(orphans)))
+
+    def _node_data(self, name, node, server):
+        """
+        The node's data with the server's details under 'rackspace'; the
+        run list and environment of existing nodes are left alone
+        """
+
+        if node is None:
+            data = {'name': name, 'chef_environment': '_default',
+                    'run_list': []}
+        else:
+            data = copy.deepcopy(node)
+
+        data['rackspace'] = dict((key, server[key]) for key in [
+            'id', 'region', 'status', 'public_ipv4', 'public_ips',
+            'private_ips', 'image', 'flavor', 'metadata'])
+        return data
+
+
+class RackspaceQueryServers(Command):
+
+    name = "query-servers"
+    description = ("Find servers in the local index of every region, "
+                   "without asking the API")
+    requires_runner = True
+
+    # Older than this, queries suggest refreshing
+    STALE_AFTER = 60 * 60
+
+    def __init__(self, runner=None, server_index=None, **kwargs):
+        super(RackspaceQueryServers, self).__init__(**kwargs)
+        self.runner = runner
+        self.server_index = server_index or ServerIndex(
+            node_store=self.node_store)
+
+    def execute(self, where=None, sort=None, refresh=False, region=None,
+                regions=None, progress=sys.stderr, **kwargs):
+        if refresh:
+            if regions and not isinstance(regions, list):
+                regions = regions.split(',')
+            self._refresh(regions or [region], progress)
+
+        ages = self.server_index.ages()
+        if not ages:
+            abort("No servers indexed yet; run query-servers --refresh")
+
+        if sort and not isinstance(sort, list):
+            sort = sort.split(',')
+        try:
+            servers = self.server_index.query(self._parse_where(where), sort)
+        except InvalidQuery as e:
+            abort(str(e))
+
+        progress.write("Indexed {0}\n".format(", ".join(
+            "{0} {1} ago".format(indexed_region, format_duration(age))
+            for indexed_region, age in sorted(ages.items()))))
+        if max(ages.values()) > self.STALE_AFTER:
+            progress.write("Some regions are more than {0} old; run with "
+                           "--refresh to update them\n".format(
+                               format_duration(self.STALE_AFTER)))
+
+        rows = [[server[field] or '' for field in FIELDS]
+                for server in servers]
+        widths = [max([len(field)] + [len(row[i]) for row in rows])
+                  for i, field in enumerate(FIELDS)]
+        for row in [FIELDS] + rows:
+            progress.write("  ".join(value.ljust(width) for value, width
+                                     in zip(row, widths)).rstrip() + "\n")
+        progress.write("{0} servers\n".format(len(servers)))
+
+        return servers
+
+    def _refresh(self, regions, progress):
+        apis = [self.runner.get_api(region) for region in regions]
+        results = run_windowed(self.server_index.refresh, apis,
+                               window=len(apis))
+        failed = [result for result in results if result.error is not None]
+        for result in results:
+            if result.error is not None:
+                progress.write("Could not refresh {0}: {1}\n".format(
+                    result.item.region, result.error))
+            else:
+                progress.write("Refreshed {0}: {1} servers changed\n"
+                               .format(result.item.region, result.value))
+
+        if failed:
+            # Don't answer from an index the caller asked to bring up to
+            # date when part of it wasn't
+            abort("Could not refresh {0}".format(", ".join(
+                result.item.region for result in failed)))
+
+    def _parse_where(self, where):
+        """
+        {field: pattern} from field=pattern strings (or a dict, from
+        rackspace.yaml)
+        """
+
+        if isinstance(where, dict):
+            return where
+
+        if where and not isinstance(where, list):
+            where = [where]
+        parsed = {}
+        for condition in where or []:
+            field, equals, pattern = condition.partition("=")
+            if not equals:
+                abort("Expected field=pattern, not '{0}'".format(condition))
+            parsed[field.strip()] = pattern.strip()
+        return parsed
+
+
+class RackspaceVerify(Command):
+
+    name = "verify"
+    description = ("Check servers converged: last Chef run, health commands "
+                   "and ports")
+    requires_api = True
+
+    def __init__(self, verifier_class=Verifier, **kwargs):
+        super(RackspaceVerify, self).__init__(**kwargs)
+        self.verifier_class = verifier_class
+
+    def execute(self, name, private_key="~/.ssh/id_rsa", checks=None,
+                check_ports=None, concurrency=None, progress=sys.stderr,
+                **kwargs):
+        servers = self._find_servers(name)
+        if not servers:
+            abort("No servers match {0}".format(name))
+
+        if check_ports and not isinstance(check_ports, list):
+            check_ports = check_ports.split(',')
+        verifier = self.verifier_class(private_key, commands=checks,
+                                       ports=check_ports)
+        results = verifier.verify_servers(servers,
+                                          concurrency=concurrency or 10)
+        # In the order servers were listed
+        results.sort(key=lambda result: servers.index(result.item))
+
+        check_names = verifier.check_names()
+        columns = ([max(len(server['name']) for server in servers)] +
+                   [len(check) for check in check_names])
+
+        def write_row(cells):
+            progress.write("  ".join(cell.ljust(max(column, 4)) for cell,
+                                     column in zip(cells, columns)).rstrip())
+            progress.write("\n")
+
+        write_row([''] + check_names)
+        failures = []
+        for result in results:
+            server_name = result.item['name']
+            if result.error is not None:
+                cells = ["FAIL"] * len(check_names)
+                failures.append((server_name, result.error))
+            else:
+                cells = ["ok" if check.passed else "FAIL"
+                         for check in result.value]
+                failures.extend(("{0} {1}".format(server_name, check.name),
+                                 check.detail)
+                                for check in result.value if not check.passed)
+            write_row([server_name] + cells)
+
+        for what, detail in failures:
+            progress.write("FAILED {0}: {1}\n".format(what, detail))
+
+        failed = len([result for result in results
+                      if result.error is not None or
+                      not all(check.passed for check in result.value)])
+        progress.write("{0} of {1} servers passed\n".format(
+            len(results) - failed, len(results)))
+        if failed:
+            abort("{0} servers failed verification".format(failed))
+
+        return results
+
+    def validate_args(self, **kwargs):
+        if not kwargs.get("name"):
+            print("Missing argument name")
+            return False
+
+        return True
+
+
+class RackspaceLogs(Command):
+
+    name = "logs"
+    description = "Show a node's captured deploy output, or list a run's logs"
+
+    def __init__(self, log_store=None, **kwargs):
+        super(RackspaceLogs, self).__init__(**kwargs)
+        self.log_store = log_store or LogStore()
+
+    def execute(self, name=None, run=None, progress=sys.stderr, **kwargs):
+        if name:
+            entry = self.log_store.find(name, run)
+            if not entry:
+                abort("No captured deploy output for {0}".format(name))
+
+            for line in read_lines(entry['path']):
+                progress.write(line + "\n")
+            return
+
+        entries = self.log_store.entries()
+        run = run or (entries and entries[-1]['run'])
+        for entry in entries:
+            if entry['run'] == run:
+                progress.write('{0}{1}{2}\n'.format(entry['name'].ljust(30),
+                                                    entry['status'].ljust(8),
+                                                    entry['path']))
+
+
+class RackspaceServe(Command):
+
+    name = "serve"
+    description = ("Keep running, serving commands to fix-rackspace-client "
+                   "over a Unix socket")
+    requires_runner = True
+
+    def __init__(self, runner=None, **kwargs):
+        super(RackspaceServe, self).__init__(**kwargs)
+        self.runner = runner
+
+    def execute(self, concurrency=None, progress=sys.stderr, **kwargs):
+        daemon = Daemon(self.runner.__class__, self.runner.config)
+        try:
+            daemon.bind(threads=concurrency or 8)
+        except AlreadyServing as e:
+            abort("Already serving on {0}".format(e))
+
+        progress.write("Serving on {0}\n".format(daemon.socket_path))
+        daemon.serve_forever()
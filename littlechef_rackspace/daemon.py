@@ -0,0 +1,186 @@
+import copy
+import os
+import Queue
+import socket
+import SocketServer
+import threading
+import traceback
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from journal import STATE_DIRECTORY, ensure_directory
+
+SOCKET_PATH = os.path.join(STATE_DIRECTORY, "serve.sock")
+
+# Commands a client may run through the daemon; anything that prompts
+# for confirmation has no terminal to prompt on
+SERVED_COMMANDS = ["create", "rebuild", "resume", "list-images",
+                   "list-flavors", "list-networks", "list-servers",
+                   "inventory-sync", "query-servers", "pool"]
+
+
+class ClientStream(object):
+
+    """
+    Progress stream that forwards writes to a connected client
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        with self._lock:
+            self.wfile.write(json.dumps(message) + "\n")
+            self.wfile.flush()
+
+    def write(self, data):
+        try:
+            self.send({'output': data})
+        except socket.error:
+            # The client went away; keep the operation going regardless
+            pass
+
+    def flush(self):
+        pass
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        stream = ClientStream(self.wfile)
+        try:
+            request = json.loads(self.rfile.readline())
+            code, error = self.server.daemon.run(request['args'], stream)
+        except ValueError:
+            code, error = 2, "Malformed request"
+
+        try:
+            stream.send({'exit': code, 'error': error})
+        except socket.error:
+            pass
+
+
+class PooledUnixServer(SocketServer.UnixStreamServer):
+
+    """
+    Unix socket server answering requests on a fixed pool of threads, so
+    each thread's authenticated API driver is reused between requests
+    """
+
+    def __init__(self, path, daemon, threads=8):
+        SocketServer.UnixStreamServer.__init__(self, path, RequestHandler)
+        self.daemon = daemon
+        self.requests = Queue.Queue()
+        for _ in range(threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+
+class Daemon(object):
+
+    """
+    Runs commands for clients over a Unix socket, keeping the kitchen
+    configuration and authenticated Rackspace APIs (with their rate
+    limiters) between requests.
+    """
+
+    def __init__(self, runner_class, config, socket_path=None):
+        self.runner_class = runner_class
+        self.config = config
+        self.socket_path = socket_path or SOCKET_PATH
+        self._shared = {}
+        self._lock = threading.Lock()
+        self.server = None
+
+    def shared(self, factory, **kwargs):
+        """
+        factory(**kwargs), created once and shared between requests
+        """
+
+        key = (factory, tuple(sorted(kwargs.items())))
+        with self._lock:
+            if key not in self._shared:
+                self._shared[key] = factory(**kwargs)
+            return self._shared[key]
+
+    def api(self, factory, **api_kwargs):
+        """
+        The RackspaceApi for an account and build policy, created once
+        """
+
+        return self.shared(factory, **api_kwargs)
+
+    def run(self, args, stream):
+        """
+        Run a command line for a client, returning its exit code and any
+        error message
+        """
+
+        if not args or args[0] not in SERVED_COMMANDS:
+            return 2, "The daemon runs these commands: {0}".format(
+                ", ".join(SERVED_COMMANDS))
+
+        runner = self.runner_class(options=copy.deepcopy(self.config),
+                                   daemon=self)
+        try:
+            runner.main(args, progress=stream)
+        except SystemExit as e:
+            # fabric's abort()
+            return 1, getattr(e, 'message', None) or str(e.code)
+        except Exception as e:
+            # The details go to the daemon's own log
+            traceback.print_exc()
+            return 1, "{0}: {1}".format(e.__class__.__name__, e)
+
+        return 0, None
+
+    def _serving_or_remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return False
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.socket_path)
+            return True
+        except socket.error:
+            os.remove(self.socket_path)
+            return False
+        finally:
+            client.close()
+
+    def bind(self, threads=8):
+        ensure_directory(self.socket_path)
+
+        if self._serving_or_remove_stale_socket():
+            raise AlreadyServing(self.socket_path)
+
+        self.server = PooledUnixServer(self.socket_path, self, threads)
+        os.chmod(self.socket_path, 0600)
+
+    def serve_forever(self):
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+class AlreadyServing(Exception):
+    pass
@@ -1,4 +1,10 @@
-from fabric.operations import os
+import copy
+import socket
+import threading
+import time
+from fabric.operations import os, sudo
+from fabric.state import connections
+from fabric.utils import abort
 try:
     import simplejson as json
 except ImportError:
@@ -6,48 +12,282 @@ except ImportError:
     assert json
 from littlechef import runner as lc
 import littlechef
+from journal import DONE, FAILED
+from metrics import Metrics
+from nodes import NodeStore
+from parallel import (call_in_subprocess, fork_safe_lock, run_windowed,
+                      SubprocessFailed)
+
+# Plugin modules by name, imported once per process
+_plugins = {}
+
+# The NodeStore of the deploy running on each thread, for get_nodes
+_deploying = threading.local()
+_install_lock = fork_safe_lock()
+
+
+# --bootstrap-network policies
+PUBLIC = "public"
+SERVICENET = "servicenet"
+AUTO = "auto"
+BOOTSTRAP_NETWORKS = [PUBLIC, SERVICENET, AUTO]
+
+
+def bootstrap_config_path(host_string):
+    return os.path.join(".", ".bootstrap-config_{0}".format(host_string))
+
+
+def reachable(address, port=22, timeout=3):
+    """
+    Whether sshd is accepting connections on address.  A refused
+    connection doesn't count: a firewall or router may be answering for
+    an address we can't actually bootstrap over.
+    """
+
+    try:
+        socket.create_connection((address, port), timeout).close()
+        return True
+    except socket.error:
+        return False
+
+
+def _use_node_index():
+    """
+    Have littlechef.lib.get_nodes (which littlechef calls to build its node
+    data bag on every run, reading every node file) answer from the index
+    of the NodeStore deploying on the calling thread.  It is replaced once
+    per process, so concurrent deploys never swap it under each other.
+    """
+
+    with _install_lock:
+        get_nodes = littlechef.lib.get_nodes
+        if getattr(get_nodes, 'indexed', None) is True:
+            return
+
+        def indexed_get_nodes(environment=None):
+            node_store = getattr(_deploying, 'node_store', None)
+            if node_store is None:
+                return get_nodes(environment)
+            return node_store.get_nodes(environment)
+
+        indexed_get_nodes.indexed = True
+        littlechef.lib.get_nodes = indexed_get_nodes
 
 
 class ChefDeployer(object):
 
-    def __init__(self, key_filename):
+    def __init__(self, key_filename, isolate=False, node_store=None,
+                 bootstrap_network=PUBLIC, probe=reachable, log_store=None,
+                 metrics=None, ssh_timeout=5 * 60):
         self.key_filename = key_filename
+        # Deploy in a child process (needed when deploying concurrently,
+        # since fabric's env is process global)
+        self.isolate = isolate
+        # Where isolated deploys' output goes instead of the terminal
+        self.log_store = log_store
+        self.metrics = metrics or Metrics()
+        # Seconds to wait for sshd before handing over to fabric
+        self.ssh_timeout = ssh_timeout
+        self.node_store = node_store or NodeStore()
+        _use_node_index()
+        self.bootstrap_network = bootstrap_network
+        self.probe = probe
+
+    def deploy(self, host, **kwargs):
+        # Choose the address here so the caller's host records it
+        self._choose_address(host)
+        self._wait_for_ssh(host)
+
+        with self.metrics.phase("deploy"):
+            return self._run_isolated(self._deploy, host, **kwargs)
+
+    def converge(self, host):
+        """
+        Run Chef again on a server that was already deployed, with its node
+        file as it is
+        """
+
+        self._choose_address(host)
+
+        with self.metrics.phase("converge"):
+            return self._run_isolated(self._converge, host)
+
+    def prepare(self, host):
+        """
+        Install Chef on a server without running it, for a pooled server
+        that gets its node data and run list once it is claimed
+        """
+
+        self._choose_address(host)
+
+        with self.metrics.phase("prepare"):
+            return self._run_isolated(self._prepare, host)
+
+    def _wait_for_ssh(self, host):
+        """
+        Wait for sshd on the bootstrap address, recording how long it took
+        to come up.  Every deploy waits, metrics or not; if sshd is still
+        down after ssh_timeout, fabric's own connection retries take over.
+        """
+
+        started = time.time()
+        while not reachable(host.bootstrap_address):
+            if time.time() - started > self.ssh_timeout:
+                self.metrics.increment("failures_total", phase="ssh_ready")
+                return
+            time.sleep(2)
+
+        self.metrics.observe("ssh_ready_seconds", time.time() - started)
+
+    def _run_isolated(self, func, host, **kwargs):
+        if not self.isolate:
+            return func(host, **kwargs)
+        if not self.log_store:
+            return call_in_subprocess(func, host, **kwargs)
+
+        name = host.get_host_string()
+        host.log_path = self.log_store.path(name)
+        try:
+            result = call_in_subprocess(self._logged, func, host, **kwargs)
+        except SubprocessFailed as e:
+            self.log_store.record(name, host.log_path, FAILED)
+            raise SubprocessFailed("{0}\nLast lines of {1}:\n{2}".format(
+                e, host.log_path, "\n".join(self.log_store.tail(
+                    host.log_path))))
 
-    def deploy(self, host, runlist=None, plugins=None, post_plugins=None,
-               use_opscode_chef=True, **kwargs):
+        self.log_store.record(name, host.log_path, DONE)
+        return result
+
+    def _logged(self, func, host, **kwargs):
+        with self.log_store.capture(host.log_path):
+            return func(host, **kwargs)
+
+    def _deploy(self, host, runlist=None, plugins=None, post_plugins=None,
+                use_opscode_chef=True, set_hostname=False, **kwargs):
         runlist = runlist or []
         plugins = plugins or []
         post_plugins = post_plugins or []
 
         self._setup_ssh_config(host)
+        if set_hostname:
+            self._set_hostname(host)
         if use_opscode_chef:
             lc.deploy_chef(ask="no")
 
-        self._save_node_data(host, runlist)
-        for plugin in plugins:
-            self._execute_plugin(host, plugin)
+        node = self._save_node_data(host, runlist)
+        self._execute_plugins(plugins, node)
+
+        node = self._bootstrap_node(host)
 
+        if post_plugins:
+            self._execute_plugins(post_plugins, node)
+
+    def _converge(self, host):
+        self._setup_ssh_config(host)
         self._bootstrap_node(host)
 
-        for plugin in post_plugins:
-            self._execute_plugin(host, plugin)
+    def _prepare(self, host):
+        self._setup_ssh_config(host)
+        lc.deploy_chef(ask="no")
+
+    def _set_hostname(self, host):
+        """
+        A claimed pool server booted with its pool name; give it its own
+        """
+
+        sudo("old=$(hostname) && "
+             "sed -i \"s/\\b$old\\b/{0}/g\" /etc/hosts && "
+             "echo {0} > /etc/hostname && hostname {0}".format(
+                 host.get_host_string()))
+
+    def _choose_address(self, host):
+        """
+        Pick the address to bootstrap over: the first reachable private
+        (ServiceNet) address unless the policy is 'public', falling back
+        to the public address for 'auto'
+        """
+
+        if self.bootstrap_network != PUBLIC:
+            for address in host.private_addresses:
+                if self.probe(address):
+                    host.bootstrap_address = address
+                    host.network = SERVICENET
+                    return
+
+            if self.bootstrap_network == SERVICENET:
+                abort("None of {0}'s ServiceNet addresses ({1}) are "
+                      "reachable".format(host.get_host_string(),
+                                         ", ".join(host.private_addresses)
+                                         or "none"))
+
+        host.bootstrap_address = host.ip_address
+        host.network = PUBLIC
 
     def _save_node_data(self, host, runlist):
         """
         Save the runlist and environment into the node data
         """
 
-        data = littlechef.lib.get_node(host.get_host_string())
+        data = self.node_store.get(host.get_host_string())
         if host.environment:
             data['chef_environment'] = host.environment
         if runlist:
             data['run_list'] = runlist
 
-        littlechef.chef.save_config(data, force=True)
+        self.node_store.save(data)
+        return data
 
-    def _execute_plugin(self, host, plugin_name):
-        node = littlechef.lib.get_node(host.get_host_string())
-        plugin = littlechef.lib.import_plugin(plugin_name)
+    def _execute_plugins(self, plugin_names, node):
+        """
+        Run plugins in order against the node data.  Consecutive plugins
+        that declare `independent = True` run concurrently, each in a
+        process of its own (fabric's env is process global) with its own
+        copy of the node data.
+        """
+
+        batch = []
+        for plugin_name in plugin_names:
+            plugin = self._import_plugin(plugin_name)
+            if getattr(plugin, 'independent', False) is True:
+                batch.append((plugin_name, plugin))
+                continue
+
+            self._execute_concurrently(batch, node)
+            batch = []
+            self._execute_plugin(plugin_name, plugin, node)
+
+        self._execute_concurrently(batch, node)
+
+    def _execute_concurrently(self, batch, node):
+        if len(batch) < 2:
+            for plugin_name, plugin in batch:
+                self._execute_plugin(plugin_name, plugin, node)
+            return
+
+        def execute(item):
+            call_in_subprocess(self._execute_plugin_in_child, *item)
+
+        items = [(plugin_name, plugin, copy.deepcopy(node))
+                 for plugin_name, plugin in batch]
+        results = run_windowed(execute, items, window=len(items))
+
+        for result in results:
+            if result.error is not None:
+                raise result.error
+
+    def _import_plugin(self, plugin_name):
+        if plugin_name not in _plugins:
+            _plugins[plugin_name] = littlechef.lib.import_plugin(plugin_name)
+
+        return _plugins[plugin_name]
+
+    def _execute_plugin_in_child(self, plugin_name, plugin, node):
+        # The parent's cached connections are no use here: their transport
+        # threads didn't survive the fork
+        connections.clear()
+        self._execute_plugin(plugin_name, plugin, node)
+
+    def _execute_plugin(self, plugin_name, plugin, node):
         littlechef.lib.print_header("Executing plugin '{0}' on "
                                     "{1}".format(plugin_name,
                                                  lc.env.host_string))
@@ -64,8 +304,7 @@ class ChefDeployer(object):
         # (for example, encrypted data bag secret)
         littlechef.runner._readconfig()
 
-        bootstrap_config_file = os.path.join(".", ".bootstrap-config_{0}"
-                                             .format(host.get_host_string()))
+        bootstrap_config_file = bootstrap_config_path(host.get_host_string())
         contents = ("User root\n"
                     "IdentityFile {key_filename}\n"
                     "StrictHostKeyChecking no\n"
@@ -73,7 +312,7 @@ class ChefDeployer(object):
                     "HostName {ip_address}\n").format(
             key_filename=self.key_filename,
             host_string=host.get_host_string(),
-            ip_address=host.ip_address)
+            ip_address=host.bootstrap_address or host.ip_address)
 
         self._create_bootstrap_ssh_config(bootstrap_config_file, contents)
 
@@ -90,7 +329,19 @@ class ChefDeployer(object):
         lc.env.connection_attempts = 10
 
     def _bootstrap_node(self, host):
-        lc.node(host.get_host_string())
+        """
+        Run Chef on the host; returns its node data as the run left it
+        """
+
+        _deploying.node_store = self.node_store
+        try:
+            lc.node(host.get_host_string())
+        finally:
+            _deploying.node_store = None
+
+        # The chef run rewrote the node file: read it once more, which
+        # also brings the node index up to date with it
+        return self.node_store.get(host.get_host_string())
 
     def _create_bootstrap_ssh_config(self, bootstrap_config_file, contents):
         """
@@ -0,0 +1,144 @@
+import errno
+import os
+import sqlite3
+import threading
+import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from parallel import fork_safe_lock
+
+STATE_DIRECTORY = ".littlechef-rackspace"
+
+# Phases a node goes through; 'done' and 'failed' are final
+REQUESTED = "requested"
+SUBMITTED = "submitted"
+ACTIVE = "active"
+DEPLOYING = "deploying"
+DONE = "done"
+FAILED = "failed"
+
+FINAL_PHASES = [DONE, FAILED]
+
+# Only these arguments are kept for resuming a deploy (never secrets)
+RESUMABLE_ARGS = ["image", "flavor", "networks", "environment", "runlist",
+                  "plugins", "post_plugins", "use_opscode_chef",
+                  "bootstrap_mode"]
+
+
+# State databases whose schema this process has already created
+_created_schemas = set()
+_schema_lock = fork_safe_lock()
+
+
+def ensure_directory(path):
+    """
+    Create the directory path is in, if it doesn't exist yet
+    """
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            # Created by another thread or process meanwhile
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def connect_state_db(path, create_schema, **kwargs):
+    """
+    A new connection to the SQLite database at path (connections can't be
+    shared between the threads of a concurrent run).  create_schema(db) is
+    called the first time this process connects to it.  Other keyword
+    arguments go to sqlite3.connect.
+    """
+
+    ensure_directory(path)
+    db = sqlite3.connect(path, timeout=30, **kwargs)
+    key = os.path.abspath(path)
+    with _schema_lock:
+        if key not in _created_schemas or not os.path.getsize(path):
+            create_schema(db)
+            _created_schemas.add(key)
+    return db
+
+
+class Journal(object):
+
+    """
+    Append-only log of create/rebuild/deploy progress, one JSON entry per
+    line, kept in the kitchen so an interrupted run can be resumed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(STATE_DIRECTORY, "journal")
+        self._lock = threading.Lock()
+
+    def record(self, operation, name, phase, node_id=None, args=None,
+               details=None):
+        entry = {
+            'time': time.time(),
+            'operation': operation,
+            'name': name,
+            'phase': phase,
+        }
+        if node_id:
+            entry['node_id'] = node_id
+        if args is not None:
+            entry['args'] = dict((key, args[key]) for key in RESUMABLE_ARGS
+                                 if args.get(key) is not None)
+        if details:
+            entry.update((key, value) for key, value in details.items()
+                         if value is not None)
+
+        with self._lock:
+            ensure_directory(self.path)
+
+            journal_file = open(self.path, "a")
+            try:
+                journal_file.write(json.dumps(entry) + "\n")
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            finally:
+                journal_file.close()
+
+    def entries(self):
+        if not os.path.isfile(self.path):
+            return []
+
+        entries = []
+        for line in open(self.path):
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # A partial line from a process killed mid-write
+                continue
+
+        return entries
+
+    def latest(self):
+        """
+        The most recent state of every node, merging node ids and args
+        recorded by earlier entries
+        """
+
+        nodes = {}
+        for entry in self.entries():
+            node = nodes.get(entry['name'], {})
+            if node.get('phase') in FINAL_PHASES:
+                node = {}
+            node.update(entry)
+            nodes[entry['name']] = node
+
+        return nodes
+
+    def unfinished(self):
+        return sorted([node for node in self.latest().values()
+                       if node['phase'] not in FINAL_PHASES],
+                      key=lambda node: node['time'])
+
+    def is_unfinished(self, name):
+        node = self.latest().get(name)
+        return node is not None and node['phase'] not in FINAL_PHASES
@@ -6,10 +6,18 @@ class Host(object):
     """
 
     def __init__(self, name=None, host_string=None, ip_address=None,
-                 environment=None):
+                 environment=None, private_addresses=None, node_id=None):
         self.name = name
+        self.node_id = node_id
         self.ip_address = ip_address
         self.environment = environment
+        # ServiceNet (and isolated network) IPv4 addresses
+        self.private_addresses = private_addresses or []
+        # Where the deploy connected to, and over which network
+        self.bootstrap_address = None
+        self.network = None
+        # Captured deploy output, if any
+        self.log_path = None
 
     def get_host_string(self):
         if self.name:
@@ -0,0 +1,224 @@
+import collections
+import gzip
+import os
+import shutil
+import sys
+import threading
+import time
+import zlib
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from journal import STATE_DIRECTORY, ensure_directory
+
+LOG_DIRECTORY = os.path.join(STATE_DIRECTORY, "logs")
+
+
+def new_run_id():
+    # Sorts by start time, and stays unique between concurrent runs
+    now = time.time()
+    return "{0}.{1:06d}-{2}".format(
+        time.strftime("%Y%m%dT%H%M%S", time.localtime(now)),
+        int(now % 1 * 1000000), os.getpid())
+
+
+def read_lines(path):
+    """
+    The lines of a gzipped log, as many as can be read (a process killed
+    mid-deploy leaves it truncated)
+    """
+
+    try:
+        log_file = gzip.open(path)
+        try:
+            for line in log_file:
+                yield line.rstrip("\n")
+        finally:
+            log_file.close()
+    except (IOError, EOFError, zlib.error):
+        return
+
+
+def tail(path, lines=20):
+    return list(collections.deque(read_lines(path), maxlen=lines))
+
+
+class NodeLog(object):
+
+    """
+    Captures everything written to stdout and stderr, by this process and
+    the commands it runs, into a gzip file as it is written.  Past
+    max_bytes only the last tail_lines lines are kept, and written at the
+    end.  The redirection is process wide, so this is for a process of its
+    own (see call_in_subprocess).
+    """
+
+    def __init__(self, path, max_bytes, tail_lines):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.omitted = 0
+        self._tail = collections.deque(maxlen=tail_lines)
+        self._partial = ""
+        self._file = None
+        self._saved = None
+        self._streams = None
+        self._reader = None
+
+    def write(self, data):
+        if self.written < self.max_bytes:
+            kept = data[:self.max_bytes - self.written]
+            self._file.write(kept)
+            self.written += len(kept)
+            data = data[len(kept):]
+
+        if data:
+            self.omitted += len(data)
+            lines = (self._partial + data).split("\n")
+            self._partial = lines.pop()
+            self._tail.extend(lines)
+
+    def _read(self, fd):
+        while True:
+            data = os.read(fd, 64 * 1024)
+            if not data:
+                break
+            self.write(data)
+        os.close(fd)
+
+    def __enter__(self):
+        ensure_directory(self.path)
+        self._file = gzip.open(self.path, "wb")
+
+        read_fd, write_fd = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self._saved = [os.dup(1), os.dup(2)]
+        os.dup2(write_fd, 1)
+        os.dup2(write_fd, 2)
+        # Python level writes too, whatever sys.stdout had been replaced
+        # with
+        self._streams = [sys.stdout, sys.stderr]
+        sys.stdout = sys.stderr = os.fdopen(write_fd, "w", 0)
+
+        self._reader = threading.Thread(target=self._read, args=(read_fd,))
+        self._reader.daemon = True
+        self._reader.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout, sys.stderr = self._streams
+        for fd, saved in zip([1, 2], self._saved):
+            os.dup2(saved, fd)
+            os.close(saved)
+
+        # Done once nothing holds the pipe open; don't wait forever on a
+        # command that left something running in the background
+        self._reader.join(30)
+        if self.omitted:
+            self._file.write("\n[{0} bytes omitted, last lines follow]\n"
+                             .format(self.omitted))
+            for line in self._tail:
+                self._file.write(line + "\n")
+            if self._partial:
+                self._file.write(self._partial + "\n")
+        self._file.close()
+
+
+class LogStore(object):
+
+    """
+    Deploy output, one gzipped log per node under
+    .littlechef-rackspace/logs/<run id>/, with an index (one JSON entry
+    per line) of which log belongs to which node and run.  Only the last
+    keep_runs runs are kept.
+    """
+
+    def __init__(self, directory=None, run_id=None, keep_runs=10,
+                 max_bytes=64 * 1024 * 1024, tail_lines=20):
+        self.directory = directory or LOG_DIRECTORY
+        self.run_id = run_id or new_run_id()
+        self.keep_runs = keep_runs
+        # Uncompressed bytes kept of each log
+        self.max_bytes = max_bytes
+        self.tail_lines = tail_lines
+        self.index_path = os.path.join(self.directory, "index")
+        self._lock = threading.Lock()
+        self._pruned = False
+
+    def path(self, name):
+        with self._lock:
+            if not self._pruned:
+                self._prune()
+                self._pruned = True
+
+        return os.path.join(self.directory, self.run_id, name + ".log.gz")
+
+    def capture(self, path):
+        return NodeLog(path, self.max_bytes, self.tail_lines)
+
+    def tail(self, path):
+        return tail(path, self.tail_lines)
+
+    def record(self, name, path, status):
+        entry = {
+            'time': time.time(),
+            'run': self.run_id,
+            'name': name,
+            'path': path,
+            'status': status,
+        }
+
+        with self._lock:
+            ensure_directory(self.index_path)
+            with open(self.index_path, "a") as index_file:
+                index_file.write(json.dumps(entry) + "\n")
+
+    def entries(self):
+        if not os.path.isfile(self.index_path):
+            return []
+
+        entries = []
+        for line in open(self.index_path):
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+
+        return entries
+
+    def find(self, name, run_id=None):
+        """
+        The latest index entry for a node, optionally in a given run
+        """
+
+        for entry in reversed(self.entries()):
+            if entry['name'] == name and run_id in (None, entry['run']):
+                return entry
+
+        return None
+
+    def _prune(self):
+        if not os.path.isdir(self.directory):
+            return
+
+        runs = sorted(run for run in os.listdir(self.directory)
+                      if os.path.isdir(os.path.join(self.directory, run)))
+        # Leave room for this run
+        stale = runs[:max(len(runs) - (self.keep_runs - 1), 0)]
+        if not stale:
+            return
+
+        for run in stale:
+            shutil.rmtree(os.path.join(self.directory, run),
+                          ignore_errors=True)
+
+        entries = [entry for entry in self.entries()
+                   if entry['run'] not in stale]
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w") as index_file:
+            for entry in entries:
+                index_file.write(json.dumps(entry) + "\n")
+        os.rename(temp_path, self.index_path)
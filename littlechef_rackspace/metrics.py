@@ -0,0 +1,267 @@
+from contextlib import contextmanager
+import os
+import socket
+import threading
+import time
+from journal import ensure_directory
+
+PREFIX = "littlechef_rackspace"
+
+# Histogram buckets, in seconds: API calls take well under one, builds and
+# deploys several minutes
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600,
+           1200, 1800, 3600]
+
+
+class Metrics(object):
+
+    """
+    Provisioning metrics: counters, histograms of durations and gauges of
+    what is in flight.  This one discards everything; see
+    PrometheusTextfile and StatsdMetrics.
+    """
+
+    enabled = False
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def gauge(self, name, delta, **labels):
+        pass
+
+    def flush(self):
+        pass
+
+    @contextmanager
+    def phase(self, phase, **labels):
+        """
+        Time a phase of an operation (histogram <phase>_seconds), counting
+        it in flight while it runs and as a failure if it raises
+        """
+
+        self.gauge("in_flight", 1, phase=phase, **labels)
+        started = time.time()
+        try:
+            yield
+        except BaseException:
+            self.increment("failures_total", phase=phase, **labels)
+            raise
+        else:
+            self.observe(phase + "_seconds", time.time() - started, **labels)
+        finally:
+            self.gauge("in_flight", -1, phase=phase, **labels)
+
+
+class MetricsGroup(Metrics):
+
+    """
+    Sends metrics to several exporters
+    """
+
+    enabled = True
+
+    def __init__(self, exporters):
+        self.exporters = exporters
+
+    def increment(self, name, value=1, **labels):
+        for exporter in self.exporters:
+            exporter.increment(name, value, **labels)
+
+    def observe(self, name, seconds, **labels):
+        for exporter in self.exporters:
+            exporter.observe(name, seconds, **labels)
+
+    def gauge(self, name, delta, **labels):
+        for exporter in self.exporters:
+            exporter.gauge(name, delta, **labels)
+
+    def flush(self):
+        for exporter in self.exporters:
+            exporter.flush()
+
+
+class StatsdMetrics(Metrics):
+
+    """
+    Sends metrics to a StatsD daemon over UDP.  StatsD has no labels, so
+    label values become part of the name: api_request_seconds.list_nodes
+    """
+
+    enabled = True
+
+    def __init__(self, host="127.0.0.1", port=8125, prefix=PREFIX):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, name, labels):
+        parts = [self.prefix, name]
+        parts.extend(str(labels[key]).replace(".", "_")
+                     for key in sorted(labels))
+        return ".".join(parts)
+
+    def _send(self, name, labels, value):
+        try:
+            self._socket.sendto("{0}:{1}".format(self._name(name, labels),
+                                                 value), self.address)
+        except socket.error:
+            # Metrics must never break provisioning
+            pass
+
+    def increment(self, name, value=1, **labels):
+        self._send(name, labels, "{0}|c".format(value))
+
+    def observe(self, name, seconds, **labels):
+        self._send(name, labels, "{0}|ms".format(int(seconds * 1000)))
+
+    def gauge(self, name, delta, **labels):
+        self._send(name, labels, "{0:+d}|g".format(delta))
+
+
+class PrometheusTextfile(Metrics):
+
+    """
+    Keeps metrics in memory and writes them out in the Prometheus text
+    format for node_exporter's textfile collector.  The file is replaced
+    atomically, at most once per `interval` seconds.
+    """
+
+    enabled = True
+
+    def __init__(self, path, interval=1, prefix=PREFIX, clock=time.time):
+        self.path = path
+        self.interval = interval
+        self.prefix = prefix
+        self.clock = clock
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        # Held while rendering and writing, so an older rendering never
+        # replaces a newer one
+        self._write_lock = threading.Lock()
+        self._written = None
+        self._timer = None
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def increment(self, name, value=1, **labels):
+        with self._lock:
+            key = self._key(name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._updated()
+
+    def observe(self, name, seconds, **labels):
+        with self._lock:
+            key = self._key(name, labels)
+            if key not in self._histograms:
+                self._histograms[key] = {'buckets': [0] * len(BUCKETS),
+                                         'sum': 0, 'count': 0}
+            histogram = self._histograms[key]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+        self._updated()
+
+    def gauge(self, name, delta, **labels):
+        with self._lock:
+            key = self._key(name, labels)
+            self._gauges[key] = self._gauges.get(key, 0) + delta
+        self._updated()
+
+    def _updated(self):
+        with self._lock:
+            wait = 0
+            if self._written is not None:
+                wait = self._written + self.interval - self.clock()
+            if wait > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(wait, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+
+        self.flush()
+
+    def _labels(self, labels, **extra):
+        labels = list(labels) + sorted(extra.items())
+        if not labels:
+            return ""
+        return "{" + ",".join('{0}="{1}"'.format(key, value)
+                              for key, value in labels) + "}"
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for kind, metrics in [("counter", self._counters),
+                                  ("gauge", self._gauges)]:
+                for name in sorted(set(key[0] for key in metrics)):
+                    full_name = "{0}_{1}".format(self.prefix, name)
+                    lines.append("# TYPE {0} {1}".format(full_name, kind))
+                    for key in sorted(metrics):
+                        if key[0] == name:
+                            lines.append("{0}{1} {2}".format(
+                                full_name, self._labels(key[1]),
+                                metrics[key]))
+
+            for name in sorted(set(key[0] for key in self._histograms)):
+                full_name = "{0}_{1}".format(self.prefix, name)
+                lines.append("# TYPE {0} histogram".format(full_name))
+                for key in sorted(self._histograms):
+                    if key[0] != name:
+                        continue
+                    histogram = self._histograms[key]
+                    for bound, count in zip(BUCKETS, histogram['buckets']):
+                        lines.append("{0}_bucket{1} {2}".format(
+                            full_name, self._labels(key[1], le=bound),
+                            count))
+                    lines.append("{0}_bucket{1} {2}".format(
+                        full_name, self._labels(key[1], le="+Inf"),
+                        histogram['count']))
+                    lines.append("{0}_sum{1} {2}".format(
+                        full_name, self._labels(key[1]), histogram['sum']))
+                    lines.append("{0}_count{1} {2}".format(
+                        full_name, self._labels(key[1]),
+                        histogram['count']))
+
+        return "".join(line + "\n" for line in lines)
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                self._written = self.clock()
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            contents = self.render()
+
+            ensure_directory(self.path)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as metrics_file:
+                metrics_file.write(contents)
+            os.rename(temp_path, self.path)
+
+
+def get_metrics(textfile=None, statsd=None):
+    """
+    Metrics for the --metrics-textfile and --statsd (host:port) options
+    """
+
+    exporters = []
+    if textfile:
+        exporters.append(PrometheusTextfile(textfile))
+    if statsd:
+        host, _, port = statsd.partition(":")
+        exporters.append(StatsdMetrics(host or "127.0.0.1", port or 8125))
+
+    if not exporters:
+        return Metrics()
+    if len(exporters) == 1:
+        return exporters[0]
+    return MetricsGroup(exporters)
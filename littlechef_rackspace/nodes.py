@@ -0,0 +1,296 @@
+from contextlib import contextmanager
+import copy
+import hashlib
+import os
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from fabric.utils import abort
+from journal import STATE_DIRECTORY, connect_state_db, ensure_directory
+
+
+def _roles(data):
+    return [item[len("role["):-1] for item in data.get('run_list', [])
+            if item.startswith("role[") and item.endswith("]")]
+
+
+def content_hash(data):
+    """
+    Hash of node data, the same whatever order its keys are in
+    """
+
+    return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+
+def _with_defaults(name, data):
+    # The same defaults littlechef.lib.get_node adds
+    data['name'] = name
+    if not data.get('chef_environment'):
+        data['chef_environment'] = '_default'
+    return data
+
+
+class NodeStore(object):
+
+    """
+    littlechef node files with a SQLite index of their names, environments
+    and roles, so finding and saving nodes doesn't scan the nodes/
+    directory.  Files changed outside of the store are picked up by
+    comparing their size and modification time with the index: by get()
+    for the file it reads, and by the first lookup of every node.  Each
+    command makes its own store, so that is once per command.
+    """
+
+    def __init__(self, directory="nodes", path=None):
+        self.directory = directory
+        self.path = path or os.path.join(STATE_DIRECTORY, "nodes.db")
+        # Changes held back by batch(): name -> node data, or None to remove
+        self._pending = None
+        self._refreshed = False
+
+    def _connect(self):
+        return connect_state_db(self.path, self._create_schema)
+
+    def _create_schema(self, db):
+        db.execute("CREATE TABLE IF NOT EXISTS nodes ("
+                   "name TEXT PRIMARY KEY, "
+                   "file TEXT NOT NULL, "
+                   "environment TEXT, "
+                   "mtime REAL NOT NULL, "
+                   "size INTEGER NOT NULL, "
+                   "data TEXT NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS roles ("
+                   "name TEXT NOT NULL, "
+                   "role TEXT NOT NULL)")
+        db.execute("CREATE INDEX IF NOT EXISTS nodes_environment "
+                   "ON nodes (environment)")
+        db.execute("CREATE INDEX IF NOT EXISTS roles_role ON roles (role)")
+        db.execute("CREATE INDEX IF NOT EXISTS roles_name ON roles (name)")
+
+    def node_path(self, name):
+        return os.path.join(self.directory, "{0}.json".format(name))
+
+    def _read(self, path):
+        try:
+            with open(path) as node_file:
+                return json.loads(node_file.read())
+        except ValueError as e:
+            abort('LittleChef found the following error in "{0}":\n'
+                  '                {1}'.format(path, e))
+
+    def _index(self, db, name, data, stat):
+        db.execute("DELETE FROM roles WHERE name = ?", (name,))
+        db.execute("INSERT OR REPLACE INTO nodes (name, file, environment, "
+                   "mtime, size, data) VALUES (?, ?, ?, ?, ?, ?)",
+                   (name, self.node_path(name),
+                    data.get('chef_environment') or '_default',
+                    stat.st_mtime, stat.st_size, json.dumps(data)))
+        db.executemany("INSERT INTO roles (name, role) VALUES (?, ?)",
+                       [(name, role) for role in _roles(data)])
+
+    def _unindex(self, db, name):
+        db.execute("DELETE FROM nodes WHERE name = ?", (name,))
+        db.execute("DELETE FROM roles WHERE name = ?", (name,))
+
+    def get(self, name):
+        """
+        Node data for `name`, like littlechef.lib.get_node, reading the
+        file only if it changed since it was indexed
+        """
+
+        if self._pending is not None and name in self._pending:
+            data = self._pending[name] or {'run_list': []}
+            return _with_defaults(name, copy.deepcopy(data))
+
+        path = self.node_path(name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return _with_defaults(name, {'run_list': []})
+
+        db = self._connect()
+        try:
+            row = db.execute("SELECT mtime, size, data FROM nodes "
+                             "WHERE name = ?", (name,)).fetchone()
+            if row and (row[0], row[1]) == (stat.st_mtime, stat.st_size):
+                data = json.loads(row[2])
+            else:
+                data = self._read(path)
+                self._index(db, name, data, stat)
+                db.commit()
+        finally:
+            db.close()
+
+        return _with_defaults(name, data)
+
+    def save(self, data):
+        if self._pending is not None:
+            self._pending[data['name']] = copy.deepcopy(data)
+        else:
+            self._write({data['name']: data})
+
+    def remove(self, name):
+        if self._pending is not None:
+            self._pending[name] = None
+        else:
+            self._write({name: None})
+
+    @contextmanager
+    def batch(self):
+        """
+        Hold back saves and removes until the block ends, then write them
+        all at once.  Nothing is written if the block raises.
+        """
+
+        if self._pending is not None:
+            yield
+            return
+
+        self._pending = {}
+        try:
+            yield
+            pending = self._pending
+        finally:
+            self._pending = None
+
+        self._write(pending)
+
+    def _write(self, changes):
+        if not changes:
+            return
+
+        # Write every file aside first so a failure leaves the kitchen
+        # untouched; littlechef ignores files starting with a dot
+        staged = []
+        try:
+            for name, data in sorted(changes.items()):
+                if data is None:
+                    continue
+                temp_path = os.path.join(self.directory,
+                                         ".{0}.json.tmp".format(name))
+                ensure_directory(temp_path)
+                with open(temp_path, "w") as node_file:
+                    node_file.write(json.dumps(data, indent=4,
+                                               sort_keys=True))
+                staged.append((name, data, temp_path))
+        except BaseException:
+            for _, _, temp_path in staged:
+                os.remove(temp_path)
+            raise
+
+        db = self._connect()
+        try:
+            for name, data, temp_path in staged:
+                os.rename(temp_path, self.node_path(name))
+                self._index(db, name, data, os.stat(self.node_path(name)))
+
+            for name, data in changes.items():
+                if data is None:
+                    if os.path.isfile(self.node_path(name)):
+                        os.remove(self.node_path(name))
+                    self._unindex(db, name)
+
+            db.commit()
+        finally:
+            db.close()
+
+    def refresh(self):
+        """
+        Bring the index up to date with the nodes/ directory, reading only
+        the files that were added or changed since the last refresh.  Each
+        file is checked, since editing one in place doesn't change the
+        directory's modification time.
+        """
+
+        self._refreshed = True
+        if not os.path.isdir(self.directory):
+            return
+
+        db = self._connect()
+        try:
+            indexed = dict((row[0], (row[1], row[2])) for row in db.execute(
+                "SELECT name, mtime, size FROM nodes"))
+
+            for filename in os.listdir(self.directory):
+                if filename.startswith('.') or not filename.endswith(".json"):
+                    continue
+
+                name = filename[:-len(".json")]
+                stat = os.stat(self.node_path(name))
+                if indexed.pop(name, None) != (stat.st_mtime, stat.st_size):
+                    self._index(db, name, self._read(self.node_path(name)),
+                                stat)
+
+            for name in indexed:
+                self._unindex(db, name)
+
+            db.commit()
+        finally:
+            db.close()
+
+    def _refresh_once(self):
+        if not self._refreshed:
+            self.refresh()
+
+    def find(self, environment=None, role=None):
+        """
+        Names of the nodes in an environment and/or with a role in their
+        run list
+        """
+
+        self._refresh_once()
+
+        query = "SELECT nodes.name FROM nodes"
+        params = []
+        conditions = []
+        if role:
+            query += " JOIN roles ON roles.name = nodes.name"
+            conditions.append("roles.role = ?")
+            params.append(role)
+        if environment:
+            conditions.append("nodes.environment = ?")
+            params.append(environment)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        db = self._connect()
+        try:
+            return [row[0] for row in db.execute(query + " ORDER BY "
+                                                 "nodes.name", params)]
+        finally:
+            db.close()
+
+    def environments(self):
+        """
+        The environment of every node, by name
+        """
+
+        self._refresh_once()
+
+        db = self._connect()
+        try:
+            return dict(db.execute("SELECT name, environment FROM nodes"))
+        finally:
+            db.close()
+
+    def get_nodes(self, environment=None):
+        """
+        Every node, like littlechef.lib.get_nodes, parsing only the files
+        that changed since they were last indexed
+        """
+
+        self._refresh_once()
+
+        query = "SELECT name, data FROM nodes"
+        params = []
+        if environment is not None:
+            query += " WHERE environment = ?"
+            params.append(environment)
+
+        db = self._connect()
+        try:
+            return [_with_defaults(row[0], json.loads(row[1]))
+                    for row in db.execute(query + " ORDER BY name", params)]
+        finally:
+            db.close()
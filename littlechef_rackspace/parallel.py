@@ -0,0 +1,170 @@
+import multiprocessing
+import Queue
+import threading
+import traceback
+
+
+# Locks call_in_subprocess holds while it forks (see fork_safe_lock)
+_fork_locks = []
+
+
+class SubprocessFailed(Exception):
+    pass
+
+
+def fork_safe_lock():
+    """
+    A module level threading.Lock that a forked child may need.  The child
+    of a threaded process (serve) would copy a lock held by another thread
+    as held for good, so call_in_subprocess takes every one of these before
+    it forks and releases them on both sides.
+    """
+
+    lock = threading.Lock()
+    _fork_locks.append(lock)
+    return lock
+
+
+def _release_fork_locks():
+    for lock in reversed(_fork_locks):
+        lock.release()
+
+
+class Result(object):
+
+    """
+    Outcome of running a function over one item of a windowed run
+    """
+
+    def __init__(self, item, value=None, error=None, skipped=False):
+        self.item = item
+        self.value = value
+        self.error = error
+        self.skipped = skipped
+
+    @property
+    def succeeded(self):
+        return not self.skipped and self.error is None
+
+    def __repr__(self):
+        return '<Result item={0}, error={1}, skipped={2}>'.format(
+            self.item, self.error, self.skipped)
+
+
+def run_windowed(func, items, window=1, max_failures=None):
+    """
+    Call func(item) for every item with at most `window` calls running at
+    once; the next item starts as soon as a running one finishes.  Once
+    `max_failures` calls have failed no new items are started, and the
+    remaining items are returned as skipped.
+
+    Returns a Result per item in completion order.
+    """
+
+    pending = list(items)
+    window = max(int(window or 1), 1)
+    finished = Queue.Queue()
+    results = []
+    failures = 0
+    running = 0
+
+    def worker(item):
+        try:
+            finished.put(Result(item, value=func(item)))
+        except BaseException as e:
+            # fabric's abort() raises SystemExit, which would otherwise end
+            # the thread without a result and leave us waiting forever
+            finished.put(Result(item, error=e))
+
+    while pending or running:
+        while pending and running < window:
+            thread = threading.Thread(target=worker, args=(pending.pop(0),))
+            thread.daemon = True
+            thread.start()
+            running += 1
+
+        # Poll with a timeout so Ctrl-C still reaches the main thread
+        try:
+            result = finished.get(True, 1)
+        except Queue.Empty:
+            continue
+
+        running -= 1
+        results.append(result)
+        if result.error is not None:
+            failures += 1
+
+        if max_failures and failures >= max_failures:
+            results.extend([Result(item, skipped=True) for item in pending])
+            pending = []
+
+    return results
+
+
+def call_in_subprocess(func, *args, **kwargs):
+    """
+    Call func in a forked child process and return its result.  Fabric
+    keeps its connection settings in a process global env, so concurrent
+    deploys each need a process of their own.
+    """
+
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+
+    def target():
+        # Taken by the thread that forked us, in our parent
+        _release_fork_locks()
+        try:
+            sender.send((True, func(*args, **kwargs)))
+        except BaseException as e:
+            # fabric's abort() raises SystemExit, which must not escape
+            # the child without telling the parent what happened
+            sender.send((False, "{0}\n{1}".format(
+                traceback.format_exc(), e)))
+
+    process = multiprocessing.Process(target=target)
+    for lock in _fork_locks:
+        lock.acquire()
+    try:
+        process.start()
+    finally:
+        _release_fork_locks()
+    sender.close()
+
+    try:
+        succeeded, value = receiver.recv()
+    except EOFError:
+        process.join()
+        raise SubprocessFailed("Process exited with code {0}"
+                               .format(process.exitcode))
+
+    process.join()
+    if not succeeded:
+        raise SubprocessFailed(value)
+
+    return value
+
+
+class PrefixedProgress(object):
+
+    """
+    Line buffered progress stream that tags every line with a prefix, so
+    output from concurrent operations stays readable.
+    """
+
+    _lock = fork_safe_lock()
+
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+        self.buffer = ""
+
+    def write(self, data):
+        self.buffer += data
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            with self._lock:
+                self.stream.write("[{0}] {1}\n".format(self.prefix, line))
+
+    def flush(self):
+        if self.buffer:
+            self.write("\n")
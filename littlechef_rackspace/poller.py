@@ -0,0 +1,157 @@
+import threading
+import time
+
+# Nova's changes-since takes an ISO 8601 time
+CHANGES_SINCE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def changes_since(listed, resynced, now, resync_after, overlap):
+    """
+    The changes-since time to bring a listing begun at `listed` up to
+    date, or None if everything should be listed again: the first time,
+    and every resync_after seconds in case a change was missed.  Changes
+    are asked for from `overlap` seconds before the last listing began, in
+    case our clock is ahead of the API's.
+    """
+
+    if listed is None or now - resynced >= resync_after:
+        return None
+    return time.strftime(CHANGES_SINCE_FORMAT, time.gmtime(listed - overlap))
+
+
+class NodePoller(object):
+
+    """
+    Shares node status polling between everything waiting on a build.  A
+    single thread lists the nodes once per interval (see ServerView), and
+    each waiter picks its nodes out of that listing, so a thousand builds
+    in flight cost one API call (and one connection) per interval instead
+    of a thousand.
+    """
+
+    def __init__(self, list_nodes, interval=5):
+        self.list_nodes = list_nodes
+        self.interval = interval
+        self._condition = threading.Condition()
+        self._waiting = 0
+        self._generation = 0
+        self._nodes = {}
+        self._error = None
+        self._thread = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._waiting:
+                    self._condition.wait()
+
+            time.sleep(self.interval)
+            try:
+                nodes, error = self.list_nodes(), None
+            except Exception as e:
+                nodes, error = [], e
+
+            with self._condition:
+                # Everyone waiting now is answered by this listing
+                self._waiting = 0
+                self._generation += 1
+                self._nodes = dict((node.id, node) for node in nodes)
+                self._error = error
+                self._condition.notify_all()
+
+    def next_states(self, node_ids):
+        """
+        The nodes as of the next listing, in the order of node_ids (None
+        for nodes missing from the listing)
+        """
+
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+            self._waiting += 1
+            self._condition.notify_all()
+            generation = self._generation
+            try:
+                while self._generation == generation:
+                    # Wake up now and then so Ctrl-C still gets through
+                    self._condition.wait(1)
+            except BaseException:
+                if self._generation == generation:
+                    self._waiting -= 1
+                raise
+
+            if self._error is not None:
+                raise self._error
+            return [self._nodes.get(node_id) for node_id in node_ids]
+
+
+class ServerView(object):
+
+    """
+    The account's servers, kept up to date incrementally.  The first
+    refresh lists every server; later ones only ask for the servers that
+    changed (or were deleted) since the one before, with Nova's
+    changes-since, so polling costs what changes rather than how many
+    servers there are.  Everything is listed again every resync_after
+    seconds in case a change was missed.
+
+    list_all(**kwargs) returns every server, list_changes(since, **kwargs)
+    returns the servers changed since a changes-since time and the ids of
+    those deleted.
+    """
+
+    def __init__(self, list_all, list_changes, resync_after=60 * 60,
+                 overlap=60, clock=time.time):
+        self.list_all = list_all
+        self.list_changes = list_changes
+        self.resync_after = resync_after
+        self.overlap = overlap
+        self.clock = clock
+        self._lock = threading.Lock()
+        # By id, and the ids in listing order (no OrderedDict on 2.6)
+        self._nodes = {}
+        self._order = []
+        self._listed = None
+        self._resynced = None
+
+    def refresh(self, **kwargs):
+        """
+        The servers, as of now (a full listing or the changes since the
+        last one)
+        """
+
+        with self._lock:
+            started = self.clock()
+            since = changes_since(self._listed, self._resynced, started,
+                                  self.resync_after, self.overlap)
+            if since is None:
+                nodes = self.list_all(**kwargs)
+                self._nodes = dict((node.id, node) for node in nodes)
+                self._order = [node.id for node in nodes]
+                self._resynced = started
+            else:
+                changed, deleted = self.list_changes(since, **kwargs)
+                for node in changed:
+                    if node.id not in self._nodes:
+                        self._order.append(node.id)
+                    self._nodes[node.id] = node
+                for node_id in deleted:
+                    if self._nodes.pop(node_id, None) is not None:
+                        self._order.remove(node_id)
+            self._listed = started
+
+            return self._listed_nodes()
+
+    def nodes(self):
+        """
+        The servers as of the last refresh, without asking the API
+        """
+
+        with self._lock:
+            return self._listed_nodes()
+
+    def _listed_nodes(self):
+        return [self._nodes[node_id] for node_id in self._order]
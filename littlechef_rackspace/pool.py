@@ -0,0 +1,347 @@
+import errno
+import hashlib
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from StringIO import StringIO
+from journal import (STATE_DIRECTORY, REQUESTED, FAILED, connect_state_db,
+                     ensure_directory)
+from parallel import run_windowed, PrefixedProgress
+
+# Pooled servers are named this, then renamed when claimed
+NAME_PREFIX = "pool-"
+
+BUILDING = "building"
+READY = "ready"
+
+# Where fills started in the background write their progress
+LOG_PATH = os.path.join(STATE_DIRECTORY, "pool.log")
+
+# The script run to fill the pool in the background
+COMMAND = "fix-rackspace"
+
+# The create command's options a background fill is run with
+FILL_OPTIONS = ["username", "public_key", "private_key", "bootstrap_network",
+                "build_timeout", "replace_failed"]
+
+# The API key for a background fill, kept off its command line where any
+# local user could read it
+KEY_VARIABLE = "LITTLECHEF_RACKSPACE_KEY"
+
+
+def key_fingerprint(public_key):
+    """
+    Short hash of an SSH public key, ignoring its comment
+    """
+
+    return hashlib.sha1(" ".join(public_key.split()[:2])).hexdigest()[:12]
+
+
+def script_path():
+    """
+    The fix-rackspace script: the one running, or else the one installed
+    beside this Python (which needn't be on the PATH, e.g. in a virtualenv
+    that isn't activated)
+    """
+
+    if os.path.basename(sys.argv[0]) == COMMAND:
+        return os.path.abspath(sys.argv[0])
+    return os.path.join(os.path.dirname(sys.executable), COMMAND)
+
+
+def pool_key(region, flavor, image, networks, public_key):
+    """
+    Pooled servers are interchangeable only if they are in the same region,
+    built from the same flavor and image, attached to the same networks
+    (in order) and authorize the same key
+    """
+
+    return "{0}/{1}/{2}/{3}/{4}".format(region, flavor, image,
+                                        ",".join(networks or []) or "default",
+                                        key_fingerprint(public_key))
+
+
+class PoolStore(object):
+
+    """
+    Local SQLite record of the idle servers built ahead of time for each
+    region, flavor and image.  Claims are atomic, so processes sharing the
+    kitchen never hand out the same server twice.
+    """
+
+    def __init__(self, path=None, build_timeout=60 * 60, clock=time.time):
+        self.path = path or os.path.join(STATE_DIRECTORY, "pool.db")
+        # A server still building after this long was abandoned (its run
+        # was interrupted) and no longer counts towards the pool
+        self.build_timeout = build_timeout
+        self.clock = clock
+
+    def _connect(self):
+        # Transactions are begun explicitly, taking the write lock up front
+        return connect_state_db(self.path, self._create_schema,
+                                isolation_level=None)
+
+    def _create_schema(self, db):
+        db.execute("CREATE TABLE IF NOT EXISTS pool ("
+                   "name TEXT PRIMARY KEY, "
+                   "key TEXT NOT NULL, "
+                   "state TEXT NOT NULL, "
+                   "node_id TEXT, "
+                   "started REAL NOT NULL)")
+
+    def reserve(self, key, size):
+        """
+        Names for the servers to build to bring the pool for key up to
+        size, counting those ready and still building (but not abandoned)
+        """
+
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            count, = db.execute("SELECT COUNT(*) FROM pool WHERE key = ? "
+                                "AND NOT (state = ? AND started < ?)",
+                                (key, BUILDING,
+                                 self.clock() - self.build_timeout)
+                                ).fetchone()
+            names = [NAME_PREFIX + uuid.uuid4().hex[:12]
+                     for _ in range(size - count)]
+            db.executemany("INSERT INTO pool (name, key, state, started) "
+                           "VALUES (?, ?, ?, ?)",
+                           [(name, key, BUILDING, self.clock())
+                            for name in names])
+            db.execute("COMMIT")
+            return names
+        finally:
+            db.close()
+
+    def ready(self, name, node_id):
+        """
+        Mark a server built; False if it was given up on meanwhile
+        """
+
+        db = self._connect()
+        try:
+            cursor = db.execute("UPDATE pool SET state = ?, node_id = ? "
+                                "WHERE name = ? AND state = ?",
+                                (READY, node_id, name, BUILDING))
+            return cursor.rowcount == 1
+        finally:
+            db.close()
+
+    def expire(self, key):
+        """
+        Take servers for key that have been building for longer than
+        build_timeout out of the pool; returns their names
+        """
+
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            cutoff = self.clock() - self.build_timeout
+            names = [name for name, in db.execute(
+                "SELECT name FROM pool WHERE key = ? AND state = ? "
+                "AND started < ?", (key, BUILDING, cutoff))]
+            db.execute("DELETE FROM pool WHERE key = ? AND state = ? "
+                       "AND started < ?", (key, BUILDING, cutoff))
+            db.execute("COMMIT")
+            return names
+        finally:
+            db.close()
+
+    def discard(self, name):
+        db = self._connect()
+        try:
+            db.execute("DELETE FROM pool WHERE name = ?", (name,))
+        finally:
+            db.close()
+
+    def claim(self, key):
+        """
+        Take the longest waiting ready server for key out of the pool;
+        returns its (name, node_id), or None if there isn't one
+        """
+
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT name, node_id FROM pool "
+                             "WHERE key = ? AND state = ? "
+                             "ORDER BY started LIMIT 1",
+                             (key, READY)).fetchone()
+            if row is not None:
+                db.execute("DELETE FROM pool WHERE name = ?", (row[0],))
+            db.execute("COMMIT")
+            return row
+        finally:
+            db.close()
+
+    def counts(self):
+        """
+        {key: {state: count}} for every pool
+        """
+
+        db = self._connect()
+        try:
+            counts = {}
+            for key, state, count in db.execute(
+                    "SELECT key, state, COUNT(*) FROM pool "
+                    "GROUP BY key, state"):
+                counts.setdefault(key, {BUILDING: 0, READY: 0})[state] = count
+            return counts
+        finally:
+            db.close()
+
+
+class Pool(object):
+
+    """
+    Warm standby servers: built and with Chef installed ahead of time, so
+    creating a server is a rename and a Chef run instead of a build
+    """
+
+    def __init__(self, rackspace_api, chef_deployer, store=None):
+        self.rackspace_api = rackspace_api
+        self.chef_deployer = chef_deployer
+        self.store = store or PoolStore()
+
+    def key(self, flavor, image, networks, public_key):
+        return pool_key(self.rackspace_api.region, flavor, image, networks,
+                        public_key)
+
+    def fill(self, size, flavor, image, public_key, networks=None,
+             concurrency=1, progress=None):
+        """
+        Build servers until the pool for flavor and image has size ready
+        or building, at most `concurrency` at a time; returns a
+        run_windowed Result per server built.  Servers abandoned while
+        building (see PoolStore.expire) are deleted first.
+        """
+
+        key = self.key(flavor, image, networks, public_key)
+        if not getattr(self.chef_deployer, 'isolate', False):
+            # fabric's env is process global
+            concurrency = 1
+
+        abandoned = self.store.expire(key)
+        if abandoned:
+            self._delete_abandoned(abandoned, progress)
+
+        def build(name):
+            server_progress = None
+            if progress:
+                server_progress = PrefixedProgress(progress, name)
+            host = None
+            try:
+                host = self.rackspace_api.create_node(
+                    name=name, flavor=flavor, image=image,
+                    public_key_file=StringIO(public_key), networks=networks,
+                    progress=server_progress)
+                self.chef_deployer.prepare(host)
+                if not self.store.ready(name, host.node_id):
+                    raise Exception("Building {0} took longer than {1} "
+                                    "seconds; it is no longer pooled".format(
+                                        name, self.store.build_timeout))
+            except BaseException:
+                self.store.discard(name)
+                if host is not None:
+                    self.rackspace_api.delete_nodes(
+                        [{'id': host.node_id, 'name': name}])
+                raise
+            return host
+
+        return run_windowed(build, self.store.reserve(key, size),
+                            window=concurrency)
+
+    def _delete_abandoned(self, names, progress=None):
+        servers = [server for server in self.rackspace_api.list_servers()
+                   if server['name'] in names]
+        if progress:
+            progress.write("Deleting {0} servers abandoned while building "
+                           "for the pool\n".format(len(servers)))
+        if servers:
+            self.rackspace_api.delete_nodes(servers, progress=progress)
+
+    def fill_in_background(self, size, flavor, image, networks=None,
+                           concurrency=1, options=None, log_path=None):
+        """
+        Run `fix-rackspace pool` in the kitchen to fill() the pool without
+        waiting for it, logging to log_path.  It is a new process rather
+        than a fork, as the caller may be the threaded serve daemon.
+        options are the create command's (see FILL_OPTIONS, plus the key).
+        Raises OSError if it can't be started.
+        """
+
+        script = script_path()
+        if not os.path.isfile(script):
+            raise OSError(errno.ENOENT, "No such file", script)
+
+        options = options or {}
+        command = [sys.executable, script, "pool",
+                   "--region", self.rackspace_api.region,
+                   "--flavor", flavor, "--image", image,
+                   "--pool-size", str(size), "--concurrency", str(concurrency)]
+        if networks:
+            command += ["--networks", ",".join(networks)]
+        for option in FILL_OPTIONS:
+            if options.get(option):
+                command += ["--" + option.replace("_", "-"),
+                            str(options[option])]
+
+        environment = dict(os.environ)
+        if options.get('key'):
+            environment[KEY_VARIABLE] = options['key']
+
+        log_path = log_path or LOG_PATH
+        ensure_directory(log_path)
+
+        with open(log_path, "a") as log:
+            with open(os.devnull) as devnull:
+                process = subprocess.Popen(command, stdin=devnull,
+                                           stdout=log,
+                                           stderr=subprocess.STDOUT,
+                                           env=environment, close_fds=True,
+                                           preexec_fn=os.setsid)
+
+        # Reaped if we outlive it, as serve does
+        reaper = threading.Thread(target=process.wait)
+        reaper.daemon = True
+        reaper.start()
+        return process
+
+    def claim(self, name, flavor, image, public_key, networks=None,
+              progress=None, journal=None, args=None):
+        """
+        Rename a ready server from the pool for flavor, image, networks and
+        public_key to name; returns its Host, or None if the pool is empty.
+        The claim is journaled (with args) before the rename, so resume can
+        finish it.
+        """
+
+        key = self.key(flavor, image, networks, public_key)
+        while True:
+            claimed = self.store.claim(key)
+            if claimed is None:
+                return None
+
+            pool_name, node_id = claimed
+            if journal:
+                journal.record("create", name, REQUESTED, node_id=node_id,
+                               args=args, details={'from_pool': True})
+            try:
+                host = self.rackspace_api.rename_node(node_id, name)
+            except Exception as e:
+                if journal:
+                    journal.record("create", name, FAILED)
+                # Deleted since it was pooled; try the next one
+                if progress:
+                    progress.write("Could not claim {0} ({1}): {2}\n".format(
+                        pool_name, node_id, e))
+                continue
+
+            if progress:
+                progress.write("Claimed {0} ({1}) from the pool as {2}\n"
+                               .format(pool_name, node_id, name))
+            return host
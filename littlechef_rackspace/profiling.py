@@ -0,0 +1,115 @@
+from contextlib import contextmanager
+import cProfile
+import os
+import pstats
+import StringIO
+import sys
+import time
+from journal import STATE_DIRECTORY, ensure_directory
+
+PROFILE_PATH = os.path.join(STATE_DIRECTORY, "profile.pstats")
+
+
+class Profiler(object):
+
+    """
+    Profiles a run of fix-rackspace phase by phase (reading configuration,
+    connecting to the API, running the command...).  Each phase gets a
+    cProfile profile of its own; phases may nest, and time spent in an
+    inner phase is only counted there.  Only the thread that starts a
+    phase is profiled.
+    """
+
+    def __init__(self, path=None, top=20):
+        self.path = path or PROFILE_PATH
+        self.top = top
+        # In the order they were first entered
+        self.phases = []
+        self._profiles = {}
+        self._seconds = {}
+        self._active = []
+
+    @contextmanager
+    def phase(self, name):
+        if name not in self._profiles:
+            self.phases.append(name)
+            self._profiles[name] = cProfile.Profile()
+            self._seconds[name] = 0.0
+
+        if self._active:
+            self._profiles[self._active[-1]].disable()
+        self._active.append(name)
+        started = time.time()
+        self._profiles[name].enable()
+        try:
+            yield
+        finally:
+            self._profiles[name].disable()
+            self._seconds[name] += time.time() - started
+            self._active.pop()
+            if self._active:
+                self._profiles[self._active[-1]].enable()
+
+    def seconds(self, name):
+        """
+        Wall time in a phase, including its inner phases
+        """
+
+        return self._seconds[name]
+
+    def _stats(self, names, stream=None):
+        stats = pstats.Stats(self._profiles[names[0]],
+                             stream=stream or sys.stdout)
+        for name in names[1:]:
+            stats.add(self._profiles[name])
+        return stats
+
+    def save(self):
+        """
+        Write every phase's profile to path and each to a file of its own,
+        <path>-<phase>.pstats; returns the paths written
+        """
+
+        if not self.phases:
+            return []
+
+        ensure_directory(self.path)
+
+        base, extension = os.path.splitext(self.path)
+        paths = [self.path]
+        self._stats(self.phases).dump_stats(self.path)
+        for name in self.phases:
+            path = "{0}-{1}{2}".format(base, name, extension)
+            self._stats([name]).dump_stats(path)
+            paths.append(path)
+
+        return paths
+
+    def summary(self):
+        """
+        Wall time of each phase and its top functions by cumulative time
+        """
+
+        lines = []
+        for name in self.phases:
+            lines.append("== {0}: {1:.3f}s".format(name, self._seconds[name]))
+            output = StringIO.StringIO()
+            stats = self._stats([name], stream=output)
+            stats.sort_stats("cumulative").print_stats(self.top)
+            # Just the table, not pstats' preamble
+            table = output.getvalue().split("\n")
+            for i, line in enumerate(table):
+                if line.lstrip().startswith("ncalls"):
+                    table = table[i:]
+                    break
+            lines.extend(line for line in table if line.strip())
+            lines.append("")
+
+        return "\n".join(lines)
+
+    def report(self, progress=sys.stdout):
+        paths = self.save()
+        progress.write(self.summary() + "\n")
+        if paths:
+            progress.write("Profile written to {0}\n".format(
+                ", ".join(paths)))
@@ -0,0 +1,305 @@
+import os
+import Queue
+import threading
+import time
+from StringIO import StringIO
+from api import RackspaceApi, BuildError, BuildFailed, BuildTimeout
+from commands import RackspaceCreate, RackspaceRebuild
+from deploy import ChefDeployer
+from journal import FAILED
+from logs import LogStore
+from parallel import SubprocessFailed
+
+__all__ = ['Provisioner', 'Operation', 'ProgressEvent', 'ProvisioningError',
+           'OperationAborted', 'DeployFailed', 'OperationTimeout',
+           'BuildError', 'BuildFailed', 'BuildTimeout']
+
+
+class ProvisioningError(Exception):
+    pass
+
+
+class OperationAborted(ProvisioningError):
+
+    """
+    The operation refused to go on (fabric's abort() in the command line
+    tool), e.g. an earlier operation on the same node is unfinished
+    """
+
+
+class DeployFailed(ProvisioningError):
+    pass
+
+
+class OperationTimeout(ProvisioningError):
+
+    """
+    Waiting for an operation's result timed out; the operation itself
+    keeps running
+    """
+
+
+class ProgressEvent(object):
+
+    """
+    A node reaching a phase of an operation (see journal for the phases)
+    """
+
+    def __init__(self, operation, name, phase, node_id=None):
+        self.operation = operation
+        self.name = name
+        self.phase = phase
+        self.node_id = node_id
+        self.time = time.time()
+
+    def __repr__(self):
+        return '<ProgressEvent {0} {1} {2}>'.format(self.operation,
+                                                    self.name, self.phase)
+
+
+class Operation(object):
+
+    """
+    Handle on a create, rebuild or delete running in the background, in
+    the style of a concurrent.futures Future
+    """
+
+    def __init__(self, kind, name, on_progress=None):
+        self.kind = kind
+        self.name = name
+        self.events = []
+        # Human readable progress, as the command line tool would print it
+        self.log = StringIO()
+        self._on_progress = on_progress
+        self._finished = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._value = None
+        self._error = None
+
+    def _event(self, event):
+        self.events.append(event)
+        if self._on_progress:
+            self._on_progress(self, event)
+
+    def _finish(self, value=None, error=None):
+        with self._lock:
+            self._value = value
+            self._error = error
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            callback(self)
+
+    @property
+    def phase(self):
+        return self.events[-1].phase if self.events else None
+
+    def done(self):
+        return self._finished.is_set()
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._finished.is_set():
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def exception(self, timeout=None):
+        self._finished.wait(timeout)
+        if not self._finished.is_set():
+            raise OperationTimeout("{0} of {1} still running after {2}s"
+                                   .format(self.kind, self.name, timeout))
+        return self._error
+
+    def result(self, timeout=None):
+        error = self.exception(timeout)
+        if error is not None:
+            raise error
+        return self._value
+
+    def __repr__(self):
+        return '<Operation {0} {1} phase={2}>'.format(self.kind, self.name,
+                                                      self.phase)
+
+
+class _EventJournal(object):
+
+    """
+    Journal stand-in for a single operation: every recorded phase becomes
+    a ProgressEvent, and is also kept in the real journal if there is one
+    """
+
+    def __init__(self, operation, journal=None):
+        self.operation = operation
+        self.journal = journal
+
+    def record(self, operation, name, phase, node_id=None, args=None,
+               details=None):
+        if self.journal:
+            self.journal.record(operation, name, phase, node_id=node_id,
+                                args=args, details=details)
+        self.operation._event(ProgressEvent(operation, name, phase,
+                                            node_id=node_id))
+
+    def is_unfinished(self, name):
+        return self.journal is not None and self.journal.is_unfinished(name)
+
+
+class Provisioner(object):
+
+    """
+    Library interface for creating, rebuilding and deleting servers.
+    Operations run on a pool of worker threads and return an Operation
+    straight away; Chef deploys run in child processes so any number of
+    them can run side by side.
+
+        provisioner = Provisioner(username, key, "dfw")
+        ops = [provisioner.create("web-n0{0}".format(i), flavor, image,
+                                  runlist=["role[web]"]) for i in range(5)]
+        hosts = [op.result() for op in ops]
+    """
+
+    def __init__(self, username=None, key=None, region=None,
+                 private_key="~/.ssh/id_rsa",
+                 public_key="~/.ssh/id_rsa.pub", workers=8, journal=None,
+                 timings=None, on_progress=None, rackspace_api=None,
+                 chef_deployer=None, metrics=None):
+        self.region = region
+        self.public_key = os.path.expanduser(public_key)
+        # e.g. metrics.PrometheusTextfile or metrics.StatsdMetrics
+        self.metrics = metrics
+        self.rackspace_api = rackspace_api or RackspaceApi(
+            username, key, region, shared_polling=True, metrics=metrics)
+        self.chef_deployer = chef_deployer or ChefDeployer(
+            key_filename=private_key, isolate=True, log_store=LogStore(),
+            metrics=metrics)
+        self.journal = journal
+        self.timings = timings
+        # Called with (operation, event) for every ProgressEvent
+        self.on_progress = on_progress
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+
+            operation, func = task
+            try:
+                value = func(operation)
+            except SystemExit as e:
+                error = OperationAborted(getattr(e, 'message', None) or
+                                         "{0} aborted".format(operation.kind))
+            except SubprocessFailed as e:
+                error = DeployFailed(str(e))
+            except Exception as e:
+                error = e
+            else:
+                operation._finish(value=value)
+                continue
+
+            operation._event(ProgressEvent(operation.kind, operation.name,
+                                           FAILED))
+            operation._finish(error=error)
+
+    def _submit(self, kind, name, func):
+        operation = Operation(kind, name, on_progress=self.on_progress)
+        with self._lock:
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+        self._queue.put((operation, func))
+        return operation
+
+    def _public_key_file(self):
+        with open(self.public_key) as public_key_file:
+            return StringIO(public_key_file.read())
+
+    def _command(self, command_class, operation):
+        return command_class(rackspace_api=self.rackspace_api,
+                             chef_deployer=self.chef_deployer,
+                             journal=_EventJournal(operation, self.journal),
+                             timings=self.timings)
+
+    def create(self, name, flavor, image, environment=None, networks=None,
+               hedge_after=None, **deploy_args):
+        """
+        Create a server and deploy Chef to it.  deploy_args are those of
+        ChefDeployer.deploy: runlist, plugins, post_plugins and
+        use_opscode_chef, or bootstrap_mode="user-data" with bundle_url
+        (and bundle_url_key, callback_url) for a server that bootstraps
+        itself.  from_pool=True (and pool_size) claims a server from the
+        warm standby pool instead of building one.  The operation's result
+        is the deployed Host.
+        """
+
+        def create(operation):
+            command = self._command(RackspaceCreate, operation)
+            return command.execute(name=name, flavor=flavor, image=image,
+                                   public_key_file=self._public_key_file(),
+                                   environment=environment,
+                                   networks=networks,
+                                   hedge_after=hedge_after,
+                                   region=self.region,
+                                   progress=operation.log, **deploy_args)
+
+        return self._submit("create", name, create)
+
+    def rebuild(self, name, image, environment=None, **deploy_args):
+        """
+        Rebuild a server and deploy Chef to it again.  The operation's
+        result is the deployed Host.
+        """
+
+        def rebuild(operation):
+            command = self._command(RackspaceRebuild, operation)
+            return command.execute(name=name, image=image,
+                                   public_key_file=self._public_key_file(),
+                                   environment=environment,
+                                   progress=operation.log, **deploy_args)
+
+        return self._submit("rebuild", name, rebuild)
+
+    def delete(self, servers, concurrency=10):
+        """
+        Delete servers (dicts as returned by list_servers).  The
+        operation's result is the list of servers that failed to delete.
+        """
+
+        def delete(operation):
+            return self.rackspace_api.delete_nodes(servers,
+                                                   concurrency=concurrency,
+                                                   progress=operation.log)
+
+        return self._submit("delete", ", ".join(server['name']
+                                                for server in servers),
+                            delete)
+
+    def list_servers(self):
+        return self.rackspace_api.list_servers()
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers once the queued operations have finished
+        """
+
+        with self._lock:
+            threads, self._threads = self._threads, []
+
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+        if self.metrics:
+            self.metrics.flush()
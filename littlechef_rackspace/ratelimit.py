@@ -0,0 +1,244 @@
+import heapq
+import itertools
+import re
+import threading
+import time
+
+# Lower numbers are served first when several callers wait on a bucket
+PRIORITY_POLL = 0
+PRIORITY_ACTION = 1
+PRIORITY_LIST = 2
+
+UNIT_SECONDS = {
+    'SECOND': 1,
+    'MINUTE': 60,
+    'HOUR': 60 * 60,
+    'DAY': 60 * 60 * 24,
+}
+
+OVER_LIMIT_STATUSES = ['413', '429']
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class TokenBucket(object):
+
+    """
+    Classic token bucket: `capacity` tokens, refilled at `rate` tokens
+    per second.  Starts full (or at `tokens` if the API told us how many
+    requests are remaining).
+    """
+
+    def __init__(self, rate, capacity, tokens=None, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        if tokens is None:
+            tokens = capacity
+        self.tokens = min(float(tokens), self.capacity)
+        self.updated = clock()
+
+    def _refill(self, now):
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """
+        Seconds until a token is available (0 if one is available now)
+        """
+
+        self._refill(self.clock())
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill(self.clock())
+        self.tokens -= 1
+
+
+class RateLimiter(object):
+
+    """
+    Schedules API calls against the account's rate limits.
+
+    Buckets are seeded from the Cloud Servers /limits response.  Callers
+    waiting on the same bucket are served in priority order, so state
+    polls for in-flight builds are not starved by bulk list calls.  Calls
+    that are rejected as over limit (413/429) put every caller on hold
+    for the Retry-After period and are retried.
+    """
+
+    def __init__(self, max_retries=5, default_backoff=5, refresh_after=300,
+                 clock=time.time):
+        self.max_retries = max_retries
+        self.default_backoff = default_backoff
+        # Seconds before the limits are read again, so remaining requests
+        # and instance counts track what other clients of the account use
+        self.refresh_after = refresh_after
+        self.clock = clock
+        self.configured = False
+        self.configured_at = None
+        self.absolute = {}
+
+        self._limits = []
+        self._waiting = {}
+        self._hold_until = 0
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    def configure(self, limits):
+        """
+        Seed buckets from a /limits response body
+        """
+
+        limits = limits.get('limits', limits)
+
+        with self._cond:
+            self._limits = []
+            for rate in limits.get('rate', []):
+                regex = re.compile(rate.get('regex') or '.*')
+                for limit in rate.get('limit', []):
+                    period = UNIT_SECONDS.get(limit.get('unit'), 60)
+                    value = int(limit['value'])
+                    bucket = TokenBucket(value / float(period), value,
+                                         tokens=limit.get('remaining'),
+                                         clock=self.clock)
+                    self._limits.append((limit['verb'], regex, bucket))
+
+            self.absolute = dict(limits.get('absolute', {}))
+            self.configured = True
+            self.configured_at = self.clock()
+
+    def expired(self):
+        """
+        Whether the limits are due to be (re)loaded.  Once configured, only
+        the first caller to find them stale is told to reload them; the
+        rest carry on with the current limits meanwhile.
+        """
+
+        with self._cond:
+            if not self.configured:
+                return True
+            if (self.refresh_after is None or
+                    self.clock() - self.configured_at < self.refresh_after):
+                return False
+            self.configured_at = self.clock()
+            return True
+
+    def claim_instance(self):
+        """
+        Account for a new server against the absolute instance quota
+        """
+
+        with self._cond:
+            maximum = self.absolute.get('maxTotalInstances')
+            if maximum is None:
+                return
+
+            used = self.absolute.get('totalInstancesUsed', 0)
+            if used >= maximum:
+                raise QuotaExceeded("Instance quota of {0} servers reached"
+                                    .format(maximum))
+            self.absolute['totalInstancesUsed'] = used + 1
+
+    def headroom(self):
+        """
+        Servers and MB of RAM still available under the absolute limits
+        (None for limits we don't know)
+        """
+
+        def remaining(maximum, used):
+            if self.absolute.get(maximum) is None:
+                return None
+            return self.absolute[maximum] - self.absolute.get(used, 0)
+
+        with self._cond:
+            return {'instances': remaining('maxTotalInstances',
+                                           'totalInstancesUsed'),
+                    'ram': remaining('maxTotalRAMSize', 'totalRAMUsed')}
+
+    def release_instance(self):
+        """
+        Give back quota for a server we deleted
+        """
+
+        with self._cond:
+            used = self.absolute.get('totalInstancesUsed')
+            if used:
+                self.absolute['totalInstancesUsed'] = used - 1
+
+    def _buckets_for(self, verb, uri):
+        return [bucket for (limit_verb, regex, bucket) in self._limits
+                if limit_verb == verb and regex.match(uri)]
+
+    def _acquire_bucket(self, bucket, priority):
+        queue = self._waiting.setdefault(id(bucket), [])
+        ticket = (priority, next(self._counter))
+        heapq.heappush(queue, ticket)
+
+        try:
+            while True:
+                delay = max(self._hold_until - self.clock(), 0)
+                if not delay and queue[0] == ticket:
+                    delay = bucket.delay()
+                    if not delay:
+                        bucket.consume()
+                        return
+                self._cond.wait(delay or None)
+        finally:
+            queue.remove(ticket)
+            heapq.heapify(queue)
+            self._cond.notify_all()
+
+    def acquire(self, verb, uri, priority=PRIORITY_ACTION):
+        with self._cond:
+            while self._hold_until > self.clock():
+                self._cond.wait(self._hold_until - self.clock())
+
+            for bucket in self._buckets_for(verb, uri):
+                self._acquire_bucket(bucket, priority)
+
+    def hold(self, seconds):
+        """
+        Stop issuing requests for `seconds` (e.g. after a Retry-After)
+        """
+
+        with self._cond:
+            self._hold_until = max(self._hold_until, self.clock() + seconds)
+            self._cond.notify_all()
+
+    def _retry_after(self, error, attempt):
+        """
+        Returns the backoff for an over limit error, or None if the error
+        is not a rate limit rejection.  libcloud only gives us the status
+        line and body text, so Retry-After is read from the message; when
+        it is missing we back off exponentially.
+        """
+
+        message = str(error)
+        if message.split(' ', 1)[0] not in OVER_LIMIT_STATUSES:
+            return None
+
+        match = re.search(r'retry.?after\D*(\d+)', message, re.IGNORECASE)
+        if match:
+            return int(match.group(1))
+
+        return self.default_backoff * 2 ** attempt
+
+    def call(self, verb, uri, priority, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.acquire(verb, uri, priority)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                retry_after = self._retry_after(e, attempt)
+                if retry_after is None or attempt >= self.max_retries:
+                    raise
+
+                attempt += 1
+                self.hold(retry_after)
@@ -1,30 +1,78 @@
+from contextlib import contextmanager
 from optparse import OptionParser
 from fabric.utils import abort
 
 import ConfigParser
+import copy
 import os
+import sys
 import littlechef
 import yaml
 
 from api import RackspaceApi
-from deploy import ChefDeployer
+from catalog import Catalog
+from deploy import ChefDeployer, BOOTSTRAP_NETWORKS
+from journal import Journal
+from logs import LogStore
+from metrics import get_metrics
+from pool import KEY_VARIABLE
+from profiling import Profiler
+from timings import TimingStore
+from userdata import BOOTSTRAP_MODES
 from commands import (RackspaceCreate,
                       RackspaceListImages,
                       RackspaceListFlavors,
                       RackspaceListNetworks,
                       RackspaceRebuild,
+                      RackspaceResume,
+                      RackspaceDelete,
+                      RackspaceServe,
+                      RackspaceLogs,
+                      RackspaceConverge,
+                      RackspaceInventorySync,
+                      RackspaceQueryServers,
+                      RackspaceBundleKitchen,
+                      RackspacePool,
+                      RackspaceVerify,
                       RackspaceListServers)
 
 
 def get_command_classes():
     return [RackspaceCreate,
             RackspaceRebuild,
+            RackspaceResume,
+            RackspaceDelete,
+            RackspaceServe,
+            RackspaceLogs,
+            RackspaceConverge,
+            RackspaceInventorySync,
+            RackspaceQueryServers,
+            RackspaceBundleKitchen,
+            RackspacePool,
+            RackspaceVerify,
             RackspaceListImages,
             RackspaceListFlavors,
             RackspaceListNetworks,
             RackspaceListServers]
 
 
+# Options whose command line dest has dashes; every other option's dest
+# has underscores
+DASHED_OPTIONS = ['secrets-file', 'post-plugins', 'use-opscode-chef']
+
+
+def option_key(key):
+    """
+    The dest for an option named in rackspace.yaml or a template, which
+    may be spelled with dashes (as on the command line) or underscores
+    """
+
+    key = key.replace('-', '_')
+    if key.replace('_', '-') in DASHED_OPTIONS:
+        return key.replace('_', '-')
+    return key
+
+
 class FailureMessages:
 
     INVALID_REGION = ("Must specify a valid region "
@@ -94,6 +142,110 @@ parser.add_option("-n", "--networks", dest="networks",
                   help="Comma separated list of network ids to \
                           create node with (PublicNet is required)",
                   default=None)
+parser.add_option("-c", "--concurrency", type="int", dest="concurrency",
+                  help=("Number of servers to operate on at once when a "
+                        "command matches several servers"),
+                  default=None)
+parser.add_option("--build-timeout", type="int", dest="build_timeout",
+                  help=("Minutes to wait for a server to become active "
+                        "before giving up on it (default 30)"),
+                  default=None)
+parser.add_option("--replace-failed", type="int", dest="replace_failed",
+                  help=("Number of times to delete and resubmit a server "
+                        "whose build fails or times out (default 0)"),
+                  default=None)
+parser.add_option("--hedge-after", dest="hedge_after",
+                  help=("Submit a spare build when a create takes longer "
+                        "than this many seconds, or than a percentile of "
+                        "past builds (e.g. 'p90'); the first to become "
+                        "active is used and the other deleted"),
+                  default=None)
+parser.add_option("--bootstrap-network", type="choice",
+                  choices=BOOTSTRAP_NETWORKS, dest="bootstrap_network",
+                  help=("Network to bootstrap new servers over: 'public', "
+                        "'servicenet' or 'auto' (ServiceNet if reachable "
+                        "from here, else public; default public)"),
+                  default=None)
+parser.add_option("--bootstrap-mode", type="choice",
+                  choices=BOOTSTRAP_MODES, dest="bootstrap_mode",
+                  help=("How create bootstraps Chef: 'ssh' from here "
+                        "(default), or 'user-data' for servers to run "
+                        "chef-solo themselves at first boot from the "
+                        "bundle at --bundle-url"),
+                  default=None)
+parser.add_option("--bundle-url", dest="bundle_url",
+                  help=("URL servers fetch the kitchen bundle (see "
+                        "bundle-kitchen) from with --bootstrap-mode "
+                        "user-data"),
+                  default=None)
+parser.add_option("--bundle-url-key", dest="bundle_url_key",
+                  help=("Cloud Files Temp URL key to sign --bundle-url "
+                        "with, for a bundle in a private container"),
+                  default=None)
+parser.add_option("--callback-url", dest="callback_url",
+                  help=("URL servers POST the outcome of their bootstrap "
+                        "to, as JSON, with --bootstrap-mode user-data"),
+                  default=None)
+parser.add_option("--from-pool", action="store_true", dest="from_pool",
+                  help=("With create, claim an idle server with the same "
+                        "region, flavor and image from the pool (see "
+                        "'pool') instead of building one"))
+parser.add_option("--pool-size", type="int", dest="pool_size",
+                  help=("With pool, how many idle servers to keep for the "
+                        "flavor and image; with create --from-pool, refill "
+                        "the pool to this size in the background"),
+                  default=None)
+parser.add_option("-y", "--yes", action="store_true", dest="yes",
+                  help="Don't ask for confirmation before deleting servers")
+parser.add_option("--abandon", action="store_true", dest="abandon",
+                  help=("With resume, give up on unfinished operations "
+                        "instead of resuming them"))
+parser.add_option("--max-failures", type="int", dest="max_failures",
+                  help=("Stop starting new operations once this many "
+                        "servers have failed"),
+                  default=None)
+parser.add_option("--regions", dest="regions",
+                  help=("With inventory-sync and query-servers, comma "
+                        "separated regions to use (default --region)"),
+                  default=None)
+parser.add_option("--where", action="append", dest="where",
+                  help=("With query-servers, a field=pattern condition, "
+                        "e.g. 'environment=preprod' or 'image=5cebb*' (may "
+                        "be given more than once)"),
+                  default=None)
+parser.add_option("--sort", dest="sort",
+                  help=("With query-servers, comma separated fields to "
+                        "sort by (default region,name)"),
+                  default=None)
+parser.add_option("--refresh", action="store_true", dest="refresh",
+                  help=("With query-servers, fetch what changed in "
+                        "--region (or --regions) before querying"))
+parser.add_option("--check", action="append", dest="checks",
+                  help=("With verify, a health command that must exit 0 on "
+                        "each server (may be given more than once)"),
+                  default=None)
+parser.add_option("--check-ports", dest="check_ports",
+                  help=("With verify, comma separated ports each server "
+                        "must accept connections on"),
+                  default=None)
+parser.add_option("--metrics-textfile", dest="metrics_textfile",
+                  help=("Write provisioning metrics to this file in the "
+                        "Prometheus text format"),
+                  default=None)
+parser.add_option("--statsd", dest="statsd",
+                  help="Send provisioning metrics to StatsD at host:port",
+                  default=None)
+parser.add_option("--profile", action="store_true", dest="profile",
+                  help=("Profile the command, phase by phase, into "
+                        ".littlechef-rackspace/profile.pstats and print "
+                        "the top functions of each phase"))
+parser.add_option("--profile-top", type="int", dest="profile_top",
+                  help=("With --profile, the number of functions shown "
+                        "for each phase (default 20)"),
+                  default=None)
+parser.add_option("--run", dest="run",
+                  help="With logs, the run to show logs from (default latest)",
+                  default=None)
 
 
 class Runner(object):
@@ -124,12 +276,21 @@ class Runner(object):
 
         return None
 
-    def __init__(self, options=None):
+    def __init__(self, options=None, daemon=None, profiler=None):
         self.command_classes = get_command_classes()
+        # Set by fix-rackspace for --profile, so reading the configuration
+        # is profiled too; otherwise made by main
+        self.profiler = profiler
         if options is None:
-            options = self._read_littlechef_config()
+            with self._phase("config"):
+                options = self._read_littlechef_config()
 
         self.options = options or {}
+        # The kitchen configuration before any command line arguments
+        self.config = copy.deepcopy(self.options)
+        # Set when running a request for `serve`
+        self.daemon = daemon
+        self.metrics = None
 
     def _read_secrets_file(self, secrets_file):
         if secrets_file:
@@ -146,27 +307,104 @@ class Runner(object):
 
         return {}
 
-    def get_api(self):
+    def get_api(self, region=None):
         username = self.options.get('username')
         key = self.options.get('key')
-        region = self.options.get('region', '').lower()
+        region = (region or self.options.get('region', '')).lower()
 
         if region not in ['dfw', 'ord', 'syd', 'lon', 'iad', 'hkg']:
             abort(FailureMessages.INVALID_REGION)
 
-        return RackspaceApi(username=username, key=key, region=region)
+        api_kwargs = {'username': username, 'key': key, 'region': region}
+        if self.options.get('build_timeout'):
+            api_kwargs['build_timeout'] = \
+                int(self.options['build_timeout']) * 60
+        if self.options.get('replace_failed'):
+            api_kwargs['replace_failed'] = int(self.options['replace_failed'])
+        if int(self.options.get("concurrency") or 1) > 1 or self.daemon:
+            api_kwargs['shared_polling'] = True
+        if self.get_metrics().enabled:
+            api_kwargs['metrics'] = self.get_metrics()
+
+        if self.daemon:
+            return self.daemon.api(RackspaceApi, **api_kwargs)
+
+        return RackspaceApi(**api_kwargs)
 
     def get_deploy(self):
-        key_filename = self.options.get("private_key", "~/.ssh/id_rsa")
-        return ChefDeployer(key_filename=key_filename)
+        deploy_kwargs = {
+            'key_filename': self.options.get("private_key", "~/.ssh/id_rsa")
+        }
+        # A daemon serves several requests at once from one process
+        if int(self.options.get("concurrency") or 1) > 1 or self.daemon:
+            deploy_kwargs['isolate'] = True
+            # Keep concurrent deploys' output out of the terminal
+            deploy_kwargs['log_store'] = self.get_log_store()
+        if self.options.get("bootstrap_network"):
+            deploy_kwargs['bootstrap_network'] = \
+                self.options["bootstrap_network"]
+        if self.get_metrics().enabled:
+            deploy_kwargs['metrics'] = self.get_metrics()
+
+        return ChefDeployer(**deploy_kwargs)
+
+    def get_catalog(self, rackspace_api):
+        return Catalog(rackspace_api,
+                       self.options.get('region', '').lower())
+
+    def get_metrics(self):
+        if self.metrics is None:
+            metrics_kwargs = {
+                'textfile': self.options.get('metrics_textfile'),
+                'statsd': self.options.get('statsd'),
+            }
+            if self.daemon:
+                # Counters keep counting across the daemon's requests
+                self.metrics = self.daemon.shared(get_metrics,
+                                                  **metrics_kwargs)
+            else:
+                self.metrics = get_metrics(**metrics_kwargs)
+
+        return self.metrics
+
+    def get_log_store(self):
+        return LogStore()
+
+    def get_journal(self):
+        return Journal()
+
+    def get_timings(self):
+        return TimingStore()
+
+    @contextmanager
+    def _phase(self, name):
+        if self.profiler is None:
+            yield
+        else:
+            with self.profiler.phase(name):
+                yield
 
     def _expand_argument(self, args, key):
         if args.get(key) and not isinstance(args.get(key), list):
             args[key.replace('-', '_')] = args[key].split(',')
 
-    def main(self, cmd_args):
+    def main(self, cmd_args, progress=None):
         (options, args) = parser.parse_args(cmd_args)
 
+        if options.profile and self.profiler is None:
+            self.profiler = Profiler()
+        if self.profiler is None:
+            return self._main(options, args, progress)
+
+        if options.profile_top:
+            self.profiler.top = options.profile_top
+        try:
+            with self.profiler.phase("main"):
+                return self._main(options, args, progress)
+        finally:
+            self.profiler.report(progress or sys.stdout)
+
+    def _main(self, options, args, progress):
         if not args:
             raise InvalidCommand
 
@@ -180,20 +418,30 @@ class Runner(object):
         if not matched_commands:
             raise InvalidCommand
 
+        self.options = dict((option_key(k), v)
+                            for k, v in self.options.items())
         for k, v in vars(options).items():
             if v is not None and v != '':
                 self.options[k] = v
+        # A background pool fill is given the key this way, not as --key
+        if os.environ.get(KEY_VARIABLE) and not options.key:
+            self.options['key'] = os.environ[KEY_VARIABLE]
 
         config_templates = self.options.get('templates', {})
         if 'templates' in self.options:
             del self.options['templates']
 
+        if templates:
+            # Recorded with build and deploy timings
+            self.options['template'] = ",".join(templates)
+
         for template in templates:
             if template not in config_templates:
                 raise InvalidTemplate
 
             template_arguments = config_templates.get(template)
             for key, value in template_arguments.iteritems():
+                key = option_key(key)
                 if key not in self.options:
                     self.options[key] = value
                 elif isinstance(self.options[key], list):
@@ -201,17 +449,29 @@ class Runner(object):
                 else:
                     self.options[key] = value
 
-        self.options.update(self._read_secrets_file(
-                            self.options.get('secrets-file')))
+        with self._phase("options"):
+            self.options.update(self._read_secrets_file(
+                                self.options.get('secrets-file')))
 
         command_class = matched_commands[0]
         command_kwargs = {'rackspace_api': None,
                           'chef_deployer': None}
 
         if command_class.requires_api:
-            command_kwargs['rackspace_api'] = self.get_api()
+            with self._phase("api"):
+                command_kwargs['rackspace_api'] = self.get_api()
+                if self.profiler is not None:
+                    command_kwargs['rackspace_api'].authenticate()
         if command_class.requires_deploy:
-            command_kwargs['chef_deployer'] = self.get_deploy()
+            with self._phase("deploy"):
+                command_kwargs['chef_deployer'] = self.get_deploy()
+                command_kwargs['journal'] = self.get_journal()
+                command_kwargs['timings'] = self.get_timings()
+                if command_kwargs['rackspace_api']:
+                    command_kwargs['catalog'] = self.get_catalog(
+                        command_kwargs['rackspace_api'])
+        if command_class.requires_runner:
+            command_kwargs['runner'] = self
 
         command = command_class(**command_kwargs)
 
@@ -229,16 +489,25 @@ class Runner(object):
         self._expand_argument(args, 'post-plugins')
         self._expand_argument(args, 'networks')
 
+        if progress is not None:
+            args['progress'] = progress
+
         if 'use-opscode-chef' in args:
             args['use_opscode_chef'] = bool(args['use-opscode-chef'])
 
         if user_command == 'create' and 'networks' in args:
-            if '00000000-0000-0000-0000-000000000000' not in args['networks']:
+            if not set(['00000000-0000-0000-0000-000000000000', 'public']) \
+                    & set(args['networks']):
                 raise InvalidConfiguration(
                     FailureMessages.MUST_SPECIFY_PUBLICNET
                 )
 
-        command.execute(**args)
+        try:
+            with self._phase("execute"):
+                command.execute(**args)
+        finally:
+            if self.metrics is not None:
+                self.metrics.flush()
 
 
 class MissingRequiredArguments(Exception):
@@ -0,0 +1,189 @@
+from fnmatch import fnmatchcase
+import os
+import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from journal import STATE_DIRECTORY, connect_state_db
+from nodes import NodeStore
+from poller import changes_since
+
+# What servers can be filtered and sorted by
+FIELDS = ["region", "name", "id", "status", "public_ipv4", "image", "flavor",
+          "environment"]
+
+METADATA_PREFIX = "metadata."
+
+
+class InvalidQuery(Exception):
+    pass
+
+
+class ServerIndex(object):
+
+    """
+    Local SQLite index of the servers in every region synced into it, for
+    querying without asking the API.  Regions are refreshed like a
+    ServerView, but their listings are kept between runs.  Environments
+    come from the node files, as they are when queried.
+    """
+
+    def __init__(self, path=None, node_store=None, resync_after=24 * 60 * 60,
+                 overlap=60, clock=time.time):
+        self.path = path or os.path.join(STATE_DIRECTORY, "servers.db")
+        self.node_store = node_store or NodeStore()
+        self.resync_after = resync_after
+        self.overlap = overlap
+        self.clock = clock
+
+    def _connect(self):
+        return connect_state_db(self.path, self._create_schema)
+
+    def _create_schema(self, db):
+        db.execute("CREATE TABLE IF NOT EXISTS servers ("
+                   "region TEXT NOT NULL, "
+                   "id TEXT NOT NULL, "
+                   "name TEXT NOT NULL, "
+                   "status TEXT, "
+                   "public_ipv4 TEXT, "
+                   "image TEXT, "
+                   "flavor TEXT, "
+                   "data TEXT NOT NULL, "
+                   "PRIMARY KEY (region, id))")
+        db.execute("CREATE INDEX IF NOT EXISTS servers_name "
+                   "ON servers (name)")
+        db.execute("CREATE INDEX IF NOT EXISTS servers_image "
+                   "ON servers (image)")
+        db.execute("CREATE TABLE IF NOT EXISTS regions ("
+                   "region TEXT PRIMARY KEY, "
+                   "listed REAL NOT NULL, "
+                   "resynced REAL NOT NULL)")
+
+    def _store(self, db, server):
+        db.execute("INSERT OR REPLACE INTO servers (region, id, name, "
+                   "status, public_ipv4, image, flavor, data) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                   (server['region'], server['id'], server['name'],
+                    server['status'], server['public_ipv4'],
+                    server['image'], server['flavor'], json.dumps(server)))
+
+    def refresh(self, rackspace_api):
+        """
+        Bring a region up to date; returns how many servers changed
+        """
+
+        region = rackspace_api.region
+        started = self.clock()
+
+        db = self._connect()
+        try:
+            row = db.execute("SELECT listed, resynced FROM regions "
+                             "WHERE region = ?", (region,)).fetchone()
+        finally:
+            db.close()
+
+        listed, resynced = row or (None, None)
+        since = changes_since(listed, resynced, started, self.resync_after,
+                              self.overlap)
+        if since is None:
+            changed, deleted = rackspace_api.list_server_details(), None
+            resynced = started
+        else:
+            changed, deleted = rackspace_api.list_server_changes(since)
+
+        db = self._connect()
+        try:
+            if deleted is None:
+                db.execute("DELETE FROM servers WHERE region = ?", (region,))
+            else:
+                db.executemany("DELETE FROM servers WHERE region = ? "
+                               "AND id = ?",
+                               [(region, server_id) for server_id in deleted])
+            for server in changed:
+                self._store(db, server)
+            db.execute("INSERT OR REPLACE INTO regions (region, listed, "
+                       "resynced) VALUES (?, ?, ?)",
+                       (region, started, resynced))
+            db.commit()
+        finally:
+            db.close()
+
+        return len(changed) + len(deleted or [])
+
+    def ages(self):
+        """
+        Seconds since each region was last refreshed
+        """
+
+        db = self._connect()
+        try:
+            return dict((region, self.clock() - listed) for region, listed
+                        in db.execute("SELECT region, listed FROM regions "
+                                      "ORDER BY region"))
+        finally:
+            db.close()
+
+    def query(self, where=None, sort=None):
+        """
+        Servers matching every field=glob pattern of `where` (fields from
+        FIELDS, or metadata.<key>), sorted by the fields in `sort`
+        """
+
+        where = where or {}
+        sort = sort or ["region", "name"]
+        for field in list(where) + list(sort):
+            if field not in FIELDS and not field.startswith(METADATA_PREFIX):
+                raise InvalidQuery("Unknown field '{0}' (expected one of "
+                                   "{1} or {2}<key>)".format(
+                                       field, ", ".join(FIELDS),
+                                       METADATA_PREFIX))
+
+        query = ("SELECT servers.data, environments.environment "
+                 "FROM servers LEFT JOIN environments "
+                 "ON environments.name = servers.name")
+        conditions = []
+        params = []
+        for field, pattern in sorted(where.items()):
+            if field.startswith(METADATA_PREFIX):
+                continue
+            if field == "environment":
+                column = "COALESCE(environments.environment, '')"
+            else:
+                column = "COALESCE(servers.{0}, '')".format(field)
+            conditions.append("{0} GLOB ?".format(column))
+            params.append(pattern)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        environments = self.node_store.environments()
+        db = self._connect()
+        try:
+            db.execute("CREATE TEMP TABLE environments ("
+                       "name TEXT PRIMARY KEY, environment TEXT)")
+            db.executemany("INSERT INTO environments (name, environment) "
+                           "VALUES (?, ?)", environments.items())
+            rows = db.execute(query, params).fetchall()
+        finally:
+            db.close()
+
+        servers = []
+        for data, environment in rows:
+            server = json.loads(data)
+            server['environment'] = environment
+            if all(fnmatchcase(_field(server, field), pattern)
+                   for field, pattern in where.items()
+                   if field.startswith(METADATA_PREFIX)):
+                servers.append(server)
+
+        servers.sort(key=lambda server: [_field(server, field)
+                                         for field in sort])
+        return servers
+
+
+def _field(server, field):
+    if field.startswith(METADATA_PREFIX):
+        value = server['metadata'].get(field[len(METADATA_PREFIX):])
+    else:
+        value = server[field]
+    return "" if value is None else unicode(value)
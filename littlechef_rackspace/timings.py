@@ -0,0 +1,173 @@
+import math
+import os
+import time
+from journal import STATE_DIRECTORY, connect_state_db
+
+# Dimensions dropped, last first, when there isn't enough exact history
+KEYS = ["region", "flavor", "image", "template"]
+
+# Phases of a create or rebuild, in order
+BUILD = "build"
+REBUILD = "rebuild"
+DEPLOY = "deploy"
+
+
+def nearest_rank(samples, percent):
+    rank = int(math.ceil(percent / 100.0 * len(samples)))
+    return samples[min(max(rank, 1), len(samples)) - 1]
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{0}h{1:02d}m{2:02d}s".format(hours, minutes, seconds)
+    if minutes:
+        return "{0}m{1:02d}s".format(minutes, seconds)
+    return "{0}s".format(seconds)
+
+
+class TimingStore(object):
+
+    """
+    Local SQLite history of how long each phase of an operation took,
+    keyed by region, flavor, image and template.
+    """
+
+    def __init__(self, path=None, min_samples=5):
+        self.path = path or os.path.join(STATE_DIRECTORY, "timings.db")
+        self.min_samples = min_samples
+
+    def _connect(self):
+        return connect_state_db(self.path, self._create_schema)
+
+    def _create_schema(self, db):
+        db.execute("CREATE TABLE IF NOT EXISTS timings ("
+                   "phase TEXT NOT NULL, "
+                   "seconds REAL NOT NULL, "
+                   "region TEXT, "
+                   "flavor TEXT, "
+                   "image TEXT, "
+                   "template TEXT, "
+                   "recorded REAL NOT NULL)")
+
+        columns = [row[1] for row in db.execute("PRAGMA table_info(timings)")]
+        if "template" not in columns:
+            # Recorded before templates were
+            db.execute("ALTER TABLE timings ADD COLUMN template TEXT")
+
+    def record(self, phase, seconds, region=None, flavor=None, image=None,
+               template=None):
+        db = self._connect()
+        try:
+            db.execute("INSERT INTO timings (phase, seconds, region, flavor, "
+                       "image, template, recorded) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (phase, seconds, region, flavor, image, template,
+                        time.time()))
+            db.commit()
+        finally:
+            db.close()
+
+    def samples(self, phase, **keys):
+        """
+        Durations recorded for `phase`, from the most specific set of
+        keys that has at least min_samples entries
+        """
+
+        db = self._connect()
+        try:
+            used_keys = [key for key in KEYS if keys.get(key)]
+            while True:
+                query = "SELECT seconds FROM timings WHERE phase = ?"
+                params = [phase]
+                for key in used_keys:
+                    query += " AND {0} = ?".format(key)
+                    params.append(keys[key])
+
+                samples = [row[0] for row in db.execute(query, params)]
+                if len(samples) >= self.min_samples or not used_keys:
+                    return sorted(samples)
+                used_keys.pop()
+        finally:
+            db.close()
+
+    def percentile(self, phase, percent, **keys):
+        """
+        Nearest-rank percentile of a phase's duration, or None if there
+        isn't enough history
+        """
+
+        samples = self.samples(phase, **keys)
+        if len(samples) < self.min_samples:
+            return None
+
+        return nearest_rank(samples, percent)
+
+    def estimate(self, phases, count=1, concurrency=1, **keys):
+        """
+        Estimate the wall time of running `phases` one after the other on
+        `count` servers, `concurrency` at a time, from whatever history
+        there is.  With a windowed run, the critical path is one window
+        slot: ceil(count / concurrency) servers in sequence.
+        """
+
+        estimate = {
+            'phases': [],
+            'servers': count,
+            'concurrency': concurrency,
+            'sequence': int(math.ceil(count / float(max(concurrency, 1)))),
+            'p50': None,
+            'p90': None,
+        }
+
+        per_server = {'p50': 0, 'p90': 0}
+        for phase in phases:
+            samples = self.samples(phase, **keys)
+            phase_estimate = {'phase': phase, 'samples': len(samples),
+                              'p50': None, 'p90': None}
+            if samples:
+                for percent in (50, 90):
+                    key = 'p{0}'.format(percent)
+                    phase_estimate[key] = nearest_rank(samples, percent)
+                    if per_server[key] is not None:
+                        per_server[key] += phase_estimate[key]
+            else:
+                per_server = {'p50': None, 'p90': None}
+            estimate['phases'].append(phase_estimate)
+
+        for key, seconds in per_server.items():
+            if seconds is not None:
+                estimate[key] = seconds * estimate['sequence']
+
+        return estimate
+
+    def describe(self, estimate, progress):
+        """
+        Write out an estimate as returned by estimate()
+        """
+
+        progress.write("Estimate from past runs:\n")
+        for phase in estimate['phases']:
+            if not phase['samples']:
+                progress.write("  {0:<10}no history\n".format(phase['phase']))
+                continue
+            progress.write("  {0:<10}p50 {1:<10}p90 {2:<10}({3} samples)\n"
+                           .format(phase['phase'],
+                                   format_duration(phase['p50']),
+                                   format_duration(phase['p90']),
+                                   phase['samples']))
+
+        path = " -> ".join(phase['phase'] for phase in estimate['phases'])
+        if estimate['sequence'] > 1:
+            path += (" on {0} servers in turn ({1} servers, {2} at a time)"
+                     .format(estimate['sequence'], estimate['servers'],
+                             estimate['concurrency']))
+        progress.write("  Critical path: {0}\n".format(path))
+
+        if estimate['p50'] is None:
+            progress.write("  Wall time: unknown (not enough history)\n")
+        else:
+            progress.write("  Wall time: about {0} (p90 {1})\n".format(
+                format_duration(estimate['p50']),
+                format_duration(estimate['p90'])))
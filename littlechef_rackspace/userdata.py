@@ -0,0 +1,188 @@
+import gzip
+import hashlib
+import hmac
+import os
+import pipes
+import tarfile
+import urlparse
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import littlechef
+from littlechef import chef
+from littlechef import runner as lc
+from journal import STATE_DIRECTORY, ensure_directory
+
+# --bootstrap-mode: Chef deployed from here over SSH, or run by the server
+# itself at first boot from its user data
+SSH = "ssh"
+USER_DATA = "user-data"
+BOOTSTRAP_MODES = [SSH, USER_DATA]
+
+BUNDLE_PATH = os.path.join(STATE_DIRECTORY, "kitchen.tar.gz")
+
+# What chef-solo needs from the kitchen, as littlechef uploads it, besides
+# littlechef.cookbook_paths (which littlechef.cfg can change)
+KITCHEN_DIRECTORIES = ["roles", "data_bags", "environments"]
+
+# Where a gzip header's 4 byte modification time starts
+GZIP_MTIME_OFFSET = 4
+
+# Seconds a signed bundle URL stays valid for: long enough for a slow
+# build to boot and fetch it
+BUNDLE_URL_LIFETIME = 6 * 60 * 60
+
+INSTALL_CHEF = ("command -v chef-solo >/dev/null || "
+                "curl -fsSL https://www.opscode.com/chef/install.sh | bash")
+
+BOOTSTRAP_SCRIPT = """#!/bin/sh
+# Written by littlechef-rackspace: run chef-solo for {name} at first boot
+exec >>/var/log/littlechef-rackspace-bootstrap.log 2>&1
+
+bootstrap() {{
+    set -e
+    {install_chef}
+    mkdir -p {node_work_path}/cache /etc/chef
+    curl -fsSL --retry 5 -o {bundle} {bundle_url}
+    echo {bundle_check} | sha256sum -c -
+    tar -xzf {bundle} -C {node_work_path}
+    cat >/etc/chef/solo.rb <<'LITTLECHEF_RACKSPACE_SOLO_RB'
+{solo_rb}
+LITTLECHEF_RACKSPACE_SOLO_RB
+    cat >/etc/chef/node.json <<'LITTLECHEF_RACKSPACE_NODE_JSON'
+{node_json}
+LITTLECHEF_RACKSPACE_NODE_JSON
+    chef-solo -c /etc/chef/solo.rb -j /etc/chef/node.json
+}}
+
+(bootstrap)
+status=$?
+if [ $status -eq 0 ]; then result=done; else result=failed; fi
+echo "Bootstrap $result (exit status $status)"
+{report}
+exit $status
+"""
+
+REPORT = ("printf '{{\"name\": %s, \"status\": \"%s\", \"exit_status\": %d}}' "
+          "{name_json} $result $status | curl -fsS -m 30 --retry 5 -X POST "
+          "-H 'Content-Type: application/json' -d @- {callback_url} || true")
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as bundle:
+        for block in iter(lambda: bundle.read(1024 * 1024), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_bundle(path=None, directories=None):
+    """
+    Pack the kitchen (cookbooks, roles, data bags including littlechef's
+    node data bag, and environments) into a gzipped tarball for servers
+    to fetch.  The same kitchen always packs to the same bytes; returns the
+    bundle's sha256.
+    """
+
+    path = path or BUNDLE_PATH
+    ensure_directory(path)
+
+    # Python 2.6's tarfile.add has no filter, hence gettarinfo/addfile
+    def add(bundle, member_path):
+        tarinfo = bundle.gettarinfo(member_path)
+        tarinfo.mtime = 0
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = "root"
+        if tarinfo.isreg():
+            with open(member_path, "rb") as member:
+                bundle.addfile(tarinfo, member)
+        else:
+            bundle.addfile(tarinfo)
+
+    chef.build_node_data_bag()
+    try:
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as bundle_file:
+            compressed = gzip.GzipFile(filename="", mode="wb",
+                                       fileobj=bundle_file)
+            bundle = tarfile.open(fileobj=compressed, mode="w")
+            for kitchen_directory in directories or (
+                    littlechef.cookbook_paths + KITCHEN_DIRECTORIES):
+                for root, subdirectories, files in os.walk(kitchen_directory):
+                    subdirectories.sort()
+                    add(bundle, root)
+                    for name in sorted(files):
+                        add(bundle, os.path.join(root, name))
+            bundle.close()
+            compressed.close()
+            # Zero the gzip header's timestamp (GzipFile only takes an
+            # mtime from Python 2.7)
+            bundle_file.seek(GZIP_MTIME_OFFSET)
+            bundle_file.write("\0" * 4)
+        os.rename(temp_path, path)
+    finally:
+        chef.remove_local_node_data_bag()
+
+    return file_sha256(path)
+
+
+def temp_url(url, key, expires):
+    """
+    url signed as a Cloud Files (Swift) TempURL with the account's
+    Temp-URL-Key, so a server can GET it until `expires` (a Unix time)
+    without credentials
+    """
+
+    path = urlparse.urlsplit(url).path
+    signature = hmac.new(key, "GET\n{0}\n{1}".format(int(expires), path),
+                         hashlib.sha1).hexdigest()
+    return "{0}{1}temp_url_sig={2}&temp_url_expires={3}".format(
+        url, "&" if "?" in url else "?", signature, int(expires))
+
+
+def solo_rb(node, node_work_path):
+    """
+    /etc/chef/solo.rb as littlechef writes it
+    """
+
+    cookbook_paths = ", ".join('"{0}/{1}"'.format(node_work_path, path)
+                               for path in reversed(littlechef.cookbook_paths))
+    return "\n".join([
+        'file_cache_path "{0}/cache"'.format(node_work_path),
+        "cookbook_path [{0}]".format(cookbook_paths),
+        'role_path "{0}/roles"'.format(node_work_path),
+        'data_bag_path "{0}/data_bags"'.format(node_work_path),
+        'environment_path "{0}/environments"'.format(node_work_path),
+        'environment "{0}"'.format(node.get('chef_environment',
+                                            '_default'))])
+
+
+def bootstrap_script(node, bundle_url, bundle_sha256, callback_url=None,
+                     install_chef=True, node_work_path=None):
+    """
+    A user data script (run by cloud-init at first boot) that installs
+    Chef, fetches and checks the kitchen bundle, and runs chef-solo with
+    the node's data.  The outcome is POSTed as JSON to callback_url.
+    """
+
+    node_work_path = (node_work_path or lc.env.node_work_path).rstrip("/")
+    bundle = "{0}/kitchen.tar.gz".format(node_work_path)
+
+    report = ""
+    if callback_url:
+        report = REPORT.format(
+            name_json=pipes.quote(json.dumps(node['name'])),
+            callback_url=pipes.quote(callback_url))
+
+    return BOOTSTRAP_SCRIPT.format(
+        name=node['name'],
+        install_chef=INSTALL_CHEF if install_chef else ":",
+        node_work_path=pipes.quote(node_work_path),
+        bundle=pipes.quote(bundle),
+        bundle_url=pipes.quote(bundle_url),
+        bundle_check=pipes.quote("{0}  {1}".format(bundle_sha256, bundle)),
+        solo_rb=solo_rb(node, node_work_path),
+        node_json=json.dumps(node, indent=4, sort_keys=True,
+                             separators=(",", ": ")),
+        report=report)
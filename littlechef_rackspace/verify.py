@@ -0,0 +1,152 @@
+import os
+import socket
+import paramiko
+from littlechef import runner as lc
+from parallel import run_windowed
+
+# chef-solo leaves this in its cache when a run fails, and removes it
+# after a successful one
+CHEF_CHECK = ("test -e /etc/chef/solo.rb && "
+              "test ! -e {node_work_path}/cache/failed-run-data.json")
+
+CHEF = "chef"
+SSH = "ssh"
+
+
+class CheckResult(object):
+
+    """
+    Outcome of one check on one server
+    """
+
+    def __init__(self, name, passed, detail=None):
+        self.name = name
+        self.passed = passed
+        self.detail = detail
+
+    def __repr__(self):
+        return '<CheckResult name={0}, passed={1}>'.format(self.name,
+                                                           self.passed)
+
+
+def port_check_name(port):
+    return "port:{0}".format(port)
+
+
+class Verifier(object):
+
+    """
+    Checks that servers converged: over one SSH connection per server, that
+    the last Chef run succeeded and each health command exits 0, and from
+    here, that each port accepts connections.
+    """
+
+    def __init__(self, key_filename, commands=None, ports=None, timeout=10,
+                 user="root", node_work_path=None):
+        self.key_filename = os.path.expanduser(key_filename)
+        self.commands = commands or []
+        self.ports = [int(port) for port in ports or []]
+        # Seconds allowed to connect and for each command
+        self.timeout = timeout
+        self.user = user
+        # Where littlechef puts the kitchen on servers (read from
+        # littlechef.cfg when not given)
+        self.node_work_path = node_work_path
+
+    def check_names(self):
+        return ([SSH, CHEF] + list(self.commands) +
+                [port_check_name(port) for port in self.ports])
+
+    def _node_work_path(self):
+        if self.node_work_path is None:
+            # littlechef only reads littlechef.cfg when one of its own
+            # commands runs
+            lc._readconfig()
+            self.node_work_path = lc.env.node_work_path
+        return self.node_work_path
+
+    def _connect(self, address):
+        client = paramiko.SSHClient()
+        # Rebuilt servers come back with new host keys
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(address, username=self.user,
+                       key_filename=self.key_filename, timeout=self.timeout,
+                       allow_agent=False, look_for_keys=False)
+        return client
+
+    def _run(self, client, command):
+        """
+        The exit status and output of a command on the server
+        """
+
+        _, stdout, stderr = client.exec_command(command,
+                                                timeout=self.timeout)
+        output = stdout.read() + stderr.read()
+        return stdout.channel.recv_exit_status(), output.strip()
+
+    def _port_open(self, address, port):
+        try:
+            socket.create_connection((address, port), self.timeout).close()
+            return True
+        except socket.error:
+            return False
+
+    def verify(self, address):
+        """
+        A CheckResult per check name, in order; if SSH fails the Chef and
+        command checks fail with it
+        """
+
+        results = []
+        remote = [(CHEF, CHEF_CHECK.format(
+            node_work_path=self._node_work_path()))]
+        remote.extend((command, command) for command in self.commands)
+
+        try:
+            client = self._connect(address)
+        except Exception as e:
+            results.append(CheckResult(SSH, False, str(e) or repr(e)))
+            results.extend(CheckResult(name, False, "no SSH connection")
+                           for name, _ in remote)
+        else:
+            results.append(CheckResult(SSH, True))
+            try:
+                for name, command in remote:
+                    try:
+                        status, output = self._run(client, command)
+                    except Exception as e:
+                        results.append(CheckResult(name, False,
+                                                   str(e) or repr(e)))
+                        continue
+                    detail = None
+                    if status != 0:
+                        detail = "exited {0}".format(status)
+                        if output:
+                            detail += ": " + output.splitlines()[-1]
+                    results.append(CheckResult(name, status == 0, detail))
+            finally:
+                client.close()
+
+        for port in self.ports:
+            passed = self._port_open(address, port)
+            results.append(CheckResult(
+                port_check_name(port), passed,
+                None if passed else "not accepting connections"))
+
+        return results
+
+    def verify_servers(self, servers, concurrency=10):
+        """
+        Verify servers (as returned by list_servers) at most `concurrency`
+        at a time; returns a run_windowed Result per server
+        """
+
+        # Once, before the threads start
+        self._node_work_path()
+
+        def verify(server):
+            if not server['public_ipv4']:
+                raise Exception("no public IPv4 address")
+            return self.verify(server['public_ipv4'])
+
+        return run_windowed(verify, servers, window=concurrency)
@@ -18,10 +18,12 @@ setup(
     install_requires=[
         "apache-libcloud==0.14.1",
         "littlechef==1.6.1",
+        # verify's SSH checks; the range fabric 1.x accepts
+        "paramiko>=1.10,<3.0",
         "PyYAML==3.10",
     ],
     packages=['littlechef_rackspace'],
-    scripts=['fix-rackspace'],
+    scripts=['fix-rackspace', 'fix-rackspace-client'],
     test_suite='nose.collector',
     classifiers=[
         "Programming Language :: Python",
@@ -5,8 +5,12 @@ from libcloud.compute.types import Provider, NodeState
 from libcloud.compute.drivers.openstack import OpenStackNetwork
 
 import mock
-from littlechef_rackspace.api import RackspaceApi
+from littlechef_rackspace.api import (RackspaceApi, BuildFailed,
+                                      BuildTimeout)
 from littlechef_rackspace.lib import Host
+from littlechef_rackspace.metrics import Metrics
+from littlechef_rackspace.poller import NodePoller
+from littlechef_rackspace.ratelimit import QuotaExceeded
 
 
 class RackspaceApiTest(unittest.TestCase):
@@ -28,6 +32,25 @@ class RackspaceApiTest(unittest.TestCase):
             private_ips=[],
             state=NodeState.RUNNING,
             driver=None)
+        self.error_node = Node(
+            id='id',
+            name='name',
+            public_ips=[],
+            private_ips=[],
+            state=NodeState.UNKNOWN,
+            driver=None)
+        self.limits = {
+            'limits': {
+                'rate': [{
+                    'uri': '/servers',
+                    'regex': '^/servers',
+                    'limit': [{'verb': 'POST', 'value': 10,
+                               'remaining': 10, 'unit': 'MINUTE'}]
+                }],
+                'absolute': {'maxTotalInstances': 100,
+                             'totalInstancesUsed': 0}
+            }
+        }
 
     def test_list_images_instantiates_driver_with_user_passwd_and_region(self):
         with mock.patch("littlechef_rackspace.api.get_driver") as get_driver:
@@ -38,6 +61,24 @@ class RackspaceApiTest(unittest.TestCase):
 
             driver.assert_any_call(self.username, self.key, region='dfw')
 
+    def test_driver_is_reused_within_a_thread(self):
+        with mock.patch("littlechef_rackspace.api.get_driver") as get_driver:
+            driver = get_driver.return_value
+
+            api = self._get_api('dfw')
+            api.list_images()
+            api.list_flavors()
+
+            self.assertEquals(1, driver.call_count)
+
+    def test_authenticate_fetches_service_catalog(self):
+        with mock.patch("littlechef_rackspace.api.get_driver") as get_driver:
+            api = self._get_api('dfw')
+            api.authenticate()
+
+        connection = get_driver.return_value.return_value.connection
+        connection.get_service_catalog.assert_called_once_with()
+
     def test_list_images_instantiates_dfw_driver(self):
         with mock.patch("littlechef_rackspace.api.get_driver") as get_driver:
             api = self._get_api('dfw')
@@ -48,6 +89,7 @@ class RackspaceApiTest(unittest.TestCase):
     def _get_api_with_mocked_conn(self, conn):
         api = self._get_api('ord')
         api._get_conn = mock.Mock(return_value=conn)
+        conn.connection.request.return_value.object = self.limits
 
         self.counter = 0
 
@@ -65,18 +107,21 @@ class RackspaceApiTest(unittest.TestCase):
         conn = mock.Mock()
         api = self._get_api_with_mocked_conn(conn)
 
-        lc_image1 = NodeImage('abc-def', 'Image 1', None)
+        lc_image1 = NodeImage('abc-def', 'Image 1', None,
+                              extra={'created': '2013-03-20T14:34:12Z'})
         lc_image2 = NodeImage('fge-hgi', 'Image 2', None)
 
         conn.list_images.return_value = [lc_image1, lc_image2]
 
         self.assertEquals([{
             'id': lc_image1.id,
-            'name': lc_image1.name
+            'name': lc_image1.name,
+            'created': '2013-03-20T14:34:12Z'
             },
             {
                 'id': lc_image2.id,
-                'name': lc_image2.name
+                'name': lc_image2.name,
+                'created': None
             }],
             api.list_images())
 
@@ -84,21 +129,32 @@ class RackspaceApiTest(unittest.TestCase):
         conn = mock.Mock()
         api = self._get_api_with_mocked_conn(conn)
 
-        lc_size1 = NodeSize('1', '256 MB image', None, None, None, None, None)
-        lc_size2 = NodeSize('2', '512 MB image', None, None, None, None, None)
+        lc_size1 = NodeSize('1', '256 MB image', 256, None, None, None, None)
+        lc_size2 = NodeSize('2', '512 MB image', 512, None, None, None, None)
 
         conn.list_sizes.return_value = [lc_size1, lc_size2]
 
         self.assertEquals([{
             'id': lc_size1.id,
-            'name': lc_size1.name
+            'name': lc_size1.name,
+            'ram': 256
             },
             {
                 'id': lc_size2.id,
-                'name': lc_size2.name
+                'name': lc_size2.name,
+                'ram': 512
             }],
             api.list_flavors())
 
+    def test_headroom_from_absolute_limits(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        self.limits['limits']['absolute'].update({'totalInstancesUsed': 97,
+                                                  'maxTotalRAMSize': 65536,
+                                                  'totalRAMUsed': 61440})
+
+        self.assertEquals({'instances': 3, 'ram': 4096}, api.headroom())
+
     def test_list_servers_returns_server_information(self):
         conn = mock.Mock()
         api = self._get_api_with_mocked_conn(conn)
@@ -106,7 +162,7 @@ class RackspaceApiTest(unittest.TestCase):
         lc_node1 = Node('1', 'server1', None, ['50.50.50.50'], [], None)
         lc_node2 = Node('2', 'server2', None, ['51.51.51.51'], [], None)
 
-        conn.list_nodes.return_value = [lc_node1, lc_node2]
+        self._servers(conn, [lc_node1, lc_node2])
 
         self.assertEquals([{
             'id': lc_node1.id,
@@ -156,6 +212,39 @@ class RackspaceApiTest(unittest.TestCase):
         self.assertEquals({"/root/.ssh/authorized_keys": public_key},
                           call_kwargs['ex_files'])
 
+    def test_creates_node_with_user_data_on_config_drive(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        limits = conn.connection.request.return_value
+        posted = []
+
+        def request(path, method='GET', data=None, params=None):
+            if path == "/servers" and method == 'POST':
+                posted.append(data['server'])
+                return mock.Mock(object={'server': {'id': 'new-id',
+                                                    'adminPass': 'pw'}})
+            if path == "/servers/new-id":
+                return mock.Mock(object={'server': {'id': 'new-id'}})
+            return limits
+
+        conn.connection.request.side_effect = request
+        conn._create_args_to_params.return_value = {'name': 'new-node'}
+        conn._to_node.return_value = self.active_node
+
+        api.create_node(name="new-node", image="some image",
+                        flavor="2", public_key_file=StringIO("some key"),
+                        user_data="#!/bin/sh\n")
+
+        self.assertFalse(conn.create_node.called)
+        call_kwargs = conn._create_args_to_params.call_args[1]
+        self.assertEquals("#!/bin/sh\n", call_kwargs['ex_userdata'])
+        self.assertEquals({"/root/.ssh/authorized_keys": "some key"},
+                          call_kwargs['ex_files'])
+        self.assertEquals([{'name': 'new-node', 'config_drive': True}],
+                          posted)
+        self.assertEquals({'id': 'new-id', 'adminPass': 'pw'},
+                          conn._to_node.call_args[0][0])
+
     def test_creates_node_with_networks(self):
         conn = mock.Mock()
         api = self._get_api_with_mocked_conn(conn)
@@ -251,7 +340,7 @@ class RackspaceApiTest(unittest.TestCase):
         public_key_io = StringIO(public_key)
 
         rebuild_node = Node('1', 'server1', None, ['50.50.50.50'], [], None)
-        conn.list_nodes.return_value = [rebuild_node]
+        self._servers(conn, [rebuild_node])
 
         with mock.patch('littlechef_rackspace.api.time'):
             api.rebuild_node(name='server1',
@@ -272,7 +361,7 @@ class RackspaceApiTest(unittest.TestCase):
         progress = StringIO()
 
         rebuild_node = Node('1', 'server1', None, ['50.50.50.50'], [], None)
-        conn.list_nodes.return_value = [rebuild_node]
+        self._servers(conn, [rebuild_node])
 
         with mock.patch('littlechef_rackspace.api.time'):
             api.rebuild_node(name='server1',
@@ -288,5 +377,472 @@ class RackspaceApiTest(unittest.TestCase):
                 "Node active! (host: 50.2.3.4)"
             ], progress.getvalue().splitlines())
 
+    def test_seeds_rate_limiter_from_account_limits(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        conn.list_images.return_value = []
+
+        api.list_images()
+        api.list_images()
+
+        conn.connection.request.assert_called_once_with("/limits")
+        self.assertTrue(api.rate_limiter.configured)
+
+    def test_reloads_account_limits_when_they_expire(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        api.rate_limiter.refresh_after = 0
+        conn.list_images.return_value = []
+
+        api.list_images()
+        api.list_images()
+
+        self.assertEquals([mock.call("/limits")] * 2,
+                          conn.connection.request.call_args_list)
+
+    def test_keeps_limits_when_reloading_them_fails(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        api.rate_limiter.refresh_after = 0
+        conn.list_images.return_value = []
+
+        api.list_images()
+        conn.connection.request.side_effect = Exception("503")
+        api.list_images()
+
+        self.assertEquals(100, api.headroom()['instances'])
+
+    def test_create_node_releases_quota_when_create_fails(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        conn.create_node.side_effect = Exception("400 Bad Request")
+
+        with self.assertRaises(Exception):
+            api.create_node(name="some name",
+                            image="some image",
+                            flavor="some flavor",
+                            public_key_file=StringIO("some public key"))
+
+        self.assertEquals(0, api.rate_limiter.absolute['totalInstancesUsed'])
+
+    def test_create_node_fails_when_instance_quota_is_used(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        self.limits['limits']['absolute']['totalInstancesUsed'] = 100
+
+        with self.assertRaises(QuotaExceeded):
+            api.create_node(name="some name",
+                            image="some image",
+                            flavor="some flavor",
+                            public_key_file=StringIO("some public key"))
+
+        self.assertEquals(0, len(conn.create_node.call_args_list))
+
+    def test_create_node_retries_over_limit_responses(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        api.rate_limiter.hold = mock.Mock()
+        conn.create_node.side_effect = [
+            Exception("413 Request Entity Too Large retryAfter: 2"),
+            self.active_node]
+
+        host = api.create_node(name="some name",
+                               image="some image",
+                               flavor="some flavor",
+                               public_key_file=StringIO("some public key"))
+
+        api.rate_limiter.hold.assert_called_once_with(2)
+        self.assertEquals(host.ip_address, '50.2.3.4')
+
+    def test_create_node_journals_submitted_node(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        conn.create_node.return_value = self.active_node
+        journal = mock.Mock()
+
+        api.create_node(name="some name",
+                        image="some image",
+                        flavor="some flavor",
+                        public_key_file=StringIO("some public key"),
+                        journal=journal)
+
+        journal.record.assert_called_once_with("create", "some name",
+                                               "submitted",
+                                               node_id=self.active_node.id)
+
+    def test_wait_for_node_returns_host_once_active(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+
+        with mock.patch('littlechef_rackspace.api.time'):
+            host = api.wait_for_node('id')
+
+        self.assertEquals(Host(name='name', ip_address='50.2.3.4'), host)
+
+    def test_host_carries_private_ipv4_addresses(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        self.active_node.private_ips = ['fd00::1', '10.176.1.2']
+
+        with mock.patch('littlechef_rackspace.api.time'):
+            host = api.wait_for_node('id')
+
+        self.assertEquals(['10.176.1.2'], host.private_addresses)
+
+    def test_shared_polling_waits_on_one_listing(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        api.poller = NodePoller(api._list_nodes_to_poll, interval=0)
+        conn.ex_get_node_details.side_effect = None
+        conn.ex_get_node_details.return_value = self.pending_node
+        self._servers(conn, [], [[self.active_node]])
+
+        host = api.wait_for_node('id')
+
+        self.assertEquals(Host(name='name', ip_address='50.2.3.4'), host)
+        # The node was missing from the first listing
+        self.assertEquals(2, conn.ex_get_node_details.call_count)
+        # Then only its changes were listed
+        self.assertEquals(2, len(self.listings))
+        self.assertEquals(1, len(self.changes_since))
+
+    def test_create_node_fails_when_node_goes_into_error(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        conn.create_node.return_value = self.pending_node
+        conn.ex_get_node_details.side_effect = None
+        conn.ex_get_node_details.return_value = self.error_node
+
+        with mock.patch('littlechef_rackspace.api.time'):
+            with self.assertRaises(BuildFailed) as cm:
+                api.create_node(name="some name",
+                                image="some image",
+                                flavor="some flavor",
+                                public_key_file=StringIO("some key"))
+
+        self.assertEquals('id', cm.exception.node_id)
+
+    def test_build_failures_and_api_latency_are_measured(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        api.metrics = mock.Mock(spec=Metrics)
+        api.metrics.phase.side_effect = Metrics().phase
+        conn.create_node.__name__ = 'create_node'
+        conn.create_node.return_value = self.pending_node
+        conn.ex_get_node_details.side_effect = None
+        conn.ex_get_node_details.return_value = self.error_node
+
+        with mock.patch('littlechef_rackspace.api.time'):
+            with self.assertRaises(BuildFailed):
+                api.create_node(name="some name",
+                                image="some image",
+                                flavor="some flavor",
+                                public_key_file=StringIO("some key"))
+
+        api.metrics.phase.assert_called_once_with("build", operation="create")
+        self.assertIn(('api_request_seconds', 'create_node'),
+                      [(c[0][0], c[1]['call'])
+                       for c in api.metrics.observe.call_args_list])
+
+    def test_create_node_times_out(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        api.build_timeout = 60
+        clock = iter([0, 30, 90])
+        api.clock = lambda: next(clock)
+        conn.create_node.return_value = self.pending_node
+        conn.ex_get_node_details.side_effect = None
+        conn.ex_get_node_details.return_value = self.pending_node
+
+        with mock.patch('littlechef_rackspace.api.time'):
+            with self.assertRaises(BuildTimeout):
+                api.create_node(name="some name",
+                                image="some image",
+                                flavor="some flavor",
+                                public_key_file=StringIO("some key"))
+
+    def test_create_node_replaces_failed_build(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        api.replace_failed = 1
+        conn.create_node.side_effect = [self.error_node, self.active_node]
+
+        with mock.patch('littlechef_rackspace.api.time'):
+            host = api.create_node(name="some name",
+                                   image="some image",
+                                   flavor="some flavor",
+                                   public_key_file=StringIO("some key"))
+
+        conn.destroy_node.assert_called_once_with(self.error_node)
+        self.assertEquals(2, len(conn.create_node.call_args_list))
+        self.assertEquals("some key",
+                          conn.create_node.call_args_list[1][1]['ex_files']
+                          ["/root/.ssh/authorized_keys"])
+        self.assertEquals('50.2.3.4', host.ip_address)
+
+    def test_rebuild_notices_rebuild_that_finished_between_polls(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        rebuild_node = Node('1', 'server1', NodeState.RUNNING,
+                            ['50.50.50.50'], [], None,
+                            extra={'updated': '2014-01-01T00:00:00Z'})
+        rebuilt_node = Node('1', 'server1', NodeState.RUNNING,
+                            ['50.50.50.50'], [], None,
+                            extra={'updated': '2014-01-01T00:04:00Z'})
+        self._servers(conn, [rebuild_node])
+        conn.ex_get_node_details.side_effect = None
+        conn.ex_get_node_details.return_value = rebuilt_node
+
+        with mock.patch('littlechef_rackspace.api.time'):
+            host = api.rebuild_node(name='server1',
+                                    image="image-id",
+                                    public_key_file=StringIO("some key"))
+
+        self.assertEquals('50.50.50.50', host.ip_address)
+        self.assertEquals(1, len(conn.ex_get_node_details.call_args_list))
+
+    def test_wait_for_rebuild_waits_for_it_to_begin(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        old_node = Node('1', 'server1', NodeState.RUNNING,
+                        ['50.50.50.50'], [], None,
+                        extra={'updated': '2014-01-01T00:00:00Z'})
+        rebuilding_node = Node('1', 'server1', NodeState.PENDING,
+                               ['50.50.50.50'], [], None)
+        rebuilt_node = Node('1', 'server1', NodeState.RUNNING,
+                            ['50.50.50.50'], [], None,
+                            extra={'updated': '2014-01-01T00:04:00Z'})
+        conn.ex_get_node_details.side_effect = [old_node, rebuilding_node,
+                                                rebuilt_node]
+
+        with mock.patch('littlechef_rackspace.api.time'):
+            host = api.wait_for_rebuild('1', '2014-01-01T00:00:00Z')
+
+        self.assertEquals('50.50.50.50', host.ip_address)
+        self.assertEquals(3, len(conn.ex_get_node_details.call_args_list))
+
+    def test_hedged_create_uses_first_active_node_and_deletes_other(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        clock = iter([0, 10, 120, 130, 140])
+        api.clock = lambda: next(clock)
+        slow_node = Node('slow', 'name', NodeState.PENDING, [], [], None)
+        spare_node = Node('spare', 'name', NodeState.PENDING, [], [], None)
+        active_spare = Node('spare', 'name', NodeState.RUNNING,
+                            ['50.2.3.5'], [], None)
+        conn.create_node.side_effect = [slow_node, spare_node]
+        conn.ex_get_node_details.side_effect = lambda node_id: (
+            active_spare if node_id == 'spare' else slow_node)
+        journal = mock.Mock()
+
+        with mock.patch('littlechef_rackspace.api.time'):
+            host = api.create_node(name="name",
+                                   image="some image",
+                                   flavor="some flavor",
+                                   public_key_file=StringIO("some key"),
+                                   journal=journal,
+                                   hedge_after=60)
+
+        self.assertEquals('50.2.3.5', host.ip_address)
+        conn.destroy_node.assert_called_once_with(slow_node)
+        journal.record.assert_called_with("create", "name", "submitted",
+                                          node_id="spare",
+                                          details={'spare_for': 'slow'})
+
+    def test_hedged_create_journals_spare_when_submitted(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        clock = iter([0, 10, 120, 130, 140])
+        api.clock = lambda: next(clock)
+        slow_node = Node('slow', 'name', NodeState.PENDING, [], [], None)
+        active_node = Node('slow', 'name', NodeState.RUNNING,
+                           ['50.2.3.4'], [], None)
+        spare_node = Node('spare', 'name', NodeState.PENDING, [], [], None)
+        conn.create_node.side_effect = [slow_node, spare_node]
+        conn.ex_get_node_details.side_effect = lambda node_id: (
+            active_node if node_id == 'slow' else spare_node)
+        journal = mock.Mock()
+
+        with mock.patch('littlechef_rackspace.api.time'):
+            host = api.create_node(name="name",
+                                   image="some image",
+                                   flavor="some flavor",
+                                   public_key_file=StringIO("some key"),
+                                   journal=journal,
+                                   hedge_after=60)
+
+        self.assertEquals('50.2.3.4', host.ip_address)
+        conn.destroy_node.assert_called_once_with(spare_node)
+        self.assertEquals([
+            mock.call("create", "name", "submitted", node_id="slow"),
+            mock.call("create", "name", "submitted", node_id="spare",
+                      details={'spare_for': 'slow'}),
+            mock.call("create", "name", "submitted", node_id="slow"),
+        ], journal.record.call_args_list)
+
+    def test_delete_nodes_waits_for_nodes_to_disappear(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        lc_node1 = Node('1', 'server1', NodeState.RUNNING, [], [], None)
+        lc_node2 = Node('2', 'server2', NodeState.RUNNING, [], [], None)
+        self._servers(conn, [lc_node1, lc_node2], [['1'], ['2']])
+        # Mock creates child attributes lazily, which isn't thread safe
+        conn.destroy_node = mock.Mock()
+
+        with mock.patch('littlechef_rackspace.api.time'):
+            failed = api.delete_nodes([{'id': '1', 'name': 'server1'},
+                                       {'id': '2', 'name': 'server2'}])
+
+        self.assertEquals([], failed)
+        self.assertEquals(['1', '2'], sorted(
+            c[0][0].id for c in conn.destroy_node.call_args_list))
+        self.assertEquals(3, len(self.listings))
+        self.assertEquals(2, len(self.changes_since))
+
+    def test_delete_nodes_returns_servers_that_could_not_be_deleted(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        conn.destroy_node.side_effect = Exception("404 Not Found")
+        self._servers(conn, [])
+
+        with mock.patch('littlechef_rackspace.api.time'):
+            failed = api.delete_nodes([{'id': '1', 'name': 'server1'}])
+
+        self.assertEquals([{'id': '1', 'name': 'server1'}], failed)
+
+    def test_servers_are_listed_once_then_by_changes(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        lc_node1 = Node('1', 'server1', NodeState.RUNNING, [], [], None)
+        lc_node2 = Node('2', 'server2', NodeState.PENDING, [], [], None)
+        lc_node3 = Node('3', 'server3', NodeState.PENDING, [], [], None)
+        self._servers(conn, [lc_node1, lc_node2], [['1', lc_node3]])
+
+        self.assertEquals(['1', '2'],
+                          [server['id'] for server in api.list_servers()])
+        self.assertEquals(['2', '3'],
+                          [server['id'] for server in api.list_servers()])
+        self.assertEquals(2, len(self.listings))
+        self.assertRegexpMatches(self.changes_since[0],
+                                 r"^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ$")
+
+    def test_servers_are_listed_a_page_at_a_time(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        api.page_size = 2
+        nodes = [Node(str(i), 'server{0}'.format(i), NodeState.RUNNING,
+                      [], [], None) for i in range(5)]
+        self._servers(conn, nodes)
+
+        self.assertEquals(5, len(api.list_servers()))
+        self.assertEquals([None, '1', '3'], [params.get('marker')
+                                             for params in self.listings])
+        self.assertEquals([2] * 3, [params['limit']
+                                    for params in self.listings])
+
+    def test_list_server_details(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        node = Node('1', 'web-n01', NodeState.RUNNING,
+                    ['2001:db8::1', '50.50.50.50'], ['10.1.2.3'], None,
+                    extra={'imageId': 'img-1', 'flavorId': '2',
+                           'metadata': {'role': 'web'}})
+        self._servers(conn, [node])
+
+        details, = api.list_server_details()
+
+        self.assertEquals('ord', details['region'])
+        self.assertEquals('ACTIVE', details['status'])
+        self.assertEquals('50.50.50.50', details['public_ipv4'])
+        self.assertEquals(['10.1.2.3'], details['private_ips'])
+        self.assertEquals(('img-1', '2'), (details['image'],
+                                           details['flavor']))
+        self.assertEquals({'role': 'web'}, details['metadata'])
+
+    def test_list_server_changes(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        node = Node('2', 'web-n02', NodeState.RUNNING, ['50.50.50.50'], [],
+                    None)
+        self._servers(conn, [], [[node, '1']])
+
+        changed, deleted = api.list_server_changes("2014-01-01T00:00:00Z")
+
+        self.assertEquals(['web-n02'], [server['name'] for server in changed])
+        self.assertEquals(['1'], deleted)
+        self.assertEquals(["2014-01-01T00:00:00Z"], self.changes_since)
+
+    def test_changes_since_listings_count_against_their_own_limit(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        self._servers(conn, [], [[]])
+        acquired = []
+        api.rate_limiter.acquire = lambda verb, uri, priority: \
+            acquired.append(uri)
+
+        api.list_server_changes("2014-01-01T00:00:00Z")
+
+        self.assertEquals(1, len(acquired))
+        self.assertTrue(acquired[0].startswith("/servers/detail?"))
+        self.assertIn("changes-since=2014-01-01T00%3A00%3A00Z", acquired[0])
+
+    def test_rename_node(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        conn.ex_set_server_name.return_value = Node(
+            'id-1', 'web-n01', NodeState.RUNNING, ['50.50.50.50'],
+            ['10.1.2.3'], None)
+
+        host = api.rename_node('id-1', 'web-n01')
+
+        node, name = conn.ex_set_server_name.call_args[0]
+        self.assertEquals(('id-1', 'web-n01'), (node.id, name))
+        self.assertEquals(Host(name='web-n01', ip_address='50.50.50.50'),
+                          host)
+        self.assertEquals('id-1', host.node_id)
+
+    def test_list_servers_includes_nodes_without_addresses(self):
+        conn = mock.Mock()
+        api = self._get_api_with_mocked_conn(conn)
+        self._servers(conn, [self.pending_node])
+
+        self.assertEquals([{'id': 'id', 'name': 'name',
+                            'public_ipv4': None}], api.list_servers())
+
+    def _servers(self, conn, nodes, changes=()):
+        """
+        Answer /servers/detail with nodes, and listings of changes-since
+        with each of changes in turn: changed nodes, or the ids of deleted
+        servers (paged like Nova)
+        """
+
+        self.listings = []
+        self.changes_since = []
+        changes = iter(changes)
+        limits = conn.connection.request.return_value
+
+        def server(node):
+            if isinstance(node, basestring):
+                return {'id': node, 'status': 'DELETED'}
+            return {'id': node.id, 'status': 'ACTIVE', 'node': node}
+
+        def request(path, params=None):
+            if path != "/servers/detail":
+                return limits
+            self.listings.append(params)
+            if 'changes-since' in params:
+                self.changes_since.append(params['changes-since'])
+                servers = [server(node) for node in next(changes)]
+            else:
+                servers = [server(node) for node in nodes]
+            ids = [listed['id'] for listed in servers]
+            start = ids.index(params['marker']) + 1 \
+                if 'marker' in params else 0
+            return mock.Mock(object={
+                'servers': servers[start:start + params['limit']]})
+
+        conn.connection.request.side_effect = request
+        conn._to_node.side_effect = lambda server: server['node']
+
     def _get_api(self, region):
         return RackspaceApi(self.username, self.key, region)
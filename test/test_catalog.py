@@ -0,0 +1,169 @@
+import os
+import shutil
+import tempfile
+import unittest2 as unittest
+import mock
+from littlechef_rackspace.api import RackspaceApi
+from littlechef_rackspace.catalog import Catalog, CatalogError, preflight
+
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.kitchen = tempfile.mkdtemp()
+        self.path = os.path.join(self.kitchen, "catalog-dfw.json")
+        self.now = 1000.0
+        self.api = mock.Mock(spec=RackspaceApi)
+        self.api.list_images.return_value = [
+            {'id': 'img-1', 'name': 'Ubuntu 12.04 LTS',
+             'created': '2013-01-10T10:00:00Z'},
+            {'id': 'img-2', 'name': 'CentOS 6.4',
+             'created': '2013-03-01T10:00:00Z'},
+            {'id': 'img-3', 'name': 'CentOS 6.4',
+             'created': '2013-04-01T10:00:00Z'},
+            {'id': 'img-5', 'name': 'Ubuntu 12.04 LTS (PVHVM)',
+             'created': '2013-02-10T10:00:00Z'},
+        ]
+        self.api.list_flavors.return_value = [
+            {'id': '2', 'name': '512MB Standard Instance', 'ram': 512},
+            {'id': '5', 'name': '4GB Standard Instance', 'ram': 4096},
+        ]
+        self.api.list_networks.return_value = [
+            {'id': '00000000-0000-0000-0000-000000000000', 'name': 'public',
+             'cidr': None},
+            {'id': 'net-1', 'name': 'backend', 'cidr': '192.168.0.0/24'},
+        ]
+        self.api.headroom.return_value = {'instances': 10, 'ram': 65536}
+        self.catalog = self._catalog()
+
+    def tearDown(self):
+        shutil.rmtree(self.kitchen)
+
+    def _catalog(self):
+        return Catalog(self.api, "dfw", path=self.path, max_age=60,
+                       clock=lambda: self.now)
+
+    def test_catalog_is_cached_between_runs(self):
+        self.catalog.resolve("images", "img-1")
+        self._catalog().resolve("images", "img-1")
+
+        self.assertEquals(1, self.api.list_images.call_count)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_stale_catalog_is_fetched_again(self):
+        self.catalog.resolve("images", "img-1")
+        self.now += 61
+        self._catalog().resolve("images", "img-1")
+
+        self.assertEquals(2, self.api.list_images.call_count)
+
+    def test_unknown_value_refreshes_once(self):
+        self.catalog.load()
+        catalog = self._catalog()
+        self.api.list_images.return_value.append({'id': 'img-4',
+                                                  'name': 'Debian 7'})
+
+        self.assertEquals('img-4', catalog.resolve("images", "Debian 7")['id'])
+        with self.assertRaises(CatalogError):
+            catalog.resolve("images", "Arch")
+        self.assertEquals(2, self.api.list_images.call_count)
+
+    def test_resolves_names(self):
+        self.assertEquals('5', self.catalog.resolve(
+            "flavors", "4GB Standard Instance")['id'])
+
+    def test_ambiguous_name(self):
+        with self.assertRaises(CatalogError) as cm:
+            self.catalog.resolve("images", "CentOS 6.4")
+
+        self.assertIn("img-2, img-3", str(cm.exception))
+
+    def test_unknown_name_suggests_close_matches(self):
+        with self.assertRaises(CatalogError) as cm:
+            self.catalog.resolve("images", "Ubuntu 12.04")
+
+        self.assertIn("did you mean 'Ubuntu 12.04 LTS'", str(cm.exception))
+
+    def test_resolves_glob_patterns(self):
+        self.assertEquals('img-5', self.catalog.resolve(
+            "images", "Ubuntu*(PVHVM)")['id'])
+
+    def test_exact_name_wins_over_glob_pattern(self):
+        self.api.list_images.return_value += [
+            {'id': 'img-6', 'name': 'Fedora 19 [PVHVM]'},
+            {'id': 'img-7', 'name': 'Fedora 19 P'}]
+
+        self.assertEquals('img-6', self.catalog.resolve(
+            "images", "Fedora 19 [PVHVM]")['id'])
+
+    def test_resolves_regular_expressions(self):
+        self.assertEquals('img-1', self.catalog.resolve(
+            "images", "re:^Ubuntu 12\\.04 LTS$")['id'])
+
+    def test_pattern_matching_several_images(self):
+        with self.assertRaises(CatalogError) as cm:
+            self.catalog.resolve("images", "Ubuntu 12.04*")
+
+        self.assertIn("Ubuntu 12.04 LTS (img-1)", str(cm.exception))
+        self.assertIn("latest:Ubuntu 12.04*", str(cm.exception))
+
+    def test_latest_matching_image(self):
+        self.assertEquals('img-5', self.catalog.resolve(
+            "images", "latest:Ubuntu 12.04*")['id'])
+        self.assertEquals('img-3', self.catalog.resolve(
+            "images", "latest:CentOS 6.4")['id'])
+
+    def test_latest_only_applies_to_images(self):
+        with self.assertRaises(CatalogError):
+            self.catalog.resolve("flavors", "latest:*Standard*")
+
+    def test_pattern_matching_nothing(self):
+        with self.assertRaises(CatalogError) as cm:
+            self.catalog.resolve("images", "Arch*")
+
+        self.assertEquals("No image matches 'Arch*'", str(cm.exception))
+        # Just fetched, so not fetched again
+        self.assertEquals(1, self.api.list_images.call_count)
+
+    def test_resolutions_are_remembered(self):
+        self.catalog.resolve("images", "latest:Ubuntu*")
+        self.catalog._index = mock.Mock()
+
+        self.assertEquals('img-5', self.catalog.resolve(
+            "images", "latest:Ubuntu*")['id'])
+        self.assertFalse(self.catalog._index.called)
+
+    def test_refresh_forgets_resolutions(self):
+        self.catalog.resolve("images", "latest:Ubuntu*")
+        self.api.list_images.return_value.append(
+            {'id': 'img-6', 'name': 'Ubuntu 13.04',
+             'created': '2013-04-25T10:00:00Z'})
+        self.catalog.refresh()
+
+        self.assertEquals('img-6', self.catalog.resolve(
+            "images", "latest:Ubuntu*")['id'])
+
+    def test_preflight_resolves_ids(self):
+        self.assertEquals({'image': 'img-1', 'flavor': '2',
+                           'networks': ['00000000-0000-0000-0000-000000000000',
+                                        'net-1']},
+                          preflight(self.catalog, "Ubuntu 12.04 LTS",
+                                    flavor="512MB Standard Instance",
+                                    networks=["public", "net-1"]))
+
+    def test_preflight_reports_every_problem(self):
+        self.api.headroom.return_value = {'instances': 0, 'ram': 1024}
+
+        with self.assertRaises(CatalogError) as cm:
+            preflight(self.catalog, "img-9", flavor="5", networks=["private"])
+
+        message = str(cm.exception)
+        self.assertIn("Unknown image 'img-9'", message)
+        self.assertIn("Unknown network 'private'", message)
+        self.assertIn("Only 0 more servers", message)
+        self.assertIn("Only 1024 MB of RAM left", message)
+
+    def test_preflight_without_flavor_skips_quota(self):
+        preflight(self.catalog, "img-1")
+
+        self.assertFalse(self.api.headroom.called)
@@ -1,16 +1,37 @@
 from StringIO import StringIO
 import unittest2 as unittest
 import mock
+import os
+import shutil
 import sys
+import tempfile
 from littlechef_rackspace.api import RackspaceApi
+from littlechef_rackspace.catalog import Catalog, CatalogError
 from littlechef_rackspace.commands import (RackspaceCreate,
                                            RackspaceListImages,
                                            RackspaceListFlavors,
                                            RackspaceListNetworks,
                                            RackspaceListServers,
-                                           RackspaceRebuild)
+                                           RackspaceRebuild,
+                                           RackspaceResume,
+                                           RackspaceDelete,
+                                           RackspaceLogs,
+                                           RackspaceConverge,
+                                           RackspaceInventorySync,
+                                           RackspaceQueryServers,
+                                           RackspacePool,
+                                           RackspaceBundleKitchen,
+                                           RackspaceVerify)
 from littlechef_rackspace.deploy import ChefDeployer
+from littlechef_rackspace.journal import Journal
 from littlechef_rackspace.lib import Host
+from littlechef_rackspace.logs import LogStore
+from littlechef_rackspace.nodes import NodeStore
+from littlechef_rackspace.parallel import Result
+from littlechef_rackspace.pool import Pool, PoolStore
+from littlechef_rackspace.servers import InvalidQuery, ServerIndex
+from littlechef_rackspace.timings import TimingStore
+from littlechef_rackspace.verify import CheckResult, Verifier
 
 
 class RackspaceCreateTest(unittest.TestCase):
@@ -59,15 +80,48 @@ class RackspaceCreateTest(unittest.TestCase):
         flavor = "flavorId"
         public_key_file = StringIO("~/.ssh/id_rsa.pub")
 
+        progress = StringIO()
         self.command.execute(name=node_name, image=image,
                              flavor=flavor, public_key_file=public_key_file,
-                             progress=StringIO())
+                             progress=progress)
 
         self.api.create_node.assert_any_call(name=node_name, image=image,
                                              flavor=flavor,
                                              public_key_file=public_key_file,
                                              networks=None,
-                                             progress=sys.stderr)
+                                             progress=progress,
+                                             journal=None,
+                                             hedge_after=None)
+
+    def test_creates_host_with_ids_resolved_from_catalog(self):
+        catalog = mock.Mock(spec=Catalog)
+        catalog.rackspace_api = self.api
+        catalog.resolve.side_effect = lambda kind, value: {
+            'id': {'Ubuntu': 'imageId', '512MB': '2'}[value]}
+        self.api.headroom.return_value = {'instances': None, 'ram': None}
+        self.command.catalog = catalog
+
+        self.command.execute(name="test", image="Ubuntu", flavor="512MB",
+                             public_key_file=StringIO("whatever"),
+                             progress=StringIO())
+
+        call_args = self.api.create_node.call_args[1]
+        self.assertEquals("imageId", call_args['image'])
+        self.assertEquals("2", call_args['flavor'])
+
+    def test_create_aborts_when_preflight_fails(self):
+        catalog = mock.Mock(spec=Catalog)
+        catalog.rackspace_api = self.api
+        catalog.resolve.side_effect = CatalogError("Unknown image 'Arch'")
+        self.api.headroom.return_value = {'instances': None, 'ram': None}
+        self.command.catalog = catalog
+
+        with self.assertRaises(SystemExit):
+            self.command.execute(name="test", image="Arch", flavor="2",
+                                 public_key_file=StringIO("whatever"),
+                                 progress=StringIO())
+
+        self.assertFalse(self.api.create_node.called)
 
     def test_deploys_to_host_with_kwargs(self):
         kwargs = {
@@ -102,6 +156,309 @@ class RackspaceCreateTest(unittest.TestCase):
         self.deployer.deploy.assert_any_call(host=expected_host)
 
 
+    def test_create_journals_progress(self):
+        journal = mock.Mock(spec=Journal)
+        journal.is_unfinished.return_value = False
+        command = RackspaceCreate(rackspace_api=self.api,
+                                  chef_deployer=self.deployer,
+                                  journal=journal)
+
+        command.execute(name="web-n01", image="imageId", flavor="2",
+                        public_key_file=StringIO("whatever"),
+                        progress=StringIO(), runlist=['role[web]'])
+
+        phases = [c[0][2] for c in journal.record.call_args_list]
+        self.assertEquals(['requested', 'active', 'deploying', 'done'],
+                          phases)
+        self.assertEquals(journal,
+                          self.api.create_node.call_args[1]['journal'])
+
+    def test_create_journals_failure(self):
+        journal = mock.Mock(spec=Journal)
+        journal.is_unfinished.return_value = False
+        command = RackspaceCreate(rackspace_api=self.api,
+                                  chef_deployer=self.deployer,
+                                  journal=journal)
+        self.deployer.deploy.side_effect = SystemExit
+
+        with self.assertRaises(SystemExit):
+            command.execute(name="web-n01", image="imageId", flavor="2",
+                            public_key_file=StringIO("whatever"),
+                            progress=StringIO())
+
+        phases = [c[0][2] for c in journal.record.call_args_list]
+        self.assertEquals(['requested', 'active', 'deploying', 'failed'],
+                          phases)
+
+    def test_create_journals_failed_build(self):
+        journal = mock.Mock(spec=Journal)
+        journal.is_unfinished.return_value = False
+        command = RackspaceCreate(rackspace_api=self.api,
+                                  chef_deployer=self.deployer,
+                                  journal=journal)
+        self.api.create_node.side_effect = Exception("build failed")
+
+        with self.assertRaises(Exception):
+            command.execute(name="web-n01", image="imageId", flavor="2",
+                            public_key_file=StringIO("whatever"),
+                            progress=StringIO())
+
+        journal.record.assert_called_with("create", "web-n01", "failed")
+
+    def test_create_refuses_node_with_unfinished_operation(self):
+        journal = mock.Mock(spec=Journal)
+        journal.is_unfinished.return_value = True
+        command = RackspaceCreate(rackspace_api=self.api,
+                                  chef_deployer=self.deployer,
+                                  journal=journal)
+
+        with mock.patch('littlechef_rackspace.commands.abort') as abort:
+            abort.side_effect = SystemExit
+            with self.assertRaises(SystemExit):
+                command.execute(name="web-n01", image="imageId", flavor="2",
+                                public_key_file=StringIO("whatever"),
+                                progress=StringIO())
+
+        self.assertEquals(0, len(self.api.create_node.call_args_list))
+
+
+    def test_create_records_build_and_deploy_times(self):
+        timings = mock.Mock(spec=TimingStore)
+        command = RackspaceCreate(rackspace_api=self.api,
+                                  chef_deployer=self.deployer,
+                                  timings=timings)
+
+        command.execute(name="web-n01", image="imageId", flavor="2",
+                        public_key_file=StringIO("whatever"),
+                        progress=StringIO(), region='dfw', template='web')
+
+        calls = timings.record.call_args_list
+        self.assertEquals(["build", "deploy"], [call[0][0] for call in calls])
+        for call in calls:
+            self.assertEquals({'region': 'dfw', 'flavor': '2',
+                               'image': 'imageId', 'template': 'web'},
+                              call[1])
+
+    def test_dry_run_estimates_from_timings(self):
+        timings = mock.Mock(spec=TimingStore)
+        command = RackspaceCreate(rackspace_api=self.api,
+                                  chef_deployer=self.deployer,
+                                  timings=timings)
+        progress = StringIO()
+
+        command.execute(name="web-n01", image="imageId", flavor="2",
+                        public_key_file=StringIO("whatever"),
+                        progress=progress, region='dfw', dry_run=True)
+
+        timings.estimate.assert_called_once_with(
+            ["build", "deploy"], count=1, concurrency=1, region='dfw',
+            flavor='2', image='imageId', template=None)
+        timings.describe.assert_called_once_with(
+            timings.estimate.return_value, progress)
+        self.assertFalse(timings.record.called)
+
+    def test_create_hedges_after_build_time_percentile(self):
+        timings = mock.Mock(spec=TimingStore)
+        timings.percentile.return_value = 240.0
+        command = RackspaceCreate(rackspace_api=self.api,
+                                  chef_deployer=self.deployer,
+                                  timings=timings)
+
+        command.execute(name="web-n01", image="imageId", flavor="2",
+                        public_key_file=StringIO("whatever"),
+                        progress=StringIO(), region='dfw',
+                        hedge_after='p90')
+
+        timings.percentile.assert_any_call("build", 90.0, region='dfw',
+                                           flavor='2', image='imageId',
+                                           template=None)
+        self.assertEquals(240.0,
+                          self.api.create_node.call_args[1]['hedge_after'])
+
+    def test_create_does_not_hedge_without_history(self):
+        timings = mock.Mock(spec=TimingStore)
+        timings.percentile.return_value = None
+        command = RackspaceCreate(rackspace_api=self.api,
+                                  chef_deployer=self.deployer,
+                                  timings=timings)
+
+        command.execute(name="web-n01", image="imageId", flavor="2",
+                        public_key_file=StringIO("whatever"),
+                        progress=StringIO(), hedge_after='p90')
+
+        self.assertEquals(None,
+                          self.api.create_node.call_args[1]['hedge_after'])
+
+    def test_validate_args_rejects_bad_hedge_after(self):
+        self.assertFalse(self.command.validate_args(
+            name="web-n01", image="imageId", flavor="2",
+            hedge_after="soon"))
+        self.assertFalse(self.command.validate_args(
+            name="web-n01", image="imageId", flavor="2",
+            hedge_after="p150"))
+        self.assertTrue(self.command.validate_args(
+            name="web-n01", image="imageId", flavor="2",
+            hedge_after="150"))
+
+    def _self_bootstrap(self, journal=None, **kwargs):
+        kitchen = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, kitchen)
+        bundle_path = os.path.join(kitchen, "kitchen.tar.gz")
+        with open(bundle_path, "w") as bundle:
+            bundle.write("bundle")
+        node_store = NodeStore(directory=os.path.join(kitchen, "nodes"),
+                               path=os.path.join(kitchen, "nodes.db"))
+        command = RackspaceCreate(rackspace_api=self.api,
+                                  chef_deployer=self.deployer,
+                                  journal=journal, node_store=node_store)
+
+        with mock.patch('littlechef_rackspace.commands.BUNDLE_PATH',
+                        bundle_path), \
+                mock.patch('littlechef_rackspace.commands.lc') as lc:
+            lc.env.node_work_path = "/srv/chef"
+            command.execute(name="web-n01", image="imageId", flavor="2",
+                            public_key_file=StringIO("whatever"),
+                            progress=StringIO(), environment="production",
+                            runlist=['role[web]'], bootstrap_mode="user-data",
+                            bundle_url="https://example.com/kitchen.tar.gz",
+                            **kwargs)
+        lc._readconfig.assert_called_once_with()
+        return node_store
+
+    def test_self_bootstrap_creates_with_user_data_and_skips_deploy(self):
+        journal = mock.Mock(spec=Journal)
+        journal.is_unfinished.return_value = False
+
+        node_store = self._self_bootstrap(journal=journal)
+
+        user_data = self.api.create_node.call_args[1]['user_data']
+        self.assertIn("https://example.com/kitchen.tar.gz", user_data)
+        self.assertIn('"role[web]"', user_data)
+        self.assertIn("tar -xzf /srv/chef/kitchen.tar.gz", user_data)
+        self.assertFalse(self.deployer.deploy.called)
+        self.assertEquals(['requested', 'active', 'done'],
+                          [c[0][2] for c in journal.record.call_args_list])
+        self.assertEquals({'name': 'web-n01', 'run_list': ['role[web]'],
+                           'chef_environment': 'production'},
+                          node_store.get("web-n01"))
+
+    def test_self_bootstrap_signs_bundle_url(self):
+        self._self_bootstrap(bundle_url_key="secret")
+
+        user_data = self.api.create_node.call_args[1]['user_data']
+        self.assertIn("kitchen.tar.gz?temp_url_sig=", user_data)
+
+    def test_self_bootstrap_needs_bundle(self):
+        with mock.patch('littlechef_rackspace.commands.BUNDLE_PATH',
+                        "/nonexistent/kitchen.tar.gz"):
+            with self.assertRaises(SystemExit):
+                self.command.execute(
+                    name="web-n01", image="imageId", flavor="2",
+                    public_key_file=StringIO("whatever"),
+                    progress=StringIO(), bootstrap_mode="user-data",
+                    bundle_url="https://example.com/kitchen.tar.gz")
+
+        self.assertFalse(self.api.create_node.called)
+
+    def test_create_claims_from_pool_and_refills(self):
+        journal = mock.Mock(spec=Journal)
+        journal.is_unfinished.return_value = False
+        command = RackspaceCreate(rackspace_api=self.api,
+                                  chef_deployer=self.deployer,
+                                  journal=journal)
+        command.pool = mock.Mock(spec=Pool)
+        host = Host(name="web-n01", ip_address="1.1.1.1", node_id="id-1")
+        command.pool.claim.return_value = host
+
+        command.execute(name="web-n01", image="imageId", flavor="2",
+                        public_key_file=StringIO("ssh-rsa key"),
+                        progress=StringIO(), runlist=['role[web]'],
+                        from_pool=True, pool_size=3)
+
+        self.assertFalse(self.api.create_node.called)
+        deploy_kwargs = self.deployer.deploy.call_args[1]
+        self.assertEquals(host, deploy_kwargs['host'])
+        self.assertFalse(deploy_kwargs['use_opscode_chef'])
+        self.assertTrue(deploy_kwargs['set_hostname'])
+        self.assertEquals(['role[web]'], deploy_kwargs['runlist'])
+        fill_args = command.pool.fill_in_background.call_args
+        self.assertEquals((3, "2", "imageId"), fill_args[0])
+        self.assertEquals(1, fill_args[1]['concurrency'])
+        self.assertEquals(['role[web]'], fill_args[1]['options']['runlist'])
+        claim_kwargs = command.pool.claim.call_args[1]
+        self.assertEquals(journal, claim_kwargs['journal'])
+        self.assertEquals('imageId', claim_kwargs['args']['image'])
+        self.assertEquals(['submitted', 'active', 'deploying', 'done'],
+                          [c[0][2] for c in journal.record.call_args_list])
+
+    def test_create_from_pool_survives_failed_refill(self):
+        command = RackspaceCreate(rackspace_api=self.api,
+                                  chef_deployer=self.deployer)
+        command.pool = mock.Mock(spec=Pool)
+        host = Host(name="web-n01", ip_address="1.1.1.1", node_id="id-1")
+        command.pool.claim.return_value = host
+        command.pool.fill_in_background.side_effect = OSError(
+            2, "No such file", "fix-rackspace")
+        progress = StringIO()
+
+        self.assertEquals(host, command.execute(
+            name="web-n01", image="imageId", flavor="2",
+            public_key_file=StringIO("ssh-rsa key"), progress=progress,
+            from_pool=True, pool_size=3))
+        self.assertIn("WARNING: Could not refill the pool",
+                      progress.getvalue())
+        self.assertTrue(self.deployer.deploy.called)
+
+    def test_create_from_pool_records_failed_deploy(self):
+        journal = mock.Mock(spec=Journal)
+        journal.is_unfinished.return_value = False
+        command = RackspaceCreate(rackspace_api=self.api,
+                                  chef_deployer=self.deployer,
+                                  journal=journal)
+        command.pool = mock.Mock(spec=Pool)
+        command.pool.claim.return_value = Host(name="web-n01",
+                                               ip_address="1.1.1.1",
+                                               node_id="id-1")
+        self.deployer.deploy.side_effect = SystemExit("chef failed")
+
+        with self.assertRaises(SystemExit):
+            command.execute(name="web-n01", image="imageId", flavor="2",
+                            public_key_file=StringIO("ssh-rsa key"),
+                            progress=StringIO(), from_pool=True)
+
+        journal.record.assert_called_with("create", "web-n01", "failed")
+
+    def test_create_builds_when_pool_is_empty(self):
+        command = RackspaceCreate(rackspace_api=self.api,
+                                  chef_deployer=self.deployer)
+        command.pool = mock.Mock(spec=Pool)
+        command.pool.claim.return_value = None
+        command.pool.key.return_value = "dfw/2/imageId/default/97e9d49563fb"
+        progress = StringIO()
+
+        command.execute(name="web-n01", image="imageId", flavor="2",
+                        public_key_file=StringIO("ssh-rsa key"),
+                        progress=progress, from_pool=True)
+
+        self.assertIn("The pool for dfw/2/imageId/default/97e9d49563fb is "
+                      "empty",
+                      progress.getvalue())
+        self.assertEquals("ssh-rsa key", self.api.create_node.call_args[1][
+            'public_key_file'].read())
+        self.assertFalse(command.pool.fill_in_background.called)
+        self.assertNotIn('set_hostname', self.deployer.deploy.call_args[1])
+
+    def test_validate_args_self_bootstrap(self):
+        args = {'name': "web-n01", 'image': "imageId", 'flavor': "2",
+                'bootstrap_mode': "user-data"}
+
+        self.assertFalse(self.command.validate_args(**args))
+        args['bundle_url'] = "https://example.com/kitchen.tar.gz"
+        self.assertTrue(self.command.validate_args(**args))
+        self.assertFalse(self.command.validate_args(plugins="save_ip",
+                                                    **args))
+
+
 class RackspaceListImagesTest(unittest.TestCase):
 
     def setUp(self):
@@ -237,7 +594,8 @@ class RackspaceRebuildTest(unittest.TestCase):
         self.api.rebuild_node.assert_any_call(name=server_name,
                                               image=image,
                                               public_key_file=public_key_file,
-                                              progress=sys.stderr)
+                                              progress=sys.stderr,
+                                              journal=None)
 
     def test_deploys_to_host_with_kwargs(self):
         kwargs = {
@@ -268,3 +626,736 @@ class RackspaceRebuildTest(unittest.TestCase):
         expected_host.environment = 'staging'
 
         self.deployer.deploy.assert_any_call(host=expected_host)
+
+    def test_rebuilds_servers_matching_pattern(self):
+        self.api.list_servers.return_value = [
+            {'id': '1', 'name': 'web-n01', 'public_ipv4': '1.1.1.1'},
+            {'id': '2', 'name': 'web-n02', 'public_ipv4': '1.1.1.2'},
+            {'id': '3', 'name': 'db-n01', 'public_ipv4': '1.1.1.3'}]
+
+        self.command.execute(name="web-*", image="imageId",
+                             public_key_file=StringIO("key"),
+                             progress=StringIO(), concurrency=2)
+
+        rebuilt = sorted(c[1]['node_id']
+                         for c in self.api.rebuild_node.call_args_list)
+        self.assertEquals(['1', '2'], rebuilt)
+        self.assertEquals(2, len(self.deployer.deploy.call_args_list))
+
+    def test_rebuilds_list_of_servers_with_full_public_key(self):
+        self.api.list_servers.return_value = [
+            {'id': '1', 'name': 'web-n01', 'public_ipv4': '1.1.1.1'},
+            {'id': '2', 'name': 'web-n02', 'public_ipv4': '1.1.1.2'}]
+
+        self.command.execute(name="web-n01,web-n02", image="imageId",
+                             public_key_file=StringIO("key"),
+                             progress=StringIO())
+
+        for call in self.api.rebuild_node.call_args_list:
+            self.assertEquals("key", call[1]['public_key_file'].read())
+
+    def test_rebuild_stops_after_max_failures(self):
+        self.api.list_servers.return_value = [
+            {'id': str(i), 'name': 'web-n0{0}'.format(i),
+             'public_ipv4': '1.1.1.1'} for i in range(4)]
+        self.api.rebuild_node.side_effect = Exception("build failed")
+
+        with mock.patch('littlechef_rackspace.commands.abort') as abort:
+            self.command.execute(name="web-*", image="imageId",
+                                 public_key_file=StringIO("key"),
+                                 progress=StringIO(), concurrency=1,
+                                 max_failures=1)
+
+        self.assertEquals(1, len(self.api.rebuild_node.call_args_list))
+        abort.assert_any_call("1 rebuilds failed, 3 skipped")
+
+    def test_rebuild_dry_run_estimates_at_concurrency(self):
+        self.api.list_servers.return_value = [
+            {'id': str(i), 'name': 'web-n0{0}'.format(i),
+             'public_ipv4': '1.1.1.1'} for i in range(5)]
+        timings = mock.Mock(spec=TimingStore)
+        self.command.timings = timings
+
+        self.command.execute(name="web-*", image="imageId",
+                             public_key_file=StringIO("key"),
+                             progress=StringIO(), concurrency=2,
+                             dry_run=True, region='dfw')
+
+        self.assertFalse(self.api.rebuild_node.called)
+        timings.estimate.assert_called_once_with(
+            ["rebuild", "deploy"], count=5, concurrency=2, region='dfw',
+            flavor=None, image='imageId', template=None)
+
+
+class RackspaceResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = mock.Mock(spec=RackspaceApi)
+        self.deployer = mock.Mock(spec=ChefDeployer)
+        self.journal = mock.Mock(spec=Journal)
+        self.command = RackspaceResume(rackspace_api=self.api,
+                                       chef_deployer=self.deployer,
+                                       journal=self.journal)
+        self.host = Host(name="web-n01", ip_address="1.1.1.1")
+
+    def _execute(self, **kwargs):
+        self.command.execute(public_key_file=StringIO("key"),
+                             progress=StringIO(), **kwargs)
+
+    def test_reattaches_to_building_node(self):
+        self.journal.unfinished.return_value = [{
+            'operation': 'create', 'name': 'web-n01', 'phase': 'submitted',
+            'node_id': 'abc', 'time': 1,
+            'args': {'image': 'imageId', 'flavor': '2',
+                     'runlist': ['role[web]'], 'environment': 'preprod'}}]
+        self.api.wait_for_node.return_value = self.host
+
+        self._execute()
+
+        self.api.wait_for_node.assert_any_call('abc', progress=mock.ANY)
+        self.assertEquals(0, len(self.api.create_node.call_args_list))
+        self.deployer.deploy.assert_any_call(host=self.host,
+                                             runlist=['role[web]'])
+        self.assertEquals('preprod', self.host.environment)
+        self.journal.record.assert_any_call('create', 'web-n01', 'done',
+                                            details=mock.ANY)
+
+    def test_finds_created_node_by_name_when_id_was_not_recorded(self):
+        self.journal.unfinished.return_value = [{
+            'operation': 'create', 'name': 'web-n01', 'phase': 'requested',
+            'time': 1, 'args': {'image': 'imageId', 'flavor': '2'}}]
+        self.api.list_servers.return_value = [
+            {'id': 'abc', 'name': 'web-n01', 'public_ipv4': '1.1.1.1'}]
+        self.api.wait_for_node.return_value = self.host
+
+        self._execute()
+
+        self.api.wait_for_node.assert_any_call('abc', progress=mock.ANY)
+
+    def test_creates_node_that_never_reached_the_api(self):
+        self.journal.unfinished.return_value = [{
+            'operation': 'create', 'name': 'web-n01', 'phase': 'requested',
+            'time': 1, 'args': {'image': 'imageId', 'flavor': '2'}}]
+        self.api.list_servers.return_value = []
+        self.api.create_node.return_value = self.host
+
+        self._execute()
+
+        call_kwargs = self.api.create_node.call_args[1]
+        self.assertEquals('imageId', call_kwargs['image'])
+        self.assertEquals('2', call_kwargs['flavor'])
+        self.assertEquals('key', call_kwargs['public_key_file'].read())
+
+    def test_renames_and_deploys_node_claimed_from_pool(self):
+        self.journal.unfinished.return_value = [{
+            'operation': 'create', 'name': 'web-n01', 'phase': 'requested',
+            'node_id': 'abc', 'from_pool': True, 'time': 1,
+            'args': {'image': 'imageId', 'flavor': '2',
+                     'runlist': ['role[web]']}}]
+        self.api.rename_node.return_value = self.host
+
+        self._execute()
+
+        self.api.rename_node.assert_called_once_with('abc', 'web-n01')
+        self.assertFalse(self.api.wait_for_node.called)
+        self.deployer.deploy.assert_any_call(host=self.host,
+                                             runlist=['role[web]'],
+                                             use_opscode_chef=False,
+                                             set_hostname=True)
+
+    def test_self_bootstrapping_create_is_not_deployed(self):
+        self.journal.unfinished.return_value = [{
+            'operation': 'create', 'name': 'web-n01', 'phase': 'submitted',
+            'node_id': 'abc', 'time': 1,
+            'args': {'image': 'imageId', 'flavor': '2',
+                     'bootstrap_mode': 'user-data'}}]
+        self.api.wait_for_node.return_value = self.host
+
+        self._execute()
+
+        self.api.wait_for_node.assert_any_call('abc', progress=mock.ANY)
+        self.assertFalse(self.deployer.deploy.called)
+        self.journal.record.assert_called_with(
+            'create', 'web-n01', 'done',
+            details={'bootstrap': 'user-data', 'address': '1.1.1.1'})
+
+    def test_self_bootstrapping_create_that_never_reached_the_api_fails(self):
+        self.journal.unfinished.return_value = [{
+            'operation': 'create', 'name': 'web-n01', 'phase': 'requested',
+            'time': 1, 'args': {'image': 'imageId', 'flavor': '2',
+                                'bootstrap_mode': 'user-data'}}]
+        self.api.list_servers.return_value = []
+
+        with self.assertRaises(SystemExit):
+            self._execute()
+
+        self.assertFalse(self.api.create_node.called)
+        self.journal.record.assert_called_with('create', 'web-n01', 'failed')
+
+    def test_waits_for_submitted_rebuild_to_begin(self):
+        self.journal.unfinished.return_value = [{
+            'operation': 'rebuild', 'name': 'web-n01', 'phase': 'submitted',
+            'node_id': 'abc', 'updated': '2014-01-01T00:00:00Z', 'time': 1,
+            'args': {'image': 'imageId'}}]
+        self.api.wait_for_rebuild.return_value = self.host
+
+        self._execute()
+
+        self.api.wait_for_rebuild.assert_called_once_with(
+            'abc', '2014-01-01T00:00:00Z', progress=mock.ANY)
+        self.assertEquals(0, len(self.api.wait_for_node.call_args_list))
+        self.assertEquals(0, len(self.api.rebuild_node.call_args_list))
+
+    def test_abandon_marks_operations_failed(self):
+        self.journal.unfinished.return_value = [{
+            'operation': 'rebuild', 'name': 'web-n01', 'phase': 'active',
+            'node_id': 'abc', 'time': 1}]
+
+        self._execute(abandon=True)
+
+        self.journal.record.assert_any_call('rebuild', 'web-n01', 'failed')
+        self.assertEquals(0, len(self.deployer.deploy.call_args_list))
+
+
+class RackspaceDeleteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = mock.Mock(spec=RackspaceApi)
+        self.api.delete_nodes.return_value = []
+        self.command = RackspaceDelete(rackspace_api=self.api)
+        self.api.list_servers.return_value = [
+            {'id': '1', 'name': 'web-n01', 'public_ipv4': '1.1.1.1'},
+            {'id': '2', 'name': 'web-n02', 'public_ipv4': '1.1.1.2'},
+            {'id': '3', 'name': 'db-n01', 'public_ipv4': '1.1.1.3'}]
+
+        self.kitchen = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.kitchen)
+        os.mkdir("nodes")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.kitchen)
+
+    def test_deletes_matching_servers_in_one_call(self):
+        self.command.execute(name="web-*,db-n01", yes=True,
+                             progress=StringIO(), concurrency=5)
+
+        servers = self.api.delete_nodes.call_args[0][0]
+        self.assertEquals(['1', '2', '3'], [s['id'] for s in servers])
+        self.assertEquals(5, self.api.delete_nodes.call_args[1]['concurrency'])
+        self.assertEquals(1, len(self.api.list_servers.call_args_list))
+
+    def test_removes_node_files_and_bootstrap_config(self):
+        for path in ["nodes/web-n01.json", ".bootstrap-config_web-n01",
+                     "nodes/db-n01.json"]:
+            open(path, "w").close()
+
+        self.command.execute(name="web-n01", yes=True, progress=StringIO())
+
+        self.assertFalse(os.path.exists("nodes/web-n01.json"))
+        self.assertFalse(os.path.exists(".bootstrap-config_web-n01"))
+        self.assertTrue(os.path.exists("nodes/db-n01.json"))
+
+    def test_keeps_node_files_for_servers_that_failed_to_delete(self):
+        open("nodes/web-n01.json", "w").close()
+        self.api.delete_nodes.return_value = [
+            {'id': '1', 'name': 'web-n01', 'public_ipv4': '1.1.1.1'}]
+
+        with mock.patch('littlechef_rackspace.commands.abort') as abort:
+            self.command.execute(name="web-n01", yes=True,
+                                 progress=StringIO())
+
+        self.assertTrue(os.path.exists("nodes/web-n01.json"))
+        abort.assert_any_call("Failed to delete 1 servers")
+
+    def test_asks_for_confirmation(self):
+        with mock.patch.multiple('littlechef_rackspace.commands',
+                                 confirm=mock.Mock(return_value=False),
+                                 abort=mock.Mock(side_effect=SystemExit)):
+            with self.assertRaises(SystemExit):
+                self.command.execute(name="web-*", progress=StringIO())
+
+        self.assertEquals(0, len(self.api.delete_nodes.call_args_list))
+
+    def test_validate_args_requires_name(self):
+        self.assertFalse(self.command.validate_args())
+
+
+class RackspaceConvergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = mock.Mock(spec=RackspaceApi)
+        self.deploy = mock.Mock(spec=ChefDeployer)
+        self.node_store = mock.Mock(spec=NodeStore)
+        self.node_store.node_path.side_effect = \
+            lambda name: "nodes/{0}.json".format(name)
+        self.node_store.find.return_value = ["web-n02", "db-n01"]
+        self.command = RackspaceConverge(rackspace_api=self.api,
+                                         chef_deployer=self.deploy,
+                                         node_store=self.node_store)
+        self.api.list_servers.return_value = [
+            {'id': '1', 'name': 'web-n01', 'public_ipv4': '1.1.1.1'},
+            {'id': '2', 'name': 'web-n02', 'public_ipv4': '1.1.1.2'},
+            {'id': '3', 'name': 'db-n01', 'public_ipv4': '1.1.1.3'}]
+
+        self.kitchen = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.kitchen)
+        os.mkdir("nodes")
+        for name in ["web-n01", "web-n02", "db-n01"]:
+            open("nodes/{0}.json".format(name), "w").close()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.kitchen)
+
+    def _converged(self):
+        return sorted(c[0][0].name
+                      for c in self.deploy.converge.call_args_list)
+
+    def test_converges_servers_matching_name(self):
+        results = self.command.execute(name="web-*", concurrency=2,
+                                       progress=StringIO())
+
+        self.assertEquals(["web-n01", "web-n02"], self._converged())
+        self.assertEquals(2, len(results))
+        host = [c[0][0] for c in self.deploy.converge.call_args_list
+                if c[0][0].name == "web-n01"][0]
+        self.assertEquals("1.1.1.1", host.ip_address)
+
+    def test_converges_servers_in_environment(self):
+        self.command.execute(environment="production", progress=StringIO())
+
+        self.node_store.find.assert_called_once_with(environment="production")
+        self.assertEquals(["db-n01", "web-n02"], self._converged())
+
+    def test_name_and_environment_both_apply(self):
+        self.command.execute(name="web-*", environment="production",
+                             progress=StringIO())
+
+        self.assertEquals(["web-n02"], self._converged())
+
+    def test_skips_servers_without_node_files(self):
+        os.remove("nodes/web-n01.json")
+        progress = StringIO()
+
+        self.command.execute(name="web-*", progress=progress)
+
+        self.assertEquals(["web-n02"], self._converged())
+        self.assertIn("Skipping web-n01: no node file", progress.getvalue())
+
+    def test_stops_after_max_failures(self):
+        self.deploy.converge.side_effect = Exception("chef failed")
+
+        with mock.patch('littlechef_rackspace.commands.abort') as abort:
+            results = self.command.execute(name="*", max_failures=1,
+                                           progress=StringIO())
+
+        self.assertEquals(1, self.deploy.converge.call_count)
+        self.assertEquals(2, len([r for r in results if r.skipped]))
+        abort.assert_called_once_with("1 converges failed, 2 skipped")
+
+    def test_dry_run_lists_servers(self):
+        progress = StringIO()
+
+        self.command.execute(name="web-*", dry_run=True, progress=progress)
+
+        self.assertFalse(self.deploy.converge.called)
+        self.assertEquals("Converging web-n01, web-n02\n",
+                          progress.getvalue())
+
+    def test_validate_args_requires_name_or_environment(self):
+        self.assertFalse(self.command.validate_args())
+        self.assertTrue(self.command.validate_args(environment="production"))
+
+
+class RackspaceInventorySyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.kitchen = tempfile.mkdtemp()
+        self.node_store = NodeStore(
+            directory=os.path.join(self.kitchen, "nodes"),
+            path=os.path.join(self.kitchen, "nodes.db"))
+        self.apis = {}
+        for region in ["dfw", "ord"]:
+            api = mock.Mock(spec=RackspaceApi)
+            api.region = region
+            api.list_server_details.return_value = []
+            self.apis[region] = api
+        self.runner = mock.Mock()
+        self.runner.get_api.side_effect = lambda region: self.apis[region]
+        self.command = RackspaceInventorySync(
+            rackspace_api=self.apis["dfw"], runner=self.runner,
+            node_store=self.node_store)
+
+    def tearDown(self):
+        shutil.rmtree(self.kitchen)
+
+    def _server(self, name, region="dfw", public_ipv4="1.1.1.1"):
+        return {'id': name + "-id", 'name': name, 'region': region,
+                'status': 'ACTIVE', 'public_ipv4': public_ipv4,
+                'public_ips': [public_ipv4], 'private_ips': ['10.0.0.1'],
+                'image': 'img-1', 'flavor': '2', 'metadata': {},
+                'created': None, 'updated': None}
+
+    def _sync(self, **kwargs):
+        progress = StringIO()
+        self.command.execute(progress=progress, **kwargs)
+        return progress.getvalue()
+
+    def test_creates_node_files_for_new_servers(self):
+        self.apis["dfw"].list_server_details.return_value = [
+            self._server("web-n01")]
+
+        output = self._sync()
+
+        node = self.node_store.get("web-n01")
+        self.assertEquals([], node['run_list'])
+        self.assertEquals("1.1.1.1", node['rackspace']['public_ipv4'])
+        self.assertEquals("dfw", node['rackspace']['region'])
+        self.assertIn("Synced 1 servers from dfw: 1 new, 0 updated, "
+                      "0 unchanged", output)
+
+    def test_updates_servers_and_keeps_run_list(self):
+        self.node_store.save({'name': 'web-n01', 'run_list': ['role[web]'],
+                              'chef_environment': 'production'})
+        self.apis["dfw"].list_server_details.return_value = [
+            self._server("web-n01", public_ipv4="2.2.2.2")]
+
+        self._sync()
+
+        node = self.node_store.get("web-n01")
+        self.assertEquals(['role[web]'], node['run_list'])
+        self.assertEquals('production', node['chef_environment'])
+        self.assertEquals("2.2.2.2", node['rackspace']['public_ipv4'])
+
+    def test_unchanged_nodes_are_not_written(self):
+        self.apis["dfw"].list_server_details.return_value = [
+            self._server("web-n01"), self._server("web-n02")]
+        self._sync()
+        self.apis["dfw"].list_server_details.return_value[1] = \
+            self._server("web-n02", public_ipv4="2.2.2.2")
+
+        with mock.patch.object(self.node_store, "save",
+                               wraps=self.node_store.save) as save:
+            output = self._sync()
+
+        self.assertEquals(["web-n02"],
+                          [c[0][0]['name'] for c in save.call_args_list])
+        self.assertIn("0 new, 1 updated, 1 unchanged", output)
+
+    def test_syncs_several_regions_in_one_write(self):
+        self.apis["dfw"].list_server_details.return_value = [
+            self._server("web-n01"), self._server("db-n01")]
+        self.apis["ord"].list_server_details.return_value = [
+            self._server("web-n01", region="ord"),
+            self._server("web-n02", region="ord")]
+
+        with mock.patch.object(self.node_store, "_write",
+                               wraps=self.node_store._write) as write:
+            output = self._sync(regions="dfw,ord")
+
+        self.assertEquals(1, write.call_count)
+        self.assertEquals(["db-n01", "web-n01", "web-n02"],
+                          sorted(write.call_args[0][0]))
+        self.assertEquals("dfw", self.node_store.get(
+            "web-n01")['rackspace']['region'])
+        self.assertIn("Skipping web-n01 in ord: already synced from dfw",
+                      output)
+
+    def test_failed_region_writes_nothing(self):
+        self.apis["dfw"].list_server_details.return_value = [
+            self._server("web-n01")]
+        self.apis["ord"].list_server_details.side_effect = \
+            Exception("503 Service Unavailable")
+
+        with self.assertRaises(SystemExit):
+            self._sync(regions="dfw,ord")
+
+        self.assertEquals([], self.node_store.find())
+
+    def test_reports_nodes_without_servers(self):
+        self.node_store.save({'name': 'old-n01', 'run_list': []})
+
+        output = self._sync()
+
+        self.assertIn("1 node files have no server: old-n01", output)
+
+    def test_dry_run_writes_nothing(self):
+        self.apis["dfw"].list_server_details.return_value = [
+            self._server("web-n01")]
+
+        output = self._sync(dry_run=True)
+
+        self.assertIn("1 new", output)
+        self.assertEquals([], self.node_store.find())
+
+
+POOL_KEY = "dfw/2/img/default/97e9d49563fb"
+
+
+class RackspacePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = PoolStore(os.path.join(self.directory, "pool.db"))
+        self.api = mock.Mock(spec=RackspaceApi)
+        self.api.region = "dfw"
+        self.api.create_node.side_effect = lambda name, **kwargs: Host(
+            name=name, ip_address="1.1.1.1", node_id=name + "-id")
+        self.deployer = mock.Mock(spec=ChefDeployer)
+        self.command = RackspacePool(rackspace_api=self.api,
+                                     chef_deployer=self.deployer,
+                                     pool_store=self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _pool(self, **kwargs):
+        progress = StringIO()
+        self.command.execute(public_key_file=StringIO("ssh-rsa key"),
+                             progress=progress, **kwargs)
+        return progress.getvalue()
+
+    def test_fills_pool(self):
+        output = self._pool(flavor="2", image="img", pool_size=2)
+
+        self.assertEquals(2, self.deployer.prepare.call_count)
+        self.assertIn("Built 2 servers; %s has 2 ready" % POOL_KEY, output)
+
+    def test_shows_pools(self):
+        self._pool(flavor="2", image="img", pool_size=1)
+
+        self.assertEquals(POOL_KEY + ": 1 ready, 0 building\n", self._pool())
+
+    def test_failed_builds_abort(self):
+        self.deployer.prepare.side_effect = Exception("no ssh")
+
+        with self.assertRaises(SystemExit):
+            self._pool(flavor="2", image="img", pool_size=1)
+
+    def test_validate_args_needs_flavor_and_image_to_fill(self):
+        self.assertTrue(self.command.validate_args())
+        self.assertFalse(self.command.validate_args(pool_size=2,
+                                                    flavor="2"))
+        self.assertTrue(self.command.validate_args(pool_size=2, flavor="2",
+                                                   image="img"))
+
+
+class RackspaceBundleKitchenTest(unittest.TestCase):
+
+    @mock.patch('littlechef_rackspace.commands.os.path.getsize')
+    @mock.patch('littlechef_rackspace.commands.build_bundle')
+    @mock.patch('littlechef_rackspace.commands.lc')
+    def test_reads_kitchen_config_before_bundling(self, lc, build_bundle,
+                                                  getsize):
+        calls = []
+        lc._readconfig.side_effect = lambda: calls.append("config")
+        build_bundle.side_effect = lambda: calls.append("bundle") or "abc"
+        getsize.return_value = 1024
+        progress = StringIO()
+
+        RackspaceBundleKitchen().execute(progress=progress)
+
+        self.assertEquals(["config", "bundle"], calls)
+        self.assertIn("1024 bytes, sha256 abc", progress.getvalue())
+
+
+class RackspaceQueryServersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server_index = mock.Mock(spec=ServerIndex)
+        self.server_index.ages.return_value = {'dfw': 185, 'ord': 7200}
+        self.server_index.query.return_value = [
+            {'region': 'dfw', 'name': 'web-n01', 'id': 'id-1',
+             'status': 'ACTIVE', 'public_ipv4': '1.1.1.1', 'image': 'img-1',
+             'flavor': '2', 'environment': 'preprod'},
+            {'region': 'ord', 'name': 'db-n01', 'id': 'id-2',
+             'status': 'BUILD', 'public_ipv4': None, 'image': 'img-1',
+             'flavor': '4', 'environment': None}]
+        self.runner = mock.Mock()
+        self.command = RackspaceQueryServers(runner=self.runner,
+                                             server_index=self.server_index)
+
+    def _query(self, **kwargs):
+        progress = StringIO()
+        self.command.execute(progress=progress, **kwargs)
+        return progress.getvalue()
+
+    def test_prints_table_and_staleness(self):
+        output = self._query(where=["environment=preprod", "image = img-*"],
+                             sort="name,region")
+
+        self.server_index.query.assert_called_once_with(
+            {'environment': 'preprod', 'image': 'img-*'}, ['name', 'region'])
+        self.assertIn("Indexed dfw 3m05s ago, ord 2h00m00s ago", output)
+        self.assertIn("--refresh", output)
+        lines = output.splitlines()
+        self.assertIn("region  name     id    status  public_ipv4  image  "
+                      "flavor  environment", lines)
+        self.assertIn("dfw     web-n01  id-1  ACTIVE  1.1.1.1      img-1  "
+                      "2       preprod", lines)
+        self.assertIn("2 servers", lines)
+
+    def test_refresh_each_region(self):
+        apis = dict((region, mock.Mock(region=region))
+                    for region in ["dfw", "ord"])
+        self.runner.get_api.side_effect = lambda region: apis[region]
+        self.server_index.refresh.side_effect = lambda api: len(api.region)
+
+        output = self._query(refresh=True, regions="dfw,ord")
+
+        self.assertEquals(2, self.server_index.refresh.call_count)
+        self.assertIn("Refreshed dfw: 3 servers changed", output)
+        self.assertIn("Refreshed ord: 3 servers changed", output)
+
+    def test_refresh_aborts_when_a_region_fails(self):
+        apis = dict((region, mock.Mock(region=region))
+                    for region in ["dfw", "ord"])
+        self.runner.get_api.side_effect = lambda region: apis[region]
+
+        def refresh(api):
+            if api.region == "ord":
+                raise Exception("timed out")
+            return 3
+        self.server_index.refresh.side_effect = refresh
+        progress = StringIO()
+
+        with mock.patch('littlechef_rackspace.commands.abort') as abort:
+            abort.side_effect = SystemExit
+            with self.assertRaises(SystemExit):
+                self.command.execute(progress=progress, refresh=True,
+                                     regions="dfw,ord")
+
+        self.assertIn("Could not refresh ord: timed out",
+                      progress.getvalue())
+        abort.assert_called_once_with("Could not refresh ord")
+        self.assertFalse(self.server_index.query.called)
+
+    def test_nothing_indexed(self):
+        self.server_index.ages.return_value = {}
+
+        with self.assertRaises(SystemExit):
+            self._query()
+
+    def test_invalid_query(self):
+        self.server_index.query.side_effect = InvalidQuery("Unknown field")
+
+        with self.assertRaises(SystemExit):
+            self._query(where=["colour=blue"])
+
+    def test_where_needs_a_pattern(self):
+        with self.assertRaises(SystemExit):
+            self._query(where=["environment"])
+
+
+class RackspaceVerifyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = mock.Mock(spec=RackspaceApi)
+        self.api.list_servers.return_value = [
+            {'id': '1', 'name': 'web-n01', 'public_ipv4': '1.1.1.1'},
+            {'id': '2', 'name': 'web-n02', 'public_ipv4': '1.1.1.2'},
+            {'id': '3', 'name': 'db-n01', 'public_ipv4': '1.1.1.3'}]
+        self.verifier_class = mock.Mock(spec=Verifier)
+        self.verifier = self.verifier_class.return_value
+        self.verifier.check_names.return_value = ["ssh", "chef", "port:80"]
+        self.command = RackspaceVerify(rackspace_api=self.api,
+                                       verifier_class=self.verifier_class)
+
+    def _passed(self, server, failing=None):
+        return Result(server, value=[
+            CheckResult(name, name != failing,
+                        "exited 1" if name == failing else None)
+            for name in ["ssh", "chef", "port:80"]])
+
+    def test_reports_matrix(self):
+        servers = self.api.list_servers.return_value
+        self.verifier.verify_servers.return_value = [
+            self._passed(servers[1], failing="chef"),
+            self._passed(servers[0])]
+        progress = StringIO()
+
+        with self.assertRaises(SystemExit):
+            self.command.execute(name="web-*", check_ports="80,443",
+                                 checks=["service nginx status"],
+                                 concurrency=20, progress=progress)
+
+        self.verifier_class.assert_called_once_with(
+            "~/.ssh/id_rsa", commands=["service nginx status"],
+            ports=["80", "443"])
+        self.assertEquals(20, self.verifier.verify_servers.call_args[1][
+            'concurrency'])
+        lines = progress.getvalue().splitlines()
+        self.assertEquals(["ssh", "chef", "port:80"], lines[0].split())
+        self.assertEquals(["web-n01", "ok", "ok", "ok"], lines[1].split())
+        self.assertEquals(["web-n02", "ok", "FAIL", "ok"], lines[2].split())
+        self.assertIn("FAILED web-n02 chef: exited 1", lines)
+        self.assertEquals("1 of 2 servers passed", lines[-1])
+
+    def test_unreachable_server_fails_every_check(self):
+        server = self.api.list_servers.return_value[2]
+        self.verifier.verify_servers.return_value = [
+            Result(server, error=Exception("no public IPv4 address"))]
+        progress = StringIO()
+
+        with self.assertRaises(SystemExit):
+            self.command.execute(name="db-n01", progress=progress)
+
+        self.assertIn("db-n01  FAIL  FAIL  FAIL", progress.getvalue())
+
+    def test_all_passed(self):
+        servers = self.api.list_servers.return_value
+        self.verifier.verify_servers.return_value = [
+            self._passed(server) for server in servers]
+        progress = StringIO()
+
+        self.command.execute(name="*", progress=progress)
+
+        self.assertIn("3 of 3 servers passed", progress.getvalue())
+
+    def test_validate_args_requires_name(self):
+        self.assertFalse(self.command.validate_args())
+
+
+class RackspaceLogsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_store = mock.Mock(spec=LogStore)
+        self.log_store.entries.return_value = [
+            {'run': '1', 'name': 'web-n01', 'status': 'failed',
+             'path': 'logs/1/web-n01.log.gz'},
+            {'run': '2', 'name': 'web-n01', 'status': 'done',
+             'path': 'logs/2/web-n01.log.gz'},
+            {'run': '2', 'name': 'web-n02', 'status': 'done',
+             'path': 'logs/2/web-n02.log.gz'},
+        ]
+        self.command = RackspaceLogs(log_store=self.log_store)
+
+    def test_lists_latest_run(self):
+        progress = StringIO()
+        self.command.execute(progress=progress)
+
+        lines = progress.getvalue().splitlines()
+        self.assertEquals(2, len(lines))
+        self.assertEquals(['web-n01', 'done', 'logs/2/web-n01.log.gz'],
+                          lines[0].split())
+
+    @mock.patch('littlechef_rackspace.commands.read_lines')
+    def test_shows_node_log(self, read_lines):
+        self.log_store.find.return_value = {'path': 'logs/1/web-n01.log.gz'}
+        read_lines.return_value = iter(["converging", "done"])
+        progress = StringIO()
+
+        self.command.execute(name="web-n01", run="1", progress=progress)
+
+        self.log_store.find.assert_called_once_with("web-n01", "1")
+        read_lines.assert_called_once_with('logs/1/web-n01.log.gz')
+        self.assertEquals("converging\ndone\n", progress.getvalue())
+
+    def test_missing_node_log_aborts(self):
+        self.log_store.find.return_value = None
+
+        with self.assertRaises(SystemExit):
+            self.command.execute(name="web-n09", progress=StringIO())
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest2 as unittest
+from StringIO import StringIO
+from fabric.utils import abort
+from littlechef_rackspace import client
+from littlechef_rackspace.daemon import Daemon, AlreadyServing
+
+
+class FakeRunner(object):
+
+    runs = []
+
+    def __init__(self, options=None, daemon=None):
+        self.options = options
+        self.daemon = daemon
+
+    def main(self, cmd_args, progress=None):
+        FakeRunner.runs.append((cmd_args, self.options, self.daemon))
+        progress.write("working on {0}\n".format(cmd_args[1]))
+        if cmd_args[1] == "fails":
+            abort("it failed")
+
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeRunner.runs = []
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, "serve.sock")
+        self.daemon = Daemon(FakeRunner, {'region': 'dfw'},
+                             socket_path=self.socket_path)
+        self.daemon.bind(threads=2)
+        thread = threading.Thread(target=self.daemon.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.daemon.server.shutdown()
+        shutil.rmtree(self.directory)
+
+    def test_runs_command_and_streams_output(self):
+        output = StringIO()
+
+        code = client.request(["list-servers", "web"], self.socket_path,
+                              output)
+
+        self.assertEquals(0, code)
+        self.assertEquals("working on web\n", output.getvalue())
+        self.assertEquals([(["list-servers", "web"], {'region': 'dfw'},
+                            self.daemon)], FakeRunner.runs)
+
+    def test_each_request_gets_its_own_copy_of_the_config(self):
+        client.request(["list-servers", "a"], self.socket_path, StringIO())
+        client.request(["list-servers", "b"], self.socket_path, StringIO())
+
+        self.assertIsNot(FakeRunner.runs[0][1], FakeRunner.runs[1][1])
+
+    def test_abort_is_reported_to_client(self):
+        output = StringIO()
+
+        code = client.request(["create", "fails"], self.socket_path, output)
+
+        self.assertEquals(1, code)
+        self.assertIn("Fatal error: it failed", output.getvalue())
+
+    def test_refuses_commands_it_does_not_serve(self):
+        output = StringIO()
+
+        code = client.request(["delete", "web"], self.socket_path, output)
+
+        self.assertEquals(2, code)
+        self.assertEquals([], FakeRunner.runs)
+
+    def test_api_is_created_once_per_account(self):
+        def factory(**kwargs):
+            return object()
+
+        first = self.daemon.api(factory, username="a", region="dfw")
+        self.assertIs(first, self.daemon.api(factory, username="a",
+                                             region="dfw"))
+        self.assertIsNot(first, self.daemon.api(factory, username="a",
+                                                region="ord"))
+
+    def test_refuses_to_start_twice(self):
+        other = Daemon(FakeRunner, {}, socket_path=self.socket_path)
+
+        with self.assertRaises(AlreadyServing):
+            other.bind()
+
+    def test_replaces_stale_socket(self):
+        stale_path = os.path.join(self.directory, "stale.sock")
+        open(stale_path, "w").close()
+        other = Daemon(FakeRunner, {}, socket_path=stale_path)
+
+        other.bind(threads=1)
+        other.server.server_close()
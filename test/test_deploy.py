@@ -1,12 +1,29 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
 import unittest2 as unittest
 import mock
 from littlechef_rackspace.lib import Host
-from littlechef_rackspace.deploy import ChefDeployer
+from littlechef_rackspace import deploy
+from littlechef_rackspace.deploy import ChefDeployer, reachable
+from littlechef_rackspace.logs import LogStore
+from littlechef_rackspace.metrics import Metrics
+from littlechef_rackspace.nodes import NodeStore
+from littlechef_rackspace.parallel import SubprocessFailed
 
 
 class ChefDeployerTest(unittest.TestCase):
 
     def setUp(self):
+        deploy._plugins.clear()
+        reachable_patch = mock.patch('littlechef_rackspace.deploy.reachable',
+                                     return_value=True)
+        reachable_patch.start()
+        self.addCleanup(reachable_patch.stop)
+        self.node_store = mock.MagicMock(spec=NodeStore)
         self.host = Host(name="test.example.com",
                          ip_address="50.56.57.58")
         self.ohai_data = {
@@ -25,12 +42,167 @@ class ChefDeployerTest(unittest.TestCase):
             }
         }
 
-    def _get_deployer(self, key_filename):
-        deployer = ChefDeployer(key_filename=key_filename,)
+    def _get_deployer(self, key_filename, **kwargs):
+        deployer = ChefDeployer(key_filename=key_filename,
+                                node_store=self.node_store, **kwargs)
         deployer._create_bootstrap_ssh_config = mock.Mock()
 
         return deployer
 
+    def _ssh_config_address(self, deployer):
+        contents = deployer._create_bootstrap_ssh_config.call_args[0][1]
+        return contents.split("HostName ")[1].strip()
+
+    @mock.patch('littlechef_rackspace.deploy.lc')
+    @mock.patch('littlechef_rackspace.deploy.littlechef')
+    def test_deploy_uses_public_address_by_default(self, littlechef, lc):
+        self.host.private_addresses = ['10.1.2.3']
+        probe = mock.Mock(return_value=True)
+        deployer = self._get_deployer("~/.ssh/id_rsa", probe=probe)
+
+        deployer.deploy(self.host)
+
+        self.assertEquals("50.56.57.58", self._ssh_config_address(deployer))
+        self.assertEquals("public", self.host.network)
+        self.assertFalse(probe.called)
+
+    @mock.patch('littlechef_rackspace.deploy.lc')
+    @mock.patch('littlechef_rackspace.deploy.littlechef')
+    def test_deploy_over_first_reachable_servicenet_address(
+            self, littlechef, lc):
+        self.host.private_addresses = ['192.168.3.4', '10.1.2.3']
+        probe = mock.Mock(side_effect=lambda address: address == '10.1.2.3')
+        deployer = self._get_deployer("~/.ssh/id_rsa", probe=probe,
+                                      bootstrap_network="servicenet")
+
+        deployer.deploy(self.host)
+
+        self.assertEquals("10.1.2.3", self._ssh_config_address(deployer))
+        self.assertEquals("servicenet", self.host.network)
+        self.assertEquals("10.1.2.3", self.host.bootstrap_address)
+        self.assertEquals("50.56.57.58", self.host.ip_address)
+
+    @mock.patch('littlechef_rackspace.deploy.abort')
+    @mock.patch('littlechef_rackspace.deploy.lc')
+    @mock.patch('littlechef_rackspace.deploy.littlechef')
+    def test_deploy_over_servicenet_aborts_if_unreachable(
+            self, littlechef, lc, abort):
+        abort.side_effect = SystemExit
+        self.host.private_addresses = ['10.1.2.3']
+        deployer = self._get_deployer("~/.ssh/id_rsa",
+                                      probe=mock.Mock(return_value=False),
+                                      bootstrap_network="servicenet")
+
+        with self.assertRaises(SystemExit):
+            deployer.deploy(self.host)
+
+        self.assertFalse(lc.node.called)
+
+    @mock.patch('littlechef_rackspace.deploy.lc')
+    @mock.patch('littlechef_rackspace.deploy.littlechef')
+    def test_auto_falls_back_to_public_address(self, littlechef, lc):
+        self.host.private_addresses = ['10.1.2.3']
+        deployer = self._get_deployer("~/.ssh/id_rsa",
+                                      probe=mock.Mock(return_value=False),
+                                      bootstrap_network="auto")
+
+        deployer.deploy(self.host)
+
+        self.assertEquals("50.56.57.58", self._ssh_config_address(deployer))
+        self.assertEquals("public", self.host.network)
+
+    def test_refused_connection_is_not_reachable(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        listener.close()
+
+        self.assertFalse(reachable("127.0.0.1", port=port))
+
+    def test_accepted_connection_is_reachable(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+
+        self.assertTrue(reachable("127.0.0.1",
+                                  port=listener.getsockname()[1]))
+
+    @mock.patch('littlechef_rackspace.deploy.call_in_subprocess')
+    def test_isolated_deploy_runs_in_subprocess(self, call_in_subprocess):
+        deployer = ChefDeployer(key_filename="~/.ssh/id_rsa", isolate=True)
+
+        deployer.deploy(self.host, runlist=['role[web]'])
+
+        call_in_subprocess.assert_any_call(deployer._deploy, self.host,
+                                           runlist=['role[web]'])
+
+    @mock.patch('littlechef_rackspace.deploy.call_in_subprocess')
+    @mock.patch('littlechef_rackspace.deploy.reachable')
+    def test_deploy_is_measured(self, ssh_ready, call_in_subprocess):
+        metrics = mock.Mock(spec=Metrics)
+        metrics.enabled = True
+        metrics.phase.side_effect = Metrics().phase
+        ssh_ready.return_value = True
+        deployer = ChefDeployer(key_filename="~/.ssh/id_rsa", isolate=True,
+                                metrics=metrics)
+
+        deployer.deploy(self.host)
+
+        ssh_ready.assert_called_once_with("50.56.57.58")
+        metrics.observe.assert_called_once_with("ssh_ready_seconds",
+                                                mock.ANY)
+        metrics.phase.assert_called_once_with("deploy")
+
+    @mock.patch('littlechef_rackspace.deploy.time')
+    @mock.patch('littlechef_rackspace.deploy.call_in_subprocess')
+    @mock.patch('littlechef_rackspace.deploy.reachable')
+    def test_deploy_without_metrics_waits_for_ssh(self, ssh_ready,
+                                                  call_in_subprocess, time):
+        ssh_ready.side_effect = [False, False, True]
+        time.time.return_value = 0
+        deployer = ChefDeployer(key_filename="~/.ssh/id_rsa", isolate=True)
+
+        deployer.deploy(self.host)
+
+        self.assertEquals(3, ssh_ready.call_count)
+        self.assertEquals(2, time.sleep.call_count)
+        self.assertTrue(call_in_subprocess.called)
+
+    @mock.patch('littlechef_rackspace.deploy.call_in_subprocess')
+    def test_isolated_deploy_output_is_logged(self, call_in_subprocess):
+        log_store = mock.Mock(spec=LogStore)
+        log_store.path.return_value = "logs/run/test.example.com.log.gz"
+        deployer = ChefDeployer(key_filename="~/.ssh/id_rsa", isolate=True,
+                                log_store=log_store)
+
+        deployer.deploy(self.host, runlist=['role[web]'])
+
+        call_in_subprocess.assert_any_call(deployer._logged,
+                                           deployer._deploy, self.host,
+                                           runlist=['role[web]'])
+        self.assertEquals("logs/run/test.example.com.log.gz",
+                          self.host.log_path)
+        log_store.record.assert_called_once_with(
+            "test.example.com", "logs/run/test.example.com.log.gz", "done")
+
+    @mock.patch('littlechef_rackspace.deploy.call_in_subprocess')
+    def test_failed_deploy_shows_tail_of_log(self, call_in_subprocess):
+        log_store = mock.Mock(spec=LogStore)
+        log_store.path.return_value = "logs/run/test.example.com.log.gz"
+        log_store.tail.return_value = ["Chef run failed", "exit 1"]
+        call_in_subprocess.side_effect = SubprocessFailed("Traceback")
+        deployer = ChefDeployer(key_filename="~/.ssh/id_rsa", isolate=True,
+                                log_store=log_store)
+
+        with self.assertRaises(SubprocessFailed) as cm:
+            deployer.deploy(self.host)
+
+        self.assertIn("logs/run/test.example.com.log.gz:\n"
+                      "Chef run failed\nexit 1", str(cm.exception))
+        log_store.record.assert_called_once_with(
+            "test.example.com", "logs/run/test.example.com.log.gz", "failed")
+
     @mock.patch('littlechef_rackspace.deploy.lc')
     @mock.patch('littlechef_rackspace.deploy.littlechef')
     def test_deploy_sets_fabric_settings(self, littlechef, lc):
@@ -53,6 +225,51 @@ class ChefDeployerTest(unittest.TestCase):
 
         lc.deploy_chef.assert_any_call(ask="no")
 
+    @mock.patch('littlechef_rackspace.deploy.lc')
+    @mock.patch('littlechef_rackspace.deploy.littlechef')
+    def test_converge_only_runs_chef(self, littlechef, lc):
+        deployer = self._get_deployer(key_filename="~/.ssh/id_rsa")
+
+        deployer.converge(self.host)
+
+        self.assertEquals("50.56.57.58", self._ssh_config_address(deployer))
+        lc.node.assert_called_once_with("test.example.com")
+        self.assertFalse(lc.deploy_chef.called)
+        self.assertFalse(self.node_store.save.called)
+
+    @mock.patch('littlechef_rackspace.deploy.lc')
+    @mock.patch('littlechef_rackspace.deploy.littlechef')
+    def test_prepare_only_installs_chef(self, littlechef, lc):
+        deployer = self._get_deployer(key_filename="~/.ssh/id_rsa")
+
+        deployer.prepare(self.host)
+
+        lc.deploy_chef.assert_called_once_with(ask="no")
+        self.assertFalse(lc.node.called)
+        self.assertFalse(self.node_store.save.called)
+
+    @mock.patch('littlechef_rackspace.deploy.sudo')
+    @mock.patch('littlechef_rackspace.deploy.lc')
+    @mock.patch('littlechef_rackspace.deploy.littlechef')
+    def test_deploy_can_set_hostname(self, littlechef, lc, sudo):
+        deployer = self._get_deployer(key_filename="~/.ssh/id_rsa")
+
+        deployer.deploy(self.host, use_opscode_chef=False, set_hostname=True)
+
+        command = sudo.call_args[0][0]
+        self.assertIn("echo test.example.com > /etc/hostname", command)
+        self.assertIn("hostname test.example.com", command)
+        self.assertFalse(lc.deploy_chef.called)
+
+    @mock.patch('littlechef_rackspace.deploy.call_in_subprocess')
+    def test_isolated_converge_runs_in_subprocess(self, call_in_subprocess):
+        deployer = ChefDeployer(key_filename="~/.ssh/id_rsa", isolate=True)
+
+        deployer.converge(self.host)
+
+        call_in_subprocess.assert_called_once_with(deployer._converge,
+                                                   self.host)
+
     @mock.patch('littlechef_rackspace.deploy.lc')
     @mock.patch('littlechef_rackspace.deploy.littlechef')
     def test_deploy_does_not_call_deploys_chef_if_option_is_set(
@@ -65,19 +282,19 @@ class ChefDeployerTest(unittest.TestCase):
 
     @mock.patch('littlechef_rackspace.deploy.lc')
     @mock.patch('littlechef_rackspace.deploy.littlechef')
-    def test_deploy_with_no_runlist_calls_save_config(self, littlechef, lc):
+    def test_deploy_with_no_runlist_saves_node_data(self, littlechef, lc):
         deployer = self._get_deployer(key_filename="~/.ssh/id_rsa")
 
         node_data = {
             'predefined': 'data'
         }
-        littlechef.lib.get_node.return_value = node_data
+        self.node_store.get.return_value = node_data
 
         deployer.deploy(self.host)
 
-        littlechef.lib.get_node.assert_any_call(self.host.name)
+        self.node_store.get.assert_any_call(self.host.name)
         node_data.update(self.ohai_data)
-        littlechef.chef.save_config.assert_any_call(node_data, force=True)
+        self.node_store.save.assert_any_call(node_data)
 
     @mock.patch('littlechef_rackspace.deploy.lc')
     @mock.patch('littlechef_rackspace.deploy.littlechef')
@@ -87,11 +304,11 @@ class ChefDeployerTest(unittest.TestCase):
 
         node_data = {}
         self.host.name = None
-        littlechef.lib.get_node.return_value = node_data
+        self.node_store.get.return_value = node_data
 
         deployer.deploy(self.host)
 
-        littlechef.lib.get_node.assert_any_call(self.host.ip_address)
+        self.node_store.get.assert_any_call(self.host.ip_address)
 
     @mock.patch('littlechef_rackspace.deploy.lc')
     @mock.patch('littlechef_rackspace.deploy.littlechef')
@@ -99,7 +316,7 @@ class ChefDeployerTest(unittest.TestCase):
         deployer = self._get_deployer(key_filename="~/.ssh/id_rsa")
 
         predefined_data = {'run_list': []}
-        littlechef.lib.get_node.return_value = predefined_data
+        self.node_store.get.return_value = predefined_data
 
         runlist = ['role[web]', 'recipe[apache2]']
         deployer.deploy(self.host, runlist=runlist)
@@ -107,10 +324,8 @@ class ChefDeployerTest(unittest.TestCase):
         predefined_data.update(self.ohai_data)
         predefined_data['run_list'] = runlist
 
-        littlechef.chef.save_config.assert_any_call(
-            predefined_data,
-            force=True)
-        littlechef.lib.get_node.assert_any_call(self.host.name)
+        self.node_store.save.assert_any_call(predefined_data)
+        self.node_store.get.assert_any_call(self.host.name)
 
     @mock.patch('littlechef_rackspace.deploy.lc')
     @mock.patch('littlechef_rackspace.deploy.littlechef')
@@ -120,11 +335,11 @@ class ChefDeployerTest(unittest.TestCase):
 
         expected_data = {'chef_environment': 'staging'}
         expected_data.update(self.ohai_data)
-        littlechef.lib.get_node.return_value = expected_data
+        self.node_store.get.return_value = expected_data
 
         deployer.deploy(self.host)
 
-        littlechef.chef.save_config.assert_any_call(expected_data, force=True)
+        self.node_store.save.assert_any_call(expected_data)
 
     @mock.patch('littlechef_rackspace.deploy.lc')
     @mock.patch('littlechef_rackspace.deploy.littlechef')
@@ -168,7 +383,7 @@ HostName 50.56.57.58
         plugin = mock.Mock()
         littlechef.lib.import_plugin.return_value = plugin
         node_data = {'predefined': ['values']}
-        littlechef.lib.get_node.return_value = node_data
+        self.node_store.get.return_value = node_data
 
         deployer.deploy(self.host, plugins=['awesome_plugin'])
 
@@ -207,3 +422,121 @@ HostName 50.56.57.58
         deployer.deploy(self.host, post_plugins=['postplugin'])
 
         littlechef.lib.import_plugin.assert_any_call('postplugin')
+
+    @mock.patch('littlechef_rackspace.deploy.lc')
+    @mock.patch('littlechef_rackspace.deploy.littlechef')
+    def test_deploy_reads_node_data_before_and_after_bootstrap(
+            self, littlechef, lc):
+        deployer = self._get_deployer(key_filename="~/.ssh/id_rsa")
+        lc.node.side_effect = lambda name: self.assertEquals(
+            1, self.node_store.get.call_count)
+
+        deployer.deploy(self.host, plugins=['plugin1', 'plugin2'])
+
+        self.assertTrue(lc.node.called)
+        self.assertEquals(2, self.node_store.get.call_count)
+
+    @mock.patch('littlechef_rackspace.deploy.lc')
+    @mock.patch('littlechef_rackspace.deploy.littlechef')
+    def test_deploy_rereads_node_data_for_post_plugins(self, littlechef, lc):
+        deployer = self._get_deployer(key_filename="~/.ssh/id_rsa")
+        plugin = mock.Mock()
+        littlechef.lib.import_plugin.return_value = plugin
+        before, after = {'before': True}, {'after': True}
+        self.node_store.get.side_effect = [before, after]
+
+        deployer.deploy(self.host, plugins=['pre'],
+                        post_plugins=['post1', 'post2'])
+
+        self.assertEquals(2, self.node_store.get.call_count)
+        self.assertEquals([mock.call(before), mock.call(after),
+                           mock.call(after)],
+                          plugin.execute.call_args_list)
+
+    @mock.patch('littlechef_rackspace.deploy.lc')
+    @mock.patch('littlechef_rackspace.deploy.littlechef')
+    def test_deploy_imports_each_plugin_once(self, littlechef, lc):
+        deployer = self._get_deployer(key_filename="~/.ssh/id_rsa")
+
+        deployer.deploy(self.host, plugins=['plugin1'],
+                        post_plugins=['plugin1'])
+        deployer.deploy(self.host, plugins=['plugin1'])
+
+        self.assertEquals([mock.call('plugin1')],
+                          littlechef.lib.import_plugin.call_args_list)
+
+    @mock.patch('littlechef_rackspace.deploy.lc')
+    @mock.patch('littlechef_rackspace.deploy.littlechef')
+    def test_deploy_runs_independent_plugins_concurrently(
+            self, littlechef, lc):
+        deployer = self._get_deployer(key_filename="~/.ssh/id_rsa")
+        node_data = {'run_list': []}
+        self.node_store.get.return_value = node_data
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        # A connection the parent made; the children open their own
+        dict.__setitem__(deploy.connections, 'root@parent', object())
+        self.addCleanup(deploy.connections.clear)
+
+        # Each plugin (in a process of its own) waits for the other to
+        # start, which only happens if they run at the same time
+        def plugin(name, other):
+            def execute(node):
+                open(os.path.join(directory, name), "w").close()
+                deadline = time.time() + 5
+                while time.time() < deadline and not os.path.exists(
+                        os.path.join(directory, other)):
+                    time.sleep(0.01)
+                with open(os.path.join(directory, name), "w") as result:
+                    result.write(json.dumps({
+                        'node': node,
+                        'connections': len(deploy.connections),
+                        'overlapped': os.path.exists(
+                            os.path.join(directory, other))}))
+                node['touched'] = True
+            return mock.Mock(independent=True, execute=execute)
+
+        plugins = {'one': plugin('one', 'two'), 'two': plugin('two', 'one')}
+        littlechef.lib.import_plugin.side_effect = plugins.get
+
+        deployer.deploy(self.host, plugins=['one', 'two'])
+
+        for name in plugins:
+            with open(os.path.join(directory, name)) as result:
+                self.assertEquals({'node': node_data, 'connections': 0,
+                                   'overlapped': True}, json.load(result))
+        self.assertNotIn('touched', node_data)
+
+    @mock.patch('littlechef_rackspace.deploy.lc')
+    @mock.patch('littlechef_rackspace.deploy.littlechef')
+    def test_deploy_fails_if_an_independent_plugin_fails(
+            self, littlechef, lc):
+        deployer = self._get_deployer(key_filename="~/.ssh/id_rsa")
+        failing = mock.Mock(independent=True)
+        failing.execute.side_effect = SystemExit(1)
+        plugins = {'ok': mock.Mock(independent=True), 'failing': failing,
+                   'after': mock.Mock(independent=False)}
+        littlechef.lib.import_plugin.side_effect = plugins.get
+
+        with self.assertRaises(SubprocessFailed):
+            deployer.deploy(self.host, plugins=['ok', 'failing', 'after'])
+
+        self.assertFalse(plugins['after'].execute.called)
+
+    @mock.patch('littlechef_rackspace.deploy.lc')
+    @mock.patch('littlechef_rackspace.deploy.littlechef')
+    def test_bootstrap_reads_nodes_from_node_store(self, littlechef, lc):
+        get_nodes = littlechef.lib.get_nodes
+        deployer = self._get_deployer(key_filename="~/.ssh/id_rsa")
+        self.node_store.get_nodes.return_value = ['indexed']
+        during_run = []
+        lc.node.side_effect = lambda *args: during_run.append(
+            littlechef.lib.get_nodes())
+
+        deployer.deploy(self.host)
+
+        self.assertEquals([['indexed']], during_run)
+        # Other threads, and this one once the run is over, get
+        # littlechef's own
+        self.assertEquals(get_nodes.return_value, littlechef.lib.get_nodes())
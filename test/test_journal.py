@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import mock
+import unittest2 as unittest
+from littlechef_rackspace.journal import (Journal, REQUESTED, SUBMITTED,
+                                          ACTIVE, DONE)
+from littlechef_rackspace.journal import connect_state_db, ensure_directory
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "state", "journal")
+        self.journal = Journal(path=self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_empty_journal_has_nothing_unfinished(self):
+        self.assertEquals([], self.journal.unfinished())
+
+    def test_latest_merges_node_id_and_args(self):
+        self.journal.record("create", "web-n01", REQUESTED,
+                            args={'image': 'imageId',
+                                  'runlist': ['role[web]']})
+        self.journal.record("create", "web-n01", SUBMITTED, node_id="abc")
+        self.journal.record("create", "web-n01", ACTIVE)
+
+        node = self.journal.latest()['web-n01']
+        self.assertEquals(ACTIVE, node['phase'])
+        self.assertEquals("abc", node['node_id'])
+        self.assertEquals({'image': 'imageId', 'runlist': ['role[web]']},
+                          node['args'])
+
+    def test_does_not_record_secrets(self):
+        self.journal.record("create", "web-n01", REQUESTED,
+                            args={'key': 'deadbeef', 'username': 'me',
+                                  'flavor': '2'})
+
+        self.assertEquals({'flavor': '2'},
+                          self.journal.latest()['web-n01']['args'])
+
+    def test_unfinished_excludes_done_nodes(self):
+        self.journal.record("create", "web-n01", SUBMITTED, node_id="1")
+        self.journal.record("create", "web-n02", SUBMITTED, node_id="2")
+        self.journal.record("create", "web-n01", DONE)
+
+        self.assertEquals(['web-n02'],
+                          [n['name'] for n in self.journal.unfinished()])
+        self.assertFalse(self.journal.is_unfinished('web-n01'))
+        self.assertTrue(self.journal.is_unfinished('web-n02'))
+
+    def test_new_operation_after_done_starts_fresh(self):
+        self.journal.record("create", "web-n01", SUBMITTED, node_id="1")
+        self.journal.record("create", "web-n01", DONE)
+        self.journal.record("rebuild", "web-n01", REQUESTED)
+
+        node = self.journal.latest()['web-n01']
+        self.assertEquals("rebuild", node['operation'])
+        self.assertTrue('node_id' not in node)
+
+    def test_ignores_partially_written_entries(self):
+        self.journal.record("create", "web-n01", SUBMITTED, node_id="1")
+        journal_file = open(self.path, "a")
+        journal_file.write('{"name": "web-n0')
+        journal_file.close()
+
+        self.assertEquals(1, len(self.journal.entries()))
+
+
+class StateDbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "state", "test.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_ensure_directory_creates_parents_once(self):
+        ensure_directory(self.path)
+        ensure_directory(self.path)
+
+        self.assertTrue(os.path.isdir(os.path.dirname(self.path)))
+
+    def test_schema_is_created_on_first_connect(self):
+        def create_schema(db):
+            db.execute("CREATE TABLE test (value TEXT)")
+        create_schema = mock.Mock(side_effect=create_schema)
+
+        for _ in range(2):
+            connect_state_db(self.path, create_schema).close()
+        self.assertEquals(1, create_schema.call_count)
+
+        os.remove(self.path)
+        db = connect_state_db(self.path, create_schema)
+        self.assertEquals([], db.execute("SELECT * FROM test").fetchall())
+        self.assertEquals(2, create_schema.call_count)
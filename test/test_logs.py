@@ -0,0 +1,99 @@
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import unittest2 as unittest
+from littlechef_rackspace.logs import LogStore, read_lines, tail
+from littlechef_rackspace.parallel import call_in_subprocess
+
+
+class LogStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = self._store("20130501T120000.000000-1")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _store(self, run_id, **kwargs):
+        return LogStore(directory=self.directory, run_id=run_id, **kwargs)
+
+    def _deploy_output(self, store, path, lines):
+        def deploy():
+            with store.capture(path):
+                for line in lines:
+                    print(line)
+                sys.stdout.flush()
+                os.system("echo from a command; echo to stderr >&2")
+            return "done"
+
+        return call_in_subprocess(deploy)
+
+    def test_captures_output_of_process_and_its_commands(self):
+        path = self.store.path("web-n01")
+
+        self.assertEquals("done", self._deploy_output(self.store, path,
+                                                      ["converging"]))
+
+        self.assertEquals(os.path.join(self.directory,
+                                       "20130501T120000.000000-1",
+                                       "web-n01.log.gz"), path)
+        self.assertEquals(["converging", "from a command", "to stderr"],
+                          list(read_lines(path)))
+
+    def test_long_output_keeps_beginning_and_tail(self):
+        store = self._store("run", max_bytes=20, tail_lines=2)
+        path = store.path("web-n01")
+
+        self._deploy_output(store, path, ["line {0}".format(i)
+                                          for i in range(100)])
+
+        lines = list(read_lines(path))
+        self.assertEquals(["line 0", "line 1"], lines[:2])
+        self.assertTrue(lines[3].endswith("last lines follow]"))
+        self.assertEquals(["from a command", "to stderr"], lines[-2:])
+
+    def test_tail_of_truncated_log(self):
+        path = os.path.join(self.directory, "web-n01.log.gz")
+        log_file = gzip.open(path, "wb")
+        log_file.write("".join("line {0}\n".format(i) for i in range(1000)))
+        log_file.close()
+        with open(path, "r+b") as log_file:
+            log_file.truncate(os.path.getsize(path) - 10)
+
+        last = tail(path, 2)
+
+        self.assertEquals(2, len(last))
+        self.assertTrue(last[0].startswith("line 9"))
+
+    def test_tail_of_missing_log(self):
+        self.assertEquals([], tail(os.path.join(self.directory, "nope")))
+
+    def test_find_latest_log_for_node(self):
+        self.store.record("web-n01", "/logs/1/web-n01.log.gz", "failed")
+        later = self._store("20130501T130000.000000-1")
+        later.record("web-n01", "/logs/2/web-n01.log.gz", "done")
+
+        self.assertEquals("/logs/2/web-n01.log.gz",
+                          self.store.find("web-n01")['path'])
+        self.assertEquals("failed", self.store.find(
+            "web-n01", "20130501T120000.000000-1")['status'])
+        self.assertIsNone(self.store.find("web-n02"))
+
+    def test_only_last_runs_are_kept(self):
+        for hour in range(10, 13):
+            store = self._store("20130501T{0}0000.000000-1".format(hour),
+                                keep_runs=2)
+            path = store.path("web-n01")
+            os.makedirs(os.path.dirname(path))
+            store.record("web-n01", path, "done")
+
+        self.assertEquals(["20130501T110000.000000-1",
+                           "20130501T120000.000000-1"],
+                          sorted(run for run in os.listdir(self.directory)
+                                 if run != "index"))
+        self.assertEquals(["20130501T110000.000000-1",
+                           "20130501T120000.000000-1"],
+                          [entry['run'] for entry in self.store.entries()])
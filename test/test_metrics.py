@@ -0,0 +1,145 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest2 as unittest
+from littlechef_rackspace.metrics import (Metrics, MetricsGroup,
+                                          PrometheusTextfile, StatsdMetrics,
+                                          get_metrics)
+
+
+class RecordingMetrics(Metrics):
+
+    enabled = True
+
+    def __init__(self):
+        self.calls = []
+
+    def increment(self, name, value=1, **labels):
+        self.calls.append(("increment", name, labels))
+
+    def observe(self, name, seconds, **labels):
+        self.calls.append(("observe", name, labels))
+
+    def gauge(self, name, delta, **labels):
+        self.calls.append(("gauge", name, delta, labels))
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_phase_is_timed_and_in_flight(self):
+        metrics = RecordingMetrics()
+
+        with metrics.phase("build", operation="create"):
+            pass
+
+        labels = {'operation': 'create'}
+        self.assertEquals([
+            ("gauge", "in_flight", 1, dict(labels, phase="build")),
+            ("observe", "build_seconds", labels),
+            ("gauge", "in_flight", -1, dict(labels, phase="build"))],
+            metrics.calls)
+
+    def test_failed_phase_is_counted(self):
+        metrics = RecordingMetrics()
+
+        with self.assertRaises(SystemExit):
+            with metrics.phase("deploy"):
+                raise SystemExit("chef failed")
+
+        self.assertIn(("increment", "failures_total", {'phase': 'deploy'}),
+                      metrics.calls)
+        self.assertNotIn("deploy_seconds", [c[1] for c in metrics.calls])
+
+    def test_no_exporters_discards_metrics(self):
+        metrics = get_metrics()
+
+        self.assertFalse(metrics.enabled)
+        with metrics.phase("build"):
+            pass
+
+    def test_both_exporters(self):
+        metrics = get_metrics(textfile="metrics.prom",
+                              statsd="localhost:8125")
+
+        self.assertIsInstance(metrics, MetricsGroup)
+        self.assertEquals(("localhost", 8125),
+                          metrics.exporters[1].address)
+
+
+class StatsdMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.settimeout(5)
+        self.metrics = StatsdMetrics("127.0.0.1",
+                                     self.listener.getsockname()[1])
+
+    def tearDown(self):
+        self.listener.close()
+
+    def _received(self):
+        return self.listener.recvfrom(1024)[0]
+
+    def test_sends_counters_timers_and_gauges(self):
+        self.metrics.increment("failures_total", phase="build")
+        self.metrics.observe("api_request_seconds", 0.25, call="list_nodes")
+        self.metrics.gauge("in_flight", -1, phase="deploy")
+
+        self.assertEquals("littlechef_rackspace.failures_total.build:1|c",
+                          self._received())
+        self.assertEquals("littlechef_rackspace.api_request_seconds."
+                          "list_nodes:250|ms", self._received())
+        self.assertEquals("littlechef_rackspace.in_flight.deploy:-1|g",
+                          self._received())
+
+
+class PrometheusTextfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "fix-rackspace.prom")
+        self.now = 1000.0
+        self.metrics = PrometheusTextfile(self.path, interval=3600,
+                                          clock=lambda: self.now)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _read(self):
+        with open(self.path) as metrics_file:
+            return metrics_file.read()
+
+    def test_writes_text_format(self):
+        self.metrics.increment("failures_total", phase="build")
+        self.metrics.gauge("in_flight", 1, phase="deploy")
+        self.metrics.observe("build_seconds", 100, operation="create")
+        self.metrics.observe("build_seconds", 400, operation="create")
+        self.metrics.flush()
+
+        text = self._read()
+        self.assertIn("# TYPE littlechef_rackspace_failures_total counter\n"
+                      'littlechef_rackspace_failures_total{phase="build"} 1\n',
+                      text)
+        self.assertIn('littlechef_rackspace_in_flight{phase="deploy"} 1\n',
+                      text)
+        self.assertIn("# TYPE littlechef_rackspace_build_seconds histogram",
+                      text)
+        self.assertIn('littlechef_rackspace_build_seconds_bucket'
+                      '{operation="create",le="120"} 1\n', text)
+        self.assertIn('littlechef_rackspace_build_seconds_bucket'
+                      '{operation="create",le="+Inf"} 2\n', text)
+        self.assertIn('littlechef_rackspace_build_seconds_sum'
+                      '{operation="create"} 500\n', text)
+
+    def test_writes_at_most_once_per_interval(self):
+        self.metrics.increment("failures_total", phase="build")
+        self.assertIn("} 1\n", self._read())
+
+        self.metrics.increment("failures_total", phase="build")
+        self.assertIn("} 1\n", self._read())
+
+        self.metrics.flush()
+        self.assertIn("} 2\n", self._read())
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
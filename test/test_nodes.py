@@ -0,0 +1,142 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest2 as unittest
+from littlechef_rackspace.nodes import NodeStore
+
+
+class NodeStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.kitchen = tempfile.mkdtemp()
+        self.nodes = os.path.join(self.kitchen, "nodes")
+        os.mkdir(self.nodes)
+        self.store = NodeStore(directory=self.nodes,
+                               path=os.path.join(self.kitchen, "nodes.db"))
+
+    def tearDown(self):
+        shutil.rmtree(self.kitchen)
+
+    def _write_node(self, name, data):
+        with open(os.path.join(self.nodes, name + ".json"), "w") as f:
+            f.write(json.dumps(data))
+
+    def _read_node(self, name):
+        with open(os.path.join(self.nodes, name + ".json")) as f:
+            return json.loads(f.read())
+
+    def test_get_missing_node_has_littlechef_defaults(self):
+        self.assertEquals({'name': 'web', 'run_list': [],
+                           'chef_environment': '_default'},
+                          self.store.get("web"))
+
+    def test_save_writes_node_file(self):
+        self.store.save({'name': 'web', 'run_list': ['role[web]']})
+
+        self.assertEquals({'name': 'web', 'run_list': ['role[web]']},
+                          self._read_node("web"))
+        self.assertEquals([], [f for f in os.listdir(self.nodes)
+                               if f.startswith('.')])
+
+    def test_get_rereads_files_changed_outside_the_store(self):
+        self.store.save({'name': 'web', 'run_list': []})
+        self._write_node("web", {'run_list': ['role[web]', 'recipe[x]']})
+
+        self.assertEquals(['role[web]', 'recipe[x]'],
+                          self.store.get("web")['run_list'])
+        self.assertEquals(['web'], self.store.find(role="web"))
+
+    def test_find_by_environment_and_role(self):
+        self.store.save({'name': 'web1', 'chef_environment': 'prod',
+                         'run_list': ['role[web]']})
+        self.store.save({'name': 'web2', 'chef_environment': 'staging',
+                         'run_list': ['role[web]']})
+        self.store.save({'name': 'db1', 'chef_environment': 'prod',
+                         'run_list': ['role[db]', 'role[backup]']})
+
+        self.assertEquals(['db1', 'web1'], self.store.find(environment="prod"))
+        self.assertEquals(['web1', 'web2'], self.store.find(role="web"))
+        self.assertEquals(['web1'], self.store.find(environment="prod",
+                                                    role="web"))
+
+    def test_find_picks_up_added_and_removed_files(self):
+        self.store.save({'name': 'web1', 'run_list': []})
+        self._write_node("web2", {'run_list': []})
+        os.remove(os.path.join(self.nodes, "web1.json"))
+
+        self.assertEquals(['web2'], self.store.find())
+
+    def _next_store(self):
+        return NodeStore(directory=self.nodes, path=self.store.path)
+
+    def test_find_picks_up_files_edited_in_place(self):
+        self.store.save({'name': 'web', 'run_list': ['role[web]']})
+        self.assertEquals(['web'], self.store.find(role="web"))
+        directory_mtime = os.stat(self.nodes).st_mtime
+
+        with open(os.path.join(self.nodes, "web.json"), "r+") as f:
+            f.truncate()
+            f.write(json.dumps({'run_list': ['role[db]']}))
+        os.utime(self.nodes, (directory_mtime, directory_mtime))
+
+        store = self._next_store()
+        self.assertEquals([], store.find(role="web"))
+        self.assertEquals(['web'], store.find(role="db"))
+
+    def test_lookups_check_the_files_once(self):
+        self._write_node("web", {'run_list': []})
+        self.assertEquals(['web'], self.store.find())
+        self._write_node("db", {'run_list': []})
+
+        self.assertEquals(['web'], self.store.find())
+        self.assertEquals(['web'], [node['name']
+                                    for node in self.store.get_nodes()])
+        self.store.save({'name': 'app', 'run_list': []})
+        self.assertEquals(['app', 'web'], self.store.find())
+        self.assertEquals(['app', 'db', 'web'], self._next_store().find())
+
+    def test_batch_writes_when_the_block_ends(self):
+        self._write_node("old", {'run_list': []})
+
+        with self.store.batch():
+            self.store.save({'name': 'web1', 'run_list': []})
+            self.store.save({'name': 'web2', 'run_list': []})
+            self.store.remove("old")
+            self.assertEquals(['old.json'], os.listdir(self.nodes))
+            self.assertEquals([], self.store.get("web1")['run_list'])
+
+        self.assertEquals(['web1.json', 'web2.json'],
+                          sorted(os.listdir(self.nodes)))
+        self.assertEquals(['web1', 'web2'], self.store.find())
+
+    def test_batch_writes_nothing_if_the_block_fails(self):
+        with self.assertRaises(KeyError):
+            with self.store.batch():
+                self.store.save({'name': 'web1', 'run_list': []})
+                raise KeyError()
+
+        self.assertEquals([], os.listdir(self.nodes))
+
+    def test_get_nodes_matches_littlechef(self):
+        self._write_node("web", {'run_list': []})
+        self._write_node("db", {'run_list': [], 'chef_environment': 'prod'})
+
+        self.assertEquals(
+            [{'name': 'db', 'run_list': [], 'chef_environment': 'prod'},
+             {'name': 'web', 'run_list': [], 'chef_environment': '_default'}],
+            self.store.get_nodes())
+        self.assertEquals(['db'], [node['name'] for node in
+                                   self.store.get_nodes("prod")])
+
+    def test_refresh_only_reads_changed_files(self):
+        self._write_node("web", {'run_list': []})
+        self.store.refresh()
+
+        read = []
+        original = self.store._read
+        self.store._read = lambda path: read.append(path) or original(path)
+        self._write_node("db", {'run_list': []})
+        self.store.refresh()
+
+        self.assertEquals([os.path.join(self.nodes, "db.json")], read)
@@ -0,0 +1,100 @@
+from StringIO import StringIO
+import threading
+import time
+import unittest2 as unittest
+from littlechef_rackspace import parallel
+from littlechef_rackspace.parallel import (run_windowed, call_in_subprocess,
+                                           fork_safe_lock, PrefixedProgress,
+                                           SubprocessFailed)
+
+
+class RunWindowedTest(unittest.TestCase):
+
+    def test_runs_every_item(self):
+        results = run_windowed(lambda item: item * 2, [1, 2, 3], window=2)
+
+        self.assertEquals([2, 4, 6],
+                          sorted(result.value for result in results))
+        self.assertTrue(all(result.succeeded for result in results))
+
+    def test_never_runs_more_than_window(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def func(item):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            threading.Event().wait(0.01)
+            with lock:
+                state['running'] -= 1
+
+        run_windowed(func, range(10), window=3)
+
+        self.assertTrue(state['peak'] <= 3)
+
+    def test_records_errors(self):
+        def func(item):
+            if item == 2:
+                raise ValueError("bad item")
+            return item
+
+        results = run_windowed(func, [1, 2, 3], window=1)
+
+        failed = [result for result in results if result.error]
+        self.assertEquals(1, len(failed))
+        self.assertEquals(2, failed[0].item)
+
+    def test_stops_starting_items_after_max_failures(self):
+        def func(item):
+            raise ValueError("everything fails")
+
+        results = run_windowed(func, [1, 2, 3, 4], window=1, max_failures=2)
+
+        self.assertEquals(2, len([r for r in results if r.error]))
+        self.assertEquals([3, 4], [r.item for r in results if r.skipped])
+
+
+class CallInSubprocessTest(unittest.TestCase):
+
+    def test_returns_result_from_child(self):
+        self.assertEquals(5, call_in_subprocess(lambda a, b: a + b, 2, b=3))
+
+    def test_raises_when_child_fails(self):
+        def func():
+            raise SystemExit("fabric aborted")
+
+        with self.assertRaises(SubprocessFailed):
+            call_in_subprocess(func)
+
+    def test_child_never_inherits_a_held_lock(self):
+        lock = fork_safe_lock()
+        self.addCleanup(parallel._fork_locks.remove, lock)
+        held = threading.Event()
+
+        def hold():
+            with lock:
+                held.set()
+                time.sleep(0.2)
+        holder = threading.Thread(target=hold)
+        holder.start()
+        held.wait()
+
+        self.assertTrue(call_in_subprocess(lambda: lock.acquire(False)))
+        holder.join()
+        self.assertTrue(lock.acquire(False))
+
+
+class PrefixedProgressTest(unittest.TestCase):
+
+    def test_prefixes_complete_lines(self):
+        stream = StringIO()
+        progress = PrefixedProgress(stream, "web-n01")
+
+        progress.write("Waiting")
+        progress.write("...")
+        self.assertEquals("", stream.getvalue())
+
+        progress.write("\nDone\n")
+        self.assertEquals("[web-n01] Waiting...\n[web-n01] Done\n",
+                          stream.getvalue())
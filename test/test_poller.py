@@ -0,0 +1,108 @@
+import threading
+import unittest2 as unittest
+import mock
+from littlechef_rackspace.poller import NodePoller, ServerView
+
+
+class NodePollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.list_nodes = mock.Mock()
+        self.poller = NodePoller(self.list_nodes, interval=0.01)
+
+    def _node(self, id, state):
+        node = mock.Mock()
+        node.id = id
+        node.state = state
+        return node
+
+    def test_returns_nodes_from_next_listing(self):
+        one, two = self._node('1', 0), self._node('2', 3)
+        self.list_nodes.return_value = [one, two]
+
+        self.assertEquals([two, one, None],
+                          self.poller.next_states(['2', '1', '3']))
+
+    def test_one_listing_answers_every_waiter(self):
+        release = threading.Event()
+        self.list_nodes.side_effect = lambda: (
+            release.wait(5) and [self._node(str(i), 0) for i in range(50)])
+        answers = []
+
+        def wait(node_id):
+            answers.append(self.poller.next_states([node_id])[0].id)
+
+        threads = [threading.Thread(target=wait, args=(str(i),))
+                   for i in range(50)]
+        for thread in threads:
+            thread.start()
+        while self.poller._waiting < 50:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEquals(sorted(str(i) for i in range(50)), sorted(answers))
+        self.assertEquals(1, self.list_nodes.call_count)
+
+    def test_listing_errors_reach_waiters(self):
+        self.list_nodes.side_effect = Exception("500 Internal Error")
+
+        with self.assertRaises(Exception):
+            self.poller.next_states(['1'])
+
+
+class ServerViewTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1367409600.0
+        self.list_all = mock.Mock()
+        self.list_changes = mock.Mock(return_value=([], []))
+        self.view = ServerView(self.list_all, self.list_changes,
+                               resync_after=600, clock=lambda: self.now)
+
+    def _node(self, id, state):
+        node = mock.Mock()
+        node.id = id
+        node.state = state
+        return node
+
+    def test_changes_are_merged_into_first_listing(self):
+        one, two = self._node('1', 0), self._node('2', 3)
+        self.list_all.return_value = [one, two]
+        self.view.refresh()
+        two_active, three = self._node('2', 0), self._node('3', 3)
+        self.list_changes.return_value = ([two_active, three], ['1'])
+        self.now += 5
+
+        self.assertEquals([two_active, three], self.view.refresh())
+        # From a minute before the previous listing began
+        self.list_changes.assert_called_once_with("2013-05-01T11:59:00Z")
+        self.assertEquals(1, self.list_all.call_count)
+
+    def test_everything_is_listed_again_after_resync_interval(self):
+        self.list_all.return_value = []
+        self.view.refresh(priority=2)
+        self.now += 300
+        self.view.refresh(priority=2)
+        self.now += 300
+
+        self.view.refresh(priority=2)
+
+        self.assertEquals(2, self.list_all.call_count)
+        self.list_changes.assert_called_once_with("2013-05-01T11:59:00Z",
+                                                  priority=2)
+
+    def test_failed_refresh_asks_for_same_changes_again(self):
+        self.list_all.return_value = []
+        self.view.refresh()
+        self.now += 5
+        self.list_changes.side_effect = [Exception("500 Internal Error"),
+                                         ([], [])]
+
+        with self.assertRaises(Exception):
+            self.view.refresh()
+        self.view.refresh()
+
+        self.assertEquals(["2013-05-01T11:59:00Z"] * 2,
+                          [c[0][0] for c in self.list_changes.call_args_list])
@@ -0,0 +1,237 @@
+import os
+import shutil
+import sys
+import tempfile
+import mock
+import unittest2 as unittest
+from littlechef_rackspace.api import RackspaceApi
+from littlechef_rackspace.deploy import ChefDeployer
+from littlechef_rackspace.lib import Host
+from littlechef_rackspace.journal import Journal
+from littlechef_rackspace.pool import Pool, PoolStore
+from littlechef_rackspace.pool import pool_key
+
+
+class PoolStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.now = 1000.0
+        self.store = PoolStore(os.path.join(self.directory, "pool.db"),
+                               build_timeout=3600, clock=lambda: self.now)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reserves_up_to_size(self):
+        names = self.store.reserve("dfw/2/img", 3)
+        self.store.ready(names[0], "id-0")
+
+        self.assertEquals(3, len(set(names)))
+        self.assertTrue(all(name.startswith("pool-") for name in names))
+        self.assertEquals([], self.store.reserve("dfw/2/img", 3))
+        self.assertEquals(1, len(self.store.reserve("dfw/2/img", 4)))
+        self.assertEquals({'dfw/2/img': {'ready': 1, 'building': 3}},
+                          self.store.counts())
+
+    def test_abandoned_builds_stop_counting(self):
+        abandoned = self.store.reserve("dfw/2/img", 2)
+        self.now += 3601
+
+        self.assertEquals(2, len(self.store.reserve("dfw/2/img", 2)))
+        self.assertEquals([], self.store.expire("ord/2/img"))
+        self.assertEquals(sorted(abandoned),
+                          sorted(self.store.expire("dfw/2/img")))
+        self.assertEquals([], self.store.expire("dfw/2/img"))
+        self.assertFalse(self.store.ready(abandoned[0], "id-0"))
+        self.assertEquals({'dfw/2/img': {'ready': 0, 'building': 2}},
+                          self.store.counts())
+
+    def test_claims_oldest_ready_server_once(self):
+        first, second, building = self.store.reserve("dfw/2/img", 3)
+        self.now += 1
+        self.store.ready(second, "id-2")
+        self.store.ready(first, "id-1")
+        self.store.reserve("ord/2/img", 1)
+
+        self.assertEquals((first, "id-1"), self.store.claim("dfw/2/img"))
+        self.assertEquals((second, "id-2"), self.store.claim("dfw/2/img"))
+        self.assertIsNone(self.store.claim("dfw/2/img"))
+        self.assertIsNone(self.store.claim("ord/2/img"))
+
+    def test_discard(self):
+        name, = self.store.reserve("dfw/2/img", 1)
+        self.store.discard(name)
+
+        self.assertEquals({}, self.store.counts())
+
+
+class PoolKeyTest(unittest.TestCase):
+
+    def test_key_includes_networks_and_key_fingerprint(self):
+        key = pool_key("dfw", "2", "img", ["public", "private"],
+                       "ssh-rsa AAAA me@laptop\n")
+
+        self.assertEquals(key, pool_key("dfw", "2", "img",
+                                        ["public", "private"],
+                                        "ssh-rsa AAAA other@host"))
+        self.assertTrue(key.startswith("dfw/2/img/public,private/"))
+        self.assertNotEquals(key, pool_key("dfw", "2", "img", ["public"],
+                                           "ssh-rsa AAAA me@laptop"))
+        self.assertNotEquals(key, pool_key("dfw", "2", "img",
+                                           ["public", "private"],
+                                           "ssh-rsa BBBB me@laptop"))
+        self.assertEquals("dfw/2/img/default/97e9d49563fb",
+                          pool_key("dfw", "2", "img", None, "ssh-rsa key"))
+
+
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = PoolStore(os.path.join(self.directory, "pool.db"))
+        self.api = mock.Mock(spec=RackspaceApi)
+        self.api.region = "dfw"
+        self.api.create_node.side_effect = lambda name, **kwargs: Host(
+            name=name, ip_address="1.1.1.1", node_id=name + "-id")
+        self.deployer = mock.Mock(spec=ChefDeployer)
+        self.pool = Pool(self.api, self.deployer, self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fill_builds_and_prepares_servers(self):
+        results = self.pool.fill(2, "2", "img", "ssh-rsa key")
+
+        self.assertTrue(all(result.succeeded for result in results))
+        self.assertEquals(2, self.deployer.prepare.call_count)
+        self.assertEquals("ssh-rsa key", self.api.create_node.call_args[1][
+            'public_key_file'].read())
+        self.assertEquals({'dfw/2/img/default/97e9d49563fb': {
+                           'ready': 2, 'building': 0}}, self.store.counts())
+
+    def test_failed_prepare_deletes_server(self):
+        self.deployer.prepare.side_effect = SystemExit("no ssh")
+
+        result, = self.pool.fill(1, "2", "img", "ssh-rsa key")
+
+        self.assertIsInstance(result.error, SystemExit)
+        self.api.delete_nodes.assert_called_once_with(
+            [{'id': result.item + "-id", 'name': result.item}])
+        self.assertEquals({}, self.store.counts())
+
+    def test_fill_deletes_abandoned_servers(self):
+        now = [1000.0]
+        self.store.clock = lambda: now[0]
+        abandoned, = self.store.reserve(self.pool.key("2", "img", None,
+                                                      "ssh-rsa key"), 1)
+        now[0] += 3601
+        self.api.list_servers.return_value = [
+            {'id': 'id-a', 'name': abandoned},
+            {'id': 'id-b', 'name': 'web-n01'}]
+
+        results = self.pool.fill(1, "2", "img", "ssh-rsa key")
+
+        self.assertEquals(1, len(results))
+        self.api.delete_nodes.assert_called_once_with(
+            [{'id': 'id-a', 'name': abandoned}], progress=None)
+
+    def test_server_abandoned_while_building_is_deleted(self):
+        def create_node(name, **kwargs):
+            # Given up on by another fill while this one built it
+            self.store.discard(name)
+            return Host(name=name, ip_address="1.1.1.1", node_id="id-x")
+        self.api.create_node.side_effect = create_node
+
+        result, = self.pool.fill(1, "2", "img", "ssh-rsa key")
+
+        self.assertIn("no longer pooled", str(result.error))
+        self.api.delete_nodes.assert_called_once_with(
+            [{'id': "id-x", 'name': result.item}])
+
+    def test_claim_renames_server(self):
+        self.pool.fill(1, "2", "img", "ssh-rsa key")
+        self.api.rename_node.return_value = Host(name="web-n01",
+                                                 node_id="x")
+
+        host = self.pool.claim("web-n01", "2", "img", "ssh-rsa key")
+
+        self.assertEquals("web-n01", host.name)
+        self.assertEquals("web-n01", self.api.rename_node.call_args[0][1])
+        self.assertIsNone(self.pool.claim("web-n02", "2", "img",
+                                          "ssh-rsa key"))
+
+    def test_claim_needs_same_networks_and_key(self):
+        self.pool.fill(1, "2", "img", "ssh-rsa key")
+
+        self.assertIsNone(self.pool.claim("web-n01", "2", "img",
+                                          "ssh-rsa other"))
+        self.assertIsNone(self.pool.claim("web-n01", "2", "img",
+                                          "ssh-rsa key",
+                                          networks=["public"]))
+        self.assertFalse(self.api.rename_node.called)
+
+    def test_claim_is_journaled_before_rename(self):
+        self.pool.fill(1, "2", "img", "ssh-rsa key")
+        journal = Journal(os.path.join(self.directory, "journal"))
+
+        def rename(node_id, name):
+            node = journal.latest()[name]
+            self.assertEquals(("requested", node_id),
+                              (node['phase'], node['node_id']))
+            self.assertTrue(node['from_pool'])
+            self.assertEquals("2", node['args']['flavor'])
+            return Host(name=name, node_id=node_id)
+        self.api.rename_node.side_effect = rename
+
+        self.pool.claim("web-n01", "2", "img", "ssh-rsa key",
+                        journal=journal, args={'flavor': "2"})
+
+        self.assertEquals(1, self.api.rename_node.call_count)
+
+    def test_claim_skips_servers_that_are_gone(self):
+        self.pool.fill(2, "2", "img", "ssh-rsa key")
+        self.api.rename_node.side_effect = [Exception("404 Not Found"),
+                                            Host(name="web-n01")]
+
+        host = self.pool.claim("web-n01", "2", "img", "ssh-rsa key")
+
+        self.assertEquals("web-n01", host.name)
+        self.assertEquals(2, self.api.rename_node.call_count)
+        self.assertEquals({}, self.store.counts())
+
+    @mock.patch("littlechef_rackspace.pool.subprocess.Popen")
+    def test_fill_in_background_runs_pool_command(self, popen):
+        log_path = os.path.join(self.directory, "logs", "pool.log")
+        script = os.path.join(self.directory, "fix-rackspace")
+        open(script, "w").close()
+
+        with mock.patch.object(sys, "argv", [script, "create"]):
+            self.pool.fill_in_background(
+                2, "2", "img", networks=["public", "private"], concurrency=2,
+                options={'username': 'me', 'key': 'secret',
+                         'public_key': '~/.ssh/pool.pub',
+                         'private_key': None},
+                log_path=log_path)
+
+        command = popen.call_args[0][0]
+        self.assertEquals([sys.executable, script, "pool", "--region", "dfw",
+                           "--flavor", "2", "--image", "img",
+                           "--pool-size", "2", "--concurrency", "2",
+                           "--networks", "public,private",
+                           "--username", "me",
+                           "--public-key", "~/.ssh/pool.pub"], command)
+        self.assertNotIn("secret", command)
+        kwargs = popen.call_args[1]
+        self.assertEquals("secret", kwargs['env']['LITTLECHEF_RACKSPACE_KEY'])
+        self.assertEquals(log_path, kwargs['stdout'].name)
+        self.assertTrue(kwargs['close_fds'])
+        self.assertTrue(os.path.exists(log_path))
+
+    @mock.patch("littlechef_rackspace.pool.subprocess.Popen")
+    def test_fill_in_background_needs_the_script(self, popen):
+        with mock.patch.object(sys, "argv", ["/nowhere/fix-rackspace"]):
+            with self.assertRaises(OSError):
+                self.pool.fill_in_background(2, "2", "img")
+
+        self.assertFalse(popen.called)
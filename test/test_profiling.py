@@ -0,0 +1,63 @@
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import unittest2 as unittest
+from littlechef_rackspace.profiling import Profiler
+
+
+def parse_configuration():
+    return sum(range(1000))
+
+
+def authenticate():
+    time.sleep(0.01)
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "profile.pstats")
+        self.profiler = Profiler(self.path, top=5)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _functions(self, path):
+        return set(function[2] for function in pstats.Stats(path).stats)
+
+    def test_inner_phases_are_profiled_separately(self):
+        with self.profiler.phase("main"):
+            parse_configuration()
+            with self.profiler.phase("api"):
+                authenticate()
+
+        self.profiler.save()
+
+        main = self._functions(os.path.join(self.directory,
+                                            "profile-main.pstats"))
+        api = self._functions(os.path.join(self.directory,
+                                           "profile-api.pstats"))
+        self.assertIn("parse_configuration", main)
+        self.assertNotIn("authenticate", main)
+        self.assertIn("authenticate", api)
+        self.assertTrue(set(["parse_configuration", "authenticate"]) <=
+                        self._functions(self.path))
+        self.assertGreaterEqual(self.profiler.seconds("main"),
+                                self.profiler.seconds("api"))
+
+    def test_summary_shows_top_functions_of_each_phase(self):
+        with self.profiler.phase("api"):
+            authenticate()
+
+        summary = self.profiler.summary()
+
+        self.assertTrue(summary.startswith("== api: "))
+        self.assertIn("ncalls", summary)
+        self.assertIn("(authenticate)", summary)
+
+    def test_nothing_profiled_writes_nothing(self):
+        self.assertEquals([], self.profiler.save())
+        self.assertFalse(os.path.exists(self.path))
@@ -0,0 +1,141 @@
+import threading
+import unittest2 as unittest
+import mock
+from littlechef_rackspace.api import RackspaceApi, BuildFailed
+from littlechef_rackspace.deploy import ChefDeployer
+from littlechef_rackspace.journal import Journal
+from littlechef_rackspace.lib import Host
+from littlechef_rackspace.parallel import SubprocessFailed
+from littlechef_rackspace.provisioner import (Provisioner, OperationAborted,
+                                              DeployFailed, OperationTimeout)
+
+
+class ProvisionerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = mock.Mock(spec=RackspaceApi)
+        self.deployer = mock.Mock(spec=ChefDeployer)
+        self.host = Host(name="web-n01", ip_address="1.2.3.4")
+        self.api.create_node.return_value = self.host
+        self.api.rebuild_node.return_value = self.host
+        self.events = []
+        self.provisioner = Provisioner(
+            region="dfw", public_key="README.md", rackspace_api=self.api,
+            chef_deployer=self.deployer, workers=4,
+            on_progress=lambda op, event: self.events.append(event.phase))
+
+    def tearDown(self):
+        self.provisioner.shutdown()
+
+    def test_create_returns_operation_with_deployed_host(self):
+        operation = self.provisioner.create("web-n01", "2", "ubuntu",
+                                            runlist=["role[web]"])
+
+        self.assertEquals(self.host, operation.result(timeout=5))
+        self.assertTrue(operation.done())
+        self.deployer.deploy.assert_called_once_with(host=self.host,
+                                                     runlist=["role[web]"],
+                                                     region="dfw")
+
+    def test_create_reports_structured_progress(self):
+        operation = self.provisioner.create("web-n01", "2", "ubuntu")
+        operation.result(timeout=5)
+
+        phases = ["requested", "active", "deploying", "done"]
+        self.assertEquals(phases, [e.phase for e in operation.events])
+        self.assertEquals(phases, self.events)
+        self.assertIn("Creating node with arguments",
+                      operation.log.getvalue())
+
+    def test_progress_is_also_journaled(self):
+        journal = mock.Mock(spec=Journal)
+        journal.is_unfinished.return_value = False
+        self.provisioner.journal = journal
+
+        self.provisioner.create("web-n01", "2", "ubuntu").result(timeout=5)
+
+        journal.record.assert_any_call("create", "web-n01", "deploying",
+                                       node_id=None, args=None,
+                                       details=None)
+
+    def test_build_errors_are_raised_from_result(self):
+        self.api.create_node.side_effect = BuildFailed(None, "went to ERROR")
+
+        operation = self.provisioner.create("web-n01", "2", "ubuntu")
+
+        with self.assertRaises(BuildFailed):
+            operation.result(timeout=5)
+        self.assertEquals("failed", operation.phase)
+
+    def test_abort_becomes_operation_aborted(self):
+        journal = mock.Mock(spec=Journal)
+        journal.is_unfinished.return_value = True
+        self.provisioner.journal = journal
+
+        operation = self.provisioner.create("web-n01", "2", "ubuntu")
+
+        with self.assertRaises(OperationAborted):
+            operation.result(timeout=5)
+
+    def test_failed_deploy_becomes_deploy_failed(self):
+        self.deployer.deploy.side_effect = SubprocessFailed("chef failed")
+
+        operation = self.provisioner.rebuild("web-n01", "ubuntu")
+
+        self.assertIsInstance(operation.exception(timeout=5), DeployFailed)
+
+    def test_result_timeout(self):
+        release = threading.Event()
+        self.api.rebuild_node.side_effect = lambda **kwargs: (
+            release.wait(5) and self.host)
+
+        operation = self.provisioner.rebuild("web-n01", "ubuntu")
+
+        with self.assertRaises(OperationTimeout):
+            operation.result(timeout=0.01)
+        release.set()
+        self.assertEquals(self.host, operation.result(timeout=5))
+
+    def test_operations_run_concurrently(self):
+        started = []
+        release = threading.Event()
+
+        def rebuild_node(**kwargs):
+            started.append(kwargs['name'])
+            release.wait(5)
+            return self.host
+
+        self.api.rebuild_node.side_effect = rebuild_node
+        operations = [self.provisioner.rebuild("web-n0{0}".format(i),
+                                               "ubuntu")
+                      for i in range(4)]
+
+        for _ in range(100):
+            if len(started) == 4:
+                break
+            threading.Event().wait(0.01)
+        release.set()
+
+        self.assertEquals(4, len(started))
+        for operation in operations:
+            operation.result(timeout=5)
+
+    def test_done_callbacks(self):
+        finished = []
+
+        operation = self.provisioner.create("web-n01", "2", "ubuntu")
+        operation.add_done_callback(finished.append)
+        operation.result(timeout=5)
+        operation.add_done_callback(finished.append)
+
+        self.assertEquals([operation, operation], finished)
+
+    def test_delete_returns_servers_that_failed(self):
+        servers = [{'id': '1', 'name': 'web-n01'}]
+        self.api.delete_nodes.return_value = servers
+
+        operation = self.provisioner.delete(servers, concurrency=3)
+
+        self.assertEquals(servers, operation.result(timeout=5))
+        self.assertEquals(3, self.api.delete_nodes.call_args[1]
+                          ['concurrency'])
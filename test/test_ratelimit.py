@@ -0,0 +1,148 @@
+import threading
+import unittest2 as unittest
+from littlechef_rackspace.ratelimit import (RateLimiter, TokenBucket,
+                                            QuotaExceeded, PRIORITY_POLL,
+                                            PRIORITY_LIST)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_full_bucket_has_no_delay(self):
+        bucket = TokenBucket(1, 5, clock=self.clock)
+
+        self.assertEquals(0, bucket.delay())
+
+    def test_empty_bucket_waits_for_refill(self):
+        bucket = TokenBucket(0.5, 1, clock=self.clock)
+        bucket.consume()
+
+        self.assertEquals(2, bucket.delay())
+        self.clock.now += 2
+        self.assertEquals(0, bucket.delay())
+
+    def test_starts_with_remaining_tokens(self):
+        bucket = TokenBucket(1, 10, tokens=0, clock=self.clock)
+
+        self.assertEquals(1, bucket.delay())
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limits = {
+            'limits': {
+                'rate': [{
+                    'regex': '^/servers',
+                    'uri': '/servers*',
+                    'limit': [{'verb': 'GET', 'value': 600,
+                               'remaining': 600, 'unit': 'MINUTE'},
+                              {'verb': 'POST', 'value': 1,
+                               'remaining': 0, 'unit': 'SECOND'}]
+                }],
+                'absolute': {'maxTotalInstances': 2,
+                             'totalInstancesUsed': 1}
+            }
+        }
+
+    def test_configure_creates_bucket_per_verb(self):
+        limiter = RateLimiter()
+        limiter.configure(self.limits)
+
+        self.assertEquals(1, len(limiter._buckets_for('GET', '/servers/1')))
+        self.assertEquals(1, len(limiter._buckets_for('POST', '/servers')))
+        self.assertEquals(0, len(limiter._buckets_for('GET', '/images')))
+
+    def test_claim_instance_respects_absolute_quota(self):
+        limiter = RateLimiter()
+        limiter.configure(self.limits)
+
+        limiter.claim_instance()
+        with self.assertRaises(QuotaExceeded):
+            limiter.claim_instance()
+
+    def test_limits_expire_after_refresh_period(self):
+        clock = FakeClock()
+        limiter = RateLimiter(refresh_after=60, clock=clock)
+        self.assertTrue(limiter.expired())
+        limiter.configure(self.limits)
+
+        self.assertFalse(limiter.expired())
+        clock.now += 60
+        self.assertTrue(limiter.expired())
+        # Only the first caller to notice reloads them
+        self.assertFalse(limiter.expired())
+
+    def test_call_retries_with_retry_after(self):
+        limiter = RateLimiter()
+        limiter.configure({})
+        holds = []
+        limiter.hold = holds.append
+        responses = [Exception("413 Over Limit Retry-After: 7"), "ok"]
+
+        def func():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        self.assertEquals("ok", limiter.call("GET", "/servers",
+                                             PRIORITY_LIST, func))
+        self.assertEquals([7], holds)
+
+    def test_call_backs_off_exponentially_without_retry_after(self):
+        limiter = RateLimiter(max_retries=2, default_backoff=1)
+        limiter.configure({})
+        holds = []
+        limiter.hold = holds.append
+
+        def func():
+            raise Exception("429 Too Many Requests")
+
+        with self.assertRaises(Exception):
+            limiter.call("GET", "/servers", PRIORITY_LIST, func)
+        self.assertEquals([1, 2], holds)
+
+    def test_call_does_not_retry_other_errors(self):
+        limiter = RateLimiter()
+        limiter.configure({})
+
+        def func():
+            raise Exception("404 Not Found")
+
+        with self.assertRaises(Exception):
+            limiter.call("GET", "/servers", PRIORITY_LIST, func)
+
+    def test_polls_are_served_before_lists(self):
+        limiter = RateLimiter()
+        limiter.configure({'rate': [{
+            'regex': '.*',
+            'limit': [{'verb': 'GET', 'value': 2, 'remaining': 0,
+                       'unit': 'SECOND'}]}]})
+        order = []
+
+        def waiter(name, priority):
+            limiter.acquire('GET', '/servers', priority)
+            order.append(name)
+
+        threads = [threading.Thread(target=waiter, args=('list',
+                                                         PRIORITY_LIST))]
+        threads[0].start()
+        threads.append(threading.Thread(target=waiter,
+                                        args=('poll', PRIORITY_POLL)))
+        threads[1].start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(['poll', 'list'], order)
@@ -1,8 +1,15 @@
+import os
+import shutil
+import StringIO
+import tempfile
 import unittest2 as unittest
 import mock
 from littlechef_rackspace.api import RackspaceApi
 from littlechef_rackspace.commands import RackspaceCreate, RackspaceListImages
+from littlechef_rackspace.daemon import Daemon
 from littlechef_rackspace.deploy import ChefDeployer
+from littlechef_rackspace.metrics import StatsdMetrics
+from littlechef_rackspace.profiling import Profiler
 from littlechef_rackspace.runner import Runner, InvalidConfiguration
 from littlechef_rackspace.runner import InvalidCommand, FailureMessages
 from littlechef_rackspace.runner import InvalidTemplate
@@ -27,10 +34,12 @@ class RunnerTest(unittest.TestCase):
         self.abort.side_effect = AbortException
 
         self.create_class.name = 'create'
+        self.create_class.requires_runner = False
 
         self.create_command = self.create_class.return_value
         self.list_images_class = mock.Mock(spec=RackspaceListImages)
         self.list_images_class.name = 'list-images'
+        self.list_images_class.requires_runner = False
 
         self.list_images_command = self.list_images_class.return_value
 
@@ -110,6 +119,20 @@ class RunnerTest(unittest.TestCase):
                                            key="deadbeef",
                                            region='ord')
 
+    def test_key_may_come_from_the_environment(self):
+        with mock.patch.multiple("littlechef_rackspace.runner",
+                                 RackspaceApi=self.api_class,
+                                 ChefDeployer=self.deploy_class,
+                                 RackspaceListImages=self.list_images_class):
+            with mock.patch.dict(os.environ,
+                                 {'LITTLECHEF_RACKSPACE_KEY': 'deadbeef'}):
+                r = Runner(options={'username': 'username', 'key': 'old'})
+                r.main(['list-images', '--region', 'dfw',
+                        '--public-key', 'README.md'])
+            self.api_class.assert_any_call(username="username",
+                                           key="deadbeef",
+                                           region='dfw')
+
     def test_create_fails_if_configuration_is_not_provided(self):
         r = Runner(options={})
         with mock.patch.multiple('littlechef_rackspace.runner',
@@ -145,6 +168,116 @@ class RunnerTest(unittest.TestCase):
                 region='dfw')
             self.deploy_class.assert_any_call(key_filename="~/.ssh/id_rsa")
 
+    def test_build_policy_is_passed_to_api(self):
+        with mock.patch.multiple(
+                "littlechef_rackspace.runner",
+                RackspaceApi=self.api_class,
+                ChefDeployer=self.deploy_class,
+                RackspaceCreate=self.create_class):
+            r = Runner(options={})
+            r.main(self.create_args + ['--build-timeout', '20',
+                                       '--replace-failed', '2'])
+
+            self.api_class.assert_any_call(username="username",
+                                           key="deadbeef",
+                                           region='dfw',
+                                           build_timeout=20 * 60,
+                                           replace_failed=2)
+
+    def test_concurrent_operations_isolate_deploys(self):
+        with mock.patch.multiple(
+                "littlechef_rackspace.runner",
+                RackspaceApi=self.api_class,
+                ChefDeployer=self.deploy_class,
+                RackspaceCreate=self.create_class):
+            r = Runner(options={})
+            r.main(self.create_args + ['--concurrency', '5'])
+
+            self.deploy_class.assert_any_call(key_filename="~/.ssh/id_rsa",
+                                              isolate=True,
+                                              log_store=mock.ANY)
+            self.api_class.assert_any_call(username="username",
+                                           key="deadbeef",
+                                           region='dfw',
+                                           shared_polling=True)
+
+    def test_bootstrap_network_is_passed_to_deploy(self):
+        with mock.patch.multiple(
+                "littlechef_rackspace.runner",
+                RackspaceApi=self.api_class,
+                ChefDeployer=self.deploy_class,
+                RackspaceCreate=self.create_class):
+            r = Runner(options={})
+            r.main(self.create_args + ['--bootstrap-network', 'auto'])
+
+            self.deploy_class.assert_any_call(key_filename="~/.ssh/id_rsa",
+                                              bootstrap_network="auto")
+
+    def test_metrics_are_passed_to_api_and_deploy(self):
+        with mock.patch.multiple(
+                "littlechef_rackspace.runner",
+                RackspaceApi=self.api_class,
+                ChefDeployer=self.deploy_class,
+                RackspaceCreate=self.create_class):
+            r = Runner(options={})
+            r.main(self.create_args + ['--statsd', 'localhost:8125'])
+
+            metrics = self.api_class.call_args[1]['metrics']
+            self.assertIsInstance(metrics, StatsdMetrics)
+            self.assertEquals(("localhost", 8125), metrics.address)
+            self.assertIs(metrics, self.deploy_class.call_args[1]['metrics'])
+
+    def test_daemon_requests_share_metrics(self):
+        daemon = Daemon(Runner, {})
+        with mock.patch.multiple(
+                "littlechef_rackspace.runner",
+                RackspaceApi=self.api_class,
+                ChefDeployer=self.deploy_class,
+                RackspaceCreate=self.create_class):
+            runners = [Runner(options={}, daemon=daemon) for _ in range(2)]
+            for runner in runners:
+                runner.main(self.create_args + ['--statsd', 'localhost:8125'])
+
+            self.assertIs(runners[0].metrics, runners[1].metrics)
+            self.assertEquals(1, self.api_class.call_count)
+
+    def test_daemon_requests_share_api_and_isolate_deploys(self):
+        daemon = Daemon(Runner, {})
+        with mock.patch.multiple(
+                "littlechef_rackspace.runner",
+                RackspaceApi=self.api_class,
+                ChefDeployer=self.deploy_class,
+                RackspaceCreate=self.create_class):
+            for _ in range(2):
+                Runner(options={}, daemon=daemon).main(self.create_args)
+
+            self.assertEquals(1, self.api_class.call_count)
+            self.deploy_class.assert_any_call(key_filename="~/.ssh/id_rsa",
+                                              isolate=True,
+                                              log_store=mock.ANY)
+
+    def test_profile_records_phases(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        profiler = Profiler(os.path.join(directory, "profile.pstats"))
+        progress = StringIO.StringIO()
+        with mock.patch.multiple(
+                "littlechef_rackspace.runner",
+                RackspaceApi=self.api_class,
+                ChefDeployer=self.deploy_class,
+                RackspaceCreate=self.create_class):
+            r = Runner(options={}, profiler=profiler)
+            r.main(self.create_args + ['--profile', '--profile-top', '5'],
+                   progress=progress)
+
+        self.assertEquals(["main", "options", "api", "deploy", "execute"],
+                          profiler.phases)
+        self.api_class.return_value.authenticate.assert_called_once_with()
+        self.assertEquals(5, profiler.top)
+        self.assertIn("== execute: ", progress.getvalue())
+        self.assertTrue(os.path.exists(
+            os.path.join(directory, "profile-execute.pstats")))
+
     def test_create_creates_node_with_specified_public_key(self):
         with mock.patch.multiple(
                 "littlechef_rackspace.runner",
@@ -155,7 +288,10 @@ class RunnerTest(unittest.TestCase):
             r.main(self.create_args)
 
             self.create_class.assert_any_call(rackspace_api=self.rackspace_api,
-                                              chef_deployer=self.chef_deployer)
+                                              chef_deployer=self.chef_deployer,
+                                              journal=mock.ANY,
+                                              timings=mock.ANY,
+                                              catalog=mock.ANY)
 
             call_args = self.create_command.execute.call_args_list[0][1]
 
@@ -345,6 +481,34 @@ class RunnerTest(unittest.TestCase):
             self.assertEquals(['role[web]'], call_args.get('runlist'))
             self.assertEquals('dfw', call_args.get('region'))
 
+    def test_template_and_config_options_may_be_spelled_with_dashes(self):
+        with mock.patch.multiple(
+                "littlechef_rackspace.runner",
+                RackspaceApi=self.api_class,
+                ChefDeployer=self.deploy_class,
+                RackspaceCreate=self.create_class):
+            r = Runner(options={
+                'build-timeout': 20,
+                'templates': {
+                    'web': {
+                        'hedge-after': 'p90',
+                        'bootstrap-network': 'auto',
+                        'post_plugins': 'mark_ready'
+                    }
+                }
+            })
+
+            r.main(self.create_args + ['web'])
+
+            call_args = self.create_command.execute.call_args_list[0][1]
+            self.assertEquals('p90', call_args.get('hedge_after'))
+            self.assertEquals(['mark_ready'], call_args.get('post_plugins'))
+            self.assertEquals(20 * 60,
+                              self.api_class.call_args[1]['build_timeout'])
+            self.assertEquals('auto',
+                              self.deploy_class.call_args[1]
+                              ['bootstrap_network'])
+
     def test_create_with_template_that_has_secrets_file_includes_values(self):
         with mock.patch.multiple(
                 "littlechef_rackspace.runner",
@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import mock
+import unittest2 as unittest
+from littlechef_rackspace.api import RackspaceApi
+from littlechef_rackspace.nodes import NodeStore
+from littlechef_rackspace.servers import InvalidQuery, ServerIndex
+
+
+class ServerIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.kitchen = tempfile.mkdtemp()
+        self.node_store = NodeStore(
+            directory=os.path.join(self.kitchen, "nodes"),
+            path=os.path.join(self.kitchen, "nodes.db"))
+        self.now = 1000000.0
+        self.index = ServerIndex(path=os.path.join(self.kitchen, "servers.db"),
+                                 node_store=self.node_store,
+                                 resync_after=3600, clock=lambda: self.now)
+        self.apis = {}
+        for region in ["dfw", "ord"]:
+            api = mock.Mock(spec=RackspaceApi)
+            api.region = region
+            api.list_server_details.return_value = []
+            api.list_server_changes.return_value = ([], [])
+            self.apis[region] = api
+
+    def tearDown(self):
+        shutil.rmtree(self.kitchen)
+
+    def _server(self, name, region="dfw", image="img-1", metadata=None):
+        return {'id': name + "-id", 'name': name, 'region': region,
+                'status': 'ACTIVE', 'public_ipv4': '1.1.1.1',
+                'public_ips': ['1.1.1.1'], 'private_ips': [],
+                'image': image, 'flavor': '2', 'metadata': metadata or {},
+                'created': None, 'updated': None}
+
+    def _names(self, **kwargs):
+        return [server['name'] for server in self.index.query(**kwargs)]
+
+    def test_first_refresh_lists_every_server(self):
+        self.apis["dfw"].list_server_details.return_value = [
+            self._server("web-n01"), self._server("db-n01")]
+
+        self.assertEquals(2, self.index.refresh(self.apis["dfw"]))
+
+        self.assertEquals(["db-n01", "web-n01"], self._names())
+        self.assertFalse(self.apis["dfw"].list_server_changes.called)
+
+    def test_later_refreshes_fetch_changes(self):
+        self.apis["dfw"].list_server_details.return_value = [
+            self._server("web-n01"), self._server("db-n01")]
+        self.index.refresh(self.apis["dfw"])
+        self.now += 600
+        self.apis["dfw"].list_server_changes.return_value = (
+            [self._server("web-n02")], ["db-n01-id"])
+
+        self.assertEquals(2, self.index.refresh(self.apis["dfw"]))
+
+        self.assertEquals(["web-n01", "web-n02"], self._names())
+        self.apis["dfw"].list_server_changes.assert_called_once_with(
+            "1970-01-12T13:45:40Z")
+        self.assertEquals(1, self.apis["dfw"].list_server_details.call_count)
+
+    def test_resyncs_with_a_full_listing(self):
+        self.apis["dfw"].list_server_details.return_value = [
+            self._server("web-n01")]
+        self.index.refresh(self.apis["dfw"])
+        self.now += 3600
+        self.apis["dfw"].list_server_details.return_value = [
+            self._server("web-n02")]
+
+        self.index.refresh(self.apis["dfw"])
+
+        self.assertEquals(["web-n02"], self._names())
+        self.assertFalse(self.apis["dfw"].list_server_changes.called)
+
+    def test_regions_are_indexed_separately(self):
+        self.apis["dfw"].list_server_details.return_value = [
+            self._server("web-n01")]
+        self.apis["ord"].list_server_details.return_value = [
+            self._server("web-n02", region="ord")]
+        self.index.refresh(self.apis["dfw"])
+        self.now += 300
+        self.index.refresh(self.apis["ord"])
+
+        self.assertEquals(["web-n02"], self._names(where={'region': 'ord'}))
+        self.assertEquals({'dfw': 300, 'ord': 0}, self.index.ages())
+
+    def test_query_by_environment_from_node_files(self):
+        self.apis["dfw"].list_server_details.return_value = [
+            self._server("web-n01"), self._server("web-n02")]
+        self.index.refresh(self.apis["dfw"])
+        self.node_store.save({'name': 'web-n01', 'run_list': [],
+                              'chef_environment': 'preprod'})
+
+        servers = self.index.query(where={'environment': 'pre*'})
+
+        self.assertEquals(["web-n01"], [s['name'] for s in servers])
+        self.assertEquals("preprod", servers[0]['environment'])
+
+    def test_query_by_image_and_metadata(self):
+        self.apis["dfw"].list_server_details.return_value = [
+            self._server("web-n01", image="5cebb13a",
+                         metadata={'team': 'web'}),
+            self._server("web-n02", image="5cebb13a"),
+            self._server("db-n01", metadata={'team': 'web'})]
+        self.index.refresh(self.apis["dfw"])
+
+        self.assertEquals(["web-n01"], self._names(
+            where={'image': '5cebb*', 'metadata.team': 'web'}))
+
+    def test_sort(self):
+        self.apis["dfw"].list_server_details.return_value = [
+            self._server("a", image="2"), self._server("b", image="1")]
+        self.index.refresh(self.apis["dfw"])
+
+        self.assertEquals(["b", "a"], self._names(sort=["image"]))
+
+    def test_unknown_field_is_invalid(self):
+        with self.assertRaises(InvalidQuery):
+            self.index.query(where={'colour': 'blue'})
+        with self.assertRaises(InvalidQuery):
+            self.index.query(sort=["colour"])
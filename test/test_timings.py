@@ -0,0 +1,118 @@
+import os
+import shutil
+import sqlite3
+from StringIO import StringIO
+import tempfile
+import unittest2 as unittest
+from littlechef_rackspace.timings import TimingStore
+
+
+class TimingStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = TimingStore(path=os.path.join(self.directory, "t.db"),
+                                 min_samples=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_percentile_without_history_is_none(self):
+        self.assertEquals(None, self.store.percentile("build", 90))
+
+    def test_percentile_of_exact_history(self):
+        for seconds in [100, 200, 300, 400, 1000]:
+            self.store.record("build", seconds, region="dfw", flavor="2",
+                              image="ubuntu")
+
+        self.assertEquals(1000, self.store.percentile(
+            "build", 90, region="dfw", flavor="2", image="ubuntu"))
+        self.assertEquals(300, self.store.percentile(
+            "build", 50, region="dfw", flavor="2", image="ubuntu"))
+        self.assertEquals(1000, self.store.percentile(
+            "build", 150, region="dfw", flavor="2", image="ubuntu"))
+
+    def test_falls_back_to_less_specific_history(self):
+        for seconds in [100, 200, 300]:
+            self.store.record("build", seconds, region="dfw", flavor="2",
+                              image="centos")
+        self.store.record("build", 5000, region="dfw", flavor="2",
+                          image="ubuntu")
+
+        self.assertEquals([100, 200, 300, 5000], self.store.samples(
+            "build", region="dfw", flavor="2", image="ubuntu"))
+
+    def test_keeps_phases_separate(self):
+        for seconds in [1, 2, 3]:
+            self.store.record("deploy", seconds)
+
+        self.assertEquals([], self.store.samples("build"))
+
+    def test_template_is_the_first_key_dropped(self):
+        for seconds in [100, 200, 300]:
+            self.store.record("build", seconds, region="dfw", template="web")
+        self.store.record("build", 900, region="dfw", template="db")
+
+        self.assertEquals([900], self.store.samples(
+            "build", region="dfw", template="db")[-1:])
+        self.assertEquals(4, len(self.store.samples(
+            "build", region="dfw", template="db")))
+        self.assertEquals([100, 200, 300], self.store.samples(
+            "build", region="dfw", template="web"))
+
+    def test_adds_template_to_existing_history(self):
+        path = os.path.join(self.directory, "old.db")
+        db = sqlite3.connect(path)
+        db.execute("CREATE TABLE timings (phase TEXT NOT NULL, "
+                   "seconds REAL NOT NULL, region TEXT, flavor TEXT, "
+                   "image TEXT, recorded REAL NOT NULL)")
+        db.execute("INSERT INTO timings VALUES ('build', 60, 'dfw', '2', "
+                   "'ubuntu', 0)")
+        db.commit()
+        db.close()
+
+        store = TimingStore(path=path, min_samples=1)
+        store.record("build", 120, region="dfw", template="web")
+
+        self.assertEquals([60, 120], store.samples("build", region="dfw"))
+
+    def test_estimate_of_windowed_run(self):
+        for seconds in [100, 200, 300, 400, 500]:
+            self.store.record("rebuild", seconds, region="dfw")
+            self.store.record("deploy", seconds / 10, region="dfw")
+
+        estimate = self.store.estimate(["rebuild", "deploy"], count=5,
+                                       concurrency=2, region="dfw")
+
+        self.assertEquals(3, estimate['sequence'])
+        self.assertEquals((300 + 30) * 3, estimate['p50'])
+        self.assertEquals((500 + 50) * 3, estimate['p90'])
+
+    def test_estimate_without_history(self):
+        self.store.record("build", 300)
+
+        estimate = self.store.estimate(["build", "deploy"])
+        progress = StringIO()
+        self.store.describe(estimate, progress)
+
+        self.assertIsNone(estimate['p50'])
+        self.assertIn("deploy    no history", progress.getvalue())
+        self.assertIn("Critical path: build -> deploy\n",
+                      progress.getvalue())
+        self.assertIn("Wall time: unknown", progress.getvalue())
+
+    def test_describe_estimate(self):
+        for seconds in [100, 200, 300]:
+            self.store.record("build", seconds)
+            self.store.record("deploy", 60)
+
+        progress = StringIO()
+        self.store.describe(self.store.estimate(["build", "deploy"], count=4,
+                                                concurrency=2), progress)
+
+        self.assertIn("build     p50 3m20s     p90 5m00s     (3 samples)",
+                      progress.getvalue())
+        self.assertIn("on 2 servers in turn (4 servers, 2 at a time)",
+                      progress.getvalue())
+        self.assertIn("Wall time: about 8m40s (p90 12m00s)",
+                      progress.getvalue())
@@ -0,0 +1,100 @@
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest2 as unittest
+from littlechef_rackspace.userdata import (bootstrap_script, build_bundle,
+                                           file_sha256, temp_url)
+
+
+class BuildBundleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.kitchen = tempfile.mkdtemp()
+        os.chdir(self.kitchen)
+        for directory in ["nodes", "roles", "cookbooks/web/recipes",
+                          "site-cookbooks", "data_bags", "environments"]:
+            os.makedirs(directory)
+        self._write("nodes/web-n01.json", {'name': 'web-n01',
+                                           'run_list': ['role[web]']})
+        self._write("roles/web.json", {'name': 'web',
+                                       'run_list': ['recipe[web]']})
+        self._write("cookbooks/web/metadata.json", {'name': 'web'})
+        self.path = os.path.join(self.kitchen, "state", "kitchen.tar.gz")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.kitchen)
+
+    def _write(self, path, data):
+        with open(path, "w") as f:
+            f.write(json.dumps(data))
+
+    def test_bundles_kitchen_with_node_data_bag(self):
+        sha256 = build_bundle(self.path)
+
+        names = tarfile.open(self.path).getnames()
+        self.assertIn("cookbooks/web/metadata.json", names)
+        self.assertIn("roles/web.json", names)
+        self.assertIn("data_bags/node/web-n01.json", names)
+        self.assertNotIn("nodes/web-n01.json", names)
+        self.assertEquals(file_sha256(self.path), sha256)
+        self.assertFalse(os.path.exists("data_bags/node"))
+        with open(self.path, "rb") as bundle:
+            # No timestamp in the gzip header
+            self.assertEquals("\0" * 4, bundle.read(8)[4:])
+
+    def test_same_kitchen_bundles_to_same_bytes(self):
+        first = build_bundle(self.path)
+        os.utime("roles/web.json", (0, 0))
+
+        self.assertEquals(first, build_bundle(self.path))
+
+
+class BootstrapScriptTest(unittest.TestCase):
+
+    def setUp(self):
+        self.node = {'name': 'web-n01', 'chef_environment': 'production',
+                     'run_list': ['role[web]']}
+
+    def test_script_runs_chef_solo_with_node_data(self):
+        script = bootstrap_script(self.node, "https://example.com/k.tar.gz",
+                                  "abc123", node_work_path="/tmp/chef-solo/")
+
+        self.assertTrue(script.startswith("#!/bin/sh\n"))
+        self.assertIn("curl -fsSL --retry 5 -o /tmp/chef-solo/kitchen.tar.gz"
+                      " https://example.com/k.tar.gz", script)
+        self.assertIn("'abc123  /tmp/chef-solo/kitchen.tar.gz' | "
+                      "sha256sum -c -", script)
+        self.assertIn('environment "production"', script)
+        self.assertIn('"run_list": [\n        "role[web]"\n    ]', script)
+        self.assertIn("install.sh", script)
+        self.assertNotIn("curl -fsS -m 30", script)
+        self.assertEquals(0, subprocess.call(["sh", "-n", "-c", script]))
+
+    def test_script_reports_to_callback(self):
+        script = bootstrap_script(self.node, "https://example.com/k.tar.gz",
+                                  "abc123", install_chef=False,
+                                  callback_url="https://example.com/cb?a=1",
+                                  node_work_path="/tmp/chef-solo")
+
+        self.assertIn("'\"web-n01\"' $result $status", script)
+        self.assertIn("-d @- 'https://example.com/cb?a=1'", script)
+        self.assertNotIn("install.sh", script)
+
+
+class TempUrlTest(unittest.TestCase):
+
+    def test_signs_path_and_expiry(self):
+        url = temp_url("https://storage101.dfw1.clouddrive.com/v1/"
+                       "MossoCloudFS_x/kitchens/kitchen.tar.gz", "secret",
+                       1400000000.5)
+
+        self.assertEquals("https://storage101.dfw1.clouddrive.com/v1/"
+                          "MossoCloudFS_x/kitchens/kitchen.tar.gz"
+                          "?temp_url_sig=db697df6a6b9a9666368e6f879609633"
+                          "db4e2b20"
+                          "&temp_url_expires=1400000000", url)
@@ -0,0 +1,102 @@
+import socket
+import unittest2 as unittest
+import mock
+from littlechef_rackspace.verify import Verifier
+
+
+class VerifierTest(unittest.TestCase):
+
+    def setUp(self):
+        readconfig = mock.patch('littlechef_rackspace.verify.lc._readconfig')
+        readconfig.start()
+        self.addCleanup(readconfig.stop)
+        self.verifier = Verifier("~/.ssh/id_rsa",
+                                 commands=["service nginx status"])
+        self.client = mock.Mock()
+        self.statuses = {}
+
+        def exec_command(command, timeout=None):
+            stdout, stderr = mock.Mock(), mock.Mock()
+            status, output = self.statuses.get(command, (0, ""))
+            stdout.read.return_value = output
+            stderr.read.return_value = ""
+            stdout.channel.recv_exit_status.return_value = status
+            return mock.Mock(), stdout, stderr
+
+        self.client.exec_command.side_effect = exec_command
+        self.verifier._connect = mock.Mock(return_value=self.client)
+
+    def _results(self, results):
+        return [(result.name, result.passed, result.detail)
+                for result in results]
+
+    def test_checks_chef_and_commands_over_one_connection(self):
+        self.statuses["service nginx status"] = (3, "nginx is not running\n")
+
+        results = self.verifier.verify("1.1.1.1")
+
+        self.assertEquals([
+            ("ssh", True, None),
+            ("chef", True, None),
+            ("service nginx status", False,
+             "exited 3: nginx is not running")], self._results(results))
+        self.verifier._connect.assert_called_once_with("1.1.1.1")
+        self.assertTrue(self.client.close.called)
+        chef_check = self.client.exec_command.call_args_list[0][0][0]
+        self.assertIn("/tmp/chef-solo/cache/failed-run-data.json",
+                      chef_check)
+
+    @mock.patch('littlechef_rackspace.verify.lc')
+    def test_chef_check_uses_kitchen_node_work_path(self, lc):
+        lc._readconfig.side_effect = lambda: setattr(
+            lc.env, 'node_work_path', '/srv/chef')
+
+        self.verifier.verify("1.1.1.1")
+        self.verifier.verify("1.1.1.2")
+
+        lc._readconfig.assert_called_once_with()
+        chef_check = self.client.exec_command.call_args_list[0][0][0]
+        self.assertIn("test ! -e /srv/chef/cache/failed-run-data.json",
+                      chef_check)
+
+    def test_failed_connection_fails_remote_checks(self):
+        self.verifier._connect.side_effect = socket.timeout("timed out")
+
+        results = self.verifier.verify("1.1.1.1")
+
+        self.assertEquals([
+            ("ssh", False, "timed out"),
+            ("chef", False, "no SSH connection"),
+            ("service nginx status", False, "no SSH connection")],
+            self._results(results))
+
+    def test_checks_ports_from_here(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        closed = socket.socket()
+        closed.bind(("127.0.0.1", 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+        verifier = Verifier("~/.ssh/id_rsa",
+                            ports=[str(listener.getsockname()[1]),
+                                   closed_port])
+        verifier._connect = self.verifier._connect
+
+        results = verifier.verify("127.0.0.1")
+
+        self.assertEquals([True, False],
+                          [result.passed for result in results[2:]])
+        self.assertEquals(verifier.check_names(),
+                          [result.name for result in results])
+
+    def test_servers_without_address_fail(self):
+        results = self.verifier.verify_servers([
+            {'id': '1', 'name': 'web-n01', 'public_ipv4': None},
+            {'id': '2', 'name': 'web-n02', 'public_ipv4': '1.1.1.2'}])
+
+        errors = dict((result.item['name'], result.error)
+                      for result in results)
+        self.assertIsNotNone(errors['web-n01'])
+        self.assertIsNone(errors['web-n02'])